@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gettingstarted.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Bounds the requests (and so threads and database connections) each worker has in flight,
+# see `pitchers/middleware.py`.
+from pitchers.middleware import ConcurrencyLimit  # noqa: E402 - needs the app registry set up above
+
+application = ConcurrencyLimit(django_application, settings.ASGI_CONCURRENCY, settings.ASGI_UNLIMITED_PATHS)
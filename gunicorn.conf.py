@@ -7,6 +7,7 @@
 # https://github.com/heroku/heroku-buildpack-python/blob/main/vendor/python.gunicorn.sh
 
 import os
+import time
 
 # On Heroku, web dynos must bind to the port number specified via the `PORT` env var. This
 # env var is set automatically for web dynos and also when using `heroku local` locally:
@@ -29,16 +30,20 @@ bind = ["[::]:{}".format(os.environ.get("PORT", 5006))]
 # Note: When changing the number of dynos/workers/threads you will want to make sure you
 # do not exceed the maximum number of connections to external services such as DBs:
 # https://devcenter.heroku.com/articles/python-concurrency-and-database-connections
-worker_class = "gthread"
+#
+# We serve the ASGI app (`gettingstarted.asgi`) with uvicorn workers rather than `gthread`, so that
+# the long-lived `/api/events/` streams are parked coroutines instead of holding a thread each. The
+# regular (sync) views still run in threads, one per in-flight request, and the app caps those at
+# `ASGI_CONCURRENCY` per worker (5, as the gthread pool was), so each worker still uses at most that
+# many DB connections for them. Their streamed bodies must be async iterators under ASGI, or Django
+# reads them whole before sending (see `pitchers/streaming.py`).
+worker_class = "uvicorn_worker.UvicornWorker"
 
 # gunicorn will start this many worker processes. The Python buildpack automatically sets a
 # default for WEB_CONCURRENCY at dyno boot, based on the number of CPUs and available RAM:
 # https://devcenter.heroku.com/articles/python-concurrency
 workers = os.environ.get("WEB_CONCURRENCY", 1)
 
-# Each `gthread` worker process will use a pool of this many threads.
-threads = 5
-
 # Workers silent for more than this many seconds are killed and restarted.
 # Note: This only affects the maximum request time when using the `sync` worker.
 # For all other worker types it acts only as a worker heartbeat timeout.
@@ -77,3 +82,74 @@ else:
     # are correctly marked as secure. This allows the WSGI app (in our case, Django) to distinguish
     # between HTTP and HTTPS requests for features like HTTP->HTTPS URL redirection.
     forwarded_allow_ips = "*"
+
+
+# Server hooks: https://docs.gunicorn.org/en/stable/settings.html#server-hooks
+# With `preload_app`, the pitcher dataset is loaded once in the master into an immutable snapshot
+# (see `pitchers/dataset.py`) that the forked workers then share copy-on-write, so the first
+# request each worker serves is already warm.
+_boot_started = time.monotonic()
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from django.urls import get_resolver
+    from pitchers.dataset import preload_snapshot, format_memory
+
+    # Import the urlconf (views, serializers, DRF, simplejwt) and build its lookup tables in the
+    # master too, rather than in every worker on its first request.
+    get_resolver().reverse_dict
+
+    try:
+        snapshot = preload_snapshot()
+    except Exception as e:
+        # A missing table (eg before the first migrate) shouldn't stop the dyno from booting,
+        # workers will build the snapshot lazily instead.
+        server.log.warning(f"Skipping pitcher snapshot preload: {e}")
+        return
+    server.log.info(
+        f"Preloaded pitcher snapshot v{snapshot.version} ({len(snapshot)} rows) in "
+        f"{snapshot.build_seconds:.3f}s, boot took {time.monotonic() - _boot_started:.3f}s, "
+        f"master {format_memory()}"
+    )
+
+
+def post_fork(server, worker):
+    # Workers forked at boot inherit the caches primed in the master. A worker forked later (eg after a
+    # crash) while the dataset has moved on primes the new version from `warm_caches` artifacts here,
+    # before it starts accepting connections.
+    if not server.cfg.preload_app:
+        return
+    from django.db import connections
+    from pitchers.warming import prime
+
+    try:
+        loaded = prime()
+    except Exception as e:
+        worker.log.warning(f"Skipping cache priming: {e}")
+        return
+    finally:
+        connections.close_all()
+    if loaded is not None:
+        worker.log.info(f"Worker primed caches from {loaded} artifacts")
+
+
+def post_worker_init(worker):
+    if not worker.cfg.preload_app:
+        return
+    from pitchers.dataset import format_memory
+
+    worker.log.info(f"Worker ready {time.monotonic() - _boot_started:.3f}s after boot, {format_memory(worker.pid)}")
+
+
+def worker_exit(server, worker):
+    # Write the favorite counts and trending activity still buffered in this worker (see `pitchers/counters.py`)
+    # before it exits on a restart or deploy, rather than losing up to a flush interval of them.
+    try:
+        from pitchers.counters import flush_at_exit
+    except Exception as e:
+        # The app never loaded in this worker, so nothing was buffered.
+        worker.log.warning(f"Skipping counter flush: {e}")
+        return
+    flush_at_exit()
@@ -1,14 +1,109 @@
+from django.conf import settings
 from django.contrib import admin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
+
 from .models import Pitcher, FavoritePitcher
 
+
+def estimated_row_count(model):
+    """Row count from the database's table statistics, or None where there are none (SQLite)"""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                [table]
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    # Postgres reports -1 for tables that have never been analyzed.
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Avoids a full COUNT(*) on every changelist page load.
+
+    Unfiltered lists use the table statistics once the table is larger than
+    `ADMIN_COUNT_LIMIT`; filtered lists count at most `ADMIN_COUNT_LIMIT` rows,
+    so the page links stop there rather than scanning every match.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model)
+            if estimate is not None and estimate > settings.ADMIN_COUNT_LIMIT:
+                return estimate
+        return queryset.order_by()[:settings.ADMIN_COUNT_LIMIT].count()
+
+
+class CachedValuesFilter(admin.SimpleListFilter):
+    """
+    List filter whose choices are the distinct values of `parameter_name`,
+    cached for `ADMIN_FILTER_CACHE_TIMEOUT` instead of a DISTINCT scan per page load.
+    """
+
+    def lookups(self, request, model_admin):
+        key = f"admin:filter:{model_admin.model._meta.label_lower}:{self.parameter_name}"
+        values = cache.get(key)
+        if values is None:
+            values = list(
+                model_admin.model.objects.order_by(self.parameter_name)
+                .values_list(self.parameter_name, flat=True).distinct()
+            )
+            cache.set(key, values, settings.ADMIN_FILTER_CACHE_TIMEOUT)
+        return [(value, value) for value in values]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            return queryset.filter(**{self.parameter_name: self.value()})
+        return queryset
+
+
+class TeamFilter(CachedValuesFilter):
+    title = 'team'
+    parameter_name = 'team_name'
+
+
+class PitchTypeFilter(CachedValuesFilter):
+    title = 'pitch type'
+    parameter_name = 'pitch_type'
+
+
+class ThrowsFilter(CachedValuesFilter):
+    title = 'throws'
+    parameter_name = 'throws'
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # No second COUNT(*) over the whole table for "N of M selected", and no per-choice facet counts.
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    ordering = ('-id',)
+
+
 @admin.register(Pitcher)
-class PitcherAdmin(admin.ModelAdmin):
-    list_display = ('player_name', 'team_name', 'pitch_type', 'throws')
-    search_fields = ('player_name', 'team_name')
-    list_filter = ('team_name', 'pitch_type', 'throws')
+class PitcherAdmin(ScalableAdmin):
+    list_display = ('player_name', 'team_name', 'pitch_type', 'throws', 'archetype')
+    # Prefix searches, so the indexes on these columns can be used.
+    search_fields = ('^player_name', '^team_name')
+    list_filter = (TeamFilter, PitchTypeFilter, ThrowsFilter)
+
 
 @admin.register(FavoritePitcher)
-class FavoritePitcherAdmin(admin.ModelAdmin):
+class FavoritePitcherAdmin(ScalableAdmin):
     list_display = ('user', 'pitcher', 'created_at')
     list_filter = ('created_at',)
-    search_fields = ('user__username', 'pitcher__player_name')
+    list_select_related = ('user', 'pitcher')
+    search_fields = ('^user__username', '^pitcher__player_name')
+    raw_id_fields = ('user',)
+    autocomplete_fields = ('pitcher',)
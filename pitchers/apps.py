@@ -1,6 +1,26 @@
 from django.apps import AppConfig
+from django.core.signals import request_started
+from django.db.models.signals import pre_save, post_save, post_delete
 
 
 class PitchersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pitchers'
+
+    def ready(self):
+        from .bundles import check_primary
+        from .changes import stamp_pitcher, publish_pitcher, record_tombstone
+        from .models import Pitcher, FavoritePitcher
+        from .recommendations import favorites_changed
+
+        # Delta sync bookkeeping for pitcher writes, see `pitchers/changes.py`.
+        pre_save.connect(stamp_pitcher, sender=Pitcher, dispatch_uid='pitchers.stamp_pitcher')
+        post_save.connect(publish_pitcher, sender=Pitcher, dispatch_uid='pitchers.publish_pitcher')
+        post_delete.connect(record_tombstone, sender=Pitcher, dispatch_uid='pitchers.record_tombstone')
+
+        # Keep the co-occurrence counts behind recommendations in step with favorites.
+        post_save.connect(favorites_changed, sender=FavoritePitcher, dispatch_uid='pitchers.favorites_saved')
+        post_delete.connect(favorites_changed, sender=FavoritePitcher, dispatch_uid='pitchers.favorites_deleted')
+
+        # Notice dataset versions published by other processes before reading from a bundle.
+        request_started.connect(check_primary, dispatch_uid='pitchers.check_bundle')
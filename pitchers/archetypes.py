@@ -0,0 +1,217 @@
+"""
+Pitch archetypes: clusters of similar pitches within each pitch type.
+
+Each pitch is described by five features: velocity (midpoint of
+`velocity_range`), spin, induced vertical break, horizontal break magnitude
+(so left- and right-handers' pitches group together) and arm angle. Features
+are standardized per pitch type, so each one carries the same weight. `cluster`
+then runs k-means on each pitch type, with k-means++ starts, `RESTARTS`
+restarts and vectorized Lloyd iterations. The random generator is seeded from
+`ARCHETYPE_SEED` and the pitch type, so the same data always gives the same
+archetypes. Clusters are numbered by descending velocity (`FF-1` is the
+hardest group of four-seamers) and named after what sets their centroid apart
+from the pitch type's average, eg "riding four-seamer" or "gyro slider".
+
+`assign` stores each pitch's archetype label, and its distance to the centroid
+in standard deviations, in indexed columns on `Pitcher`. One `PitchArchetype`
+row is kept per cluster, so the API only does indexed lookups. It runs at the
+end of every `load_pitchers`, or on demand with `manage.py cluster_pitchers`.
+Rows without tracking data (eg placeholder pitchers) get no archetype.
+"""
+import logging
+import time
+import zlib
+from collections import defaultdict
+from contextlib import nullcontext
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+
+from .changes import dataset_change
+from .models import Pitcher, PitchArchetype
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ('velocity', 'avg_spin_rate', 'avg_induced_vert_break', 'horz_break', 'arm_angle')
+# (feature index, word for above the pitch type's average, word for below), in naming order.
+DESCRIPTORS = (
+    (0, 'hard', 'soft'),
+    (1, 'high-spin', 'low-spin'),
+    (4, 'over-the-top', 'low-slot'),
+    (2, 'riding', 'dropping'),
+    (3, 'sweeping', 'gyro'),
+)
+# Standard deviations a centroid must be from the average for a feature to appear in its name.
+DESCRIPTOR_THRESHOLD = 0.5
+PITCH_NAMES = {
+    'FF': 'four-seamer', 'SI': 'sinker', 'FC': 'cutter', 'SL': 'slider', 'ST': 'sweeper', 'SV': 'slurve',
+    'CU': 'curveball', 'KC': 'knuckle curve', 'CS': 'slow curve', 'CH': 'changeup', 'FS': 'splitter',
+    'FO': 'forkball', 'SC': 'screwball', 'EP': 'eephus', 'FA': 'fastball', 'KN': 'knuckleball',
+}
+RESTARTS = 4
+MAX_ITERATIONS = 100
+# Lloyd iterations stop once the centroids move less than this in total (squared, standardized units).
+TOLERANCE = 1e-4
+
+
+def velocity(velocity_range):
+    """Midpoint of a `94.0-97.1` style range, or None if it isn't one"""
+    low, _, high = velocity_range.partition('-')
+    try:
+        return (float(low) + float(high or low)) / 2
+    except ValueError:
+        return None
+
+
+def feature_row(velocity_range, spin_rate, induced_vert_break, horz_break, arm_angle):
+    """The pitch's features in `FEATURES` order, or None when it has no tracking data"""
+    mph = velocity(velocity_range)
+    if mph is None or not spin_rate or spin_rate <= 0 or None in (induced_vert_break, horz_break, arm_angle):
+        return None
+    return mph, spin_rate, induced_vert_break, abs(horz_break), arm_angle
+
+
+def squared_distances(points, centroids):
+    """(points x centroids) squared distances, as |p|^2 - 2 p.c + |c|^2 so it's one matrix product"""
+    distances = (points ** 2).sum(axis=1)[:, None] - 2 * points @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+    return np.maximum(distances, 0, out=distances)
+
+
+def kmeans(points, k, rng):
+    """(centroids, labels) of the lowest-inertia of `RESTARTS` k-means++ runs"""
+    best = None
+    for _ in range(RESTARTS):
+        centroids = points[[rng.integers(len(points))]]
+        while len(centroids) < k:
+            nearest = squared_distances(points, centroids).min(axis=1)
+            centroids = np.vstack([centroids, points[rng.choice(len(points), p=nearest / nearest.sum())]])
+        for _ in range(MAX_ITERATIONS):
+            labels = squared_distances(points, centroids).argmin(axis=1)
+            sizes = np.bincount(labels, minlength=k)
+            sums = np.stack(
+                [np.bincount(labels, weights=points[:, column], minlength=k) for column in range(points.shape[1])],
+                axis=1
+            )
+            # An emptied cluster keeps its centroid.
+            moved = np.where(sizes[:, None] > 0, sums / np.maximum(sizes, 1)[:, None], centroids)
+            shift = ((moved - centroids) ** 2).sum()
+            centroids = moved
+            if shift <= TOLERANCE:
+                break
+        distances = squared_distances(points, centroids)
+        labels = distances.argmin(axis=1)
+        inertia = distances[np.arange(len(points)), labels].sum()
+        if best is None or inertia < best[0]:
+            best = (inertia, centroids, labels)
+    return best[1], best[2]
+
+
+def describe(pitch_type, centroid):
+    """Name of an archetype from its standardized centroid, eg 'riding four-seamer'"""
+    notable = sorted(
+        (
+            (-abs(centroid[index]), position, high if centroid[index] > 0 else low)
+            for position, (index, high, low) in enumerate(DESCRIPTORS)
+            if abs(centroid[index]) >= DESCRIPTOR_THRESHOLD
+        )
+    )[:2]
+    words = [word for _, _, word in sorted(notable, key=lambda item: item[1])] or ['standard']
+    return ' '.join([*words, PITCH_NAMES.get(pitch_type, pitch_type)])
+
+
+def cluster_pitch_type(pitch_type, ids, raw):
+    """Cluster one pitch type; returns (unsaved `PitchArchetype`s, {pitcher id: (label, distance)})"""
+    mean = raw.mean(axis=0)
+    scale = raw.std(axis=0)
+    # A feature with no spread (up to rounding) is left unscaled rather than blown up.
+    scale[np.isclose(scale, 0)] = 1.0
+    points = (raw - mean) / scale
+    k = max(1, min(
+        settings.ARCHETYPES_PER_PITCH_TYPE, len(points) // settings.ARCHETYPE_MIN_SIZE, len(np.unique(points, axis=0))
+    ))
+    rng = np.random.default_rng([settings.ARCHETYPE_SEED, zlib.crc32(pitch_type.encode())])
+    centroids, labels = kmeans(points, k, rng)
+    distances = np.sqrt(((points - centroids[labels]) ** 2).sum(axis=1))
+
+    archetypes = []
+    assignments = {}
+    used = np.unique(labels)
+    for rank, cluster in enumerate(used[np.argsort(-centroids[used, 0], kind='stable')], start=1):
+        label = f"{pitch_type}-{rank}"
+        members = labels == cluster
+        archetypes.append(PitchArchetype(
+            label=label,
+            pitch_type=pitch_type,
+            rank=rank,
+            name=describe(pitch_type, centroids[cluster]),
+            size=int(members.sum()),
+            centroid={
+                feature: round(float(value), 2) for feature, value in zip(FEATURES, raw[members].mean(axis=0))
+            },
+            spread=round(float(distances[members].mean()), 4),
+        ))
+        for pitcher_id, distance in zip(ids[members].tolist(), distances[members].tolist()):
+            assignments[pitcher_id] = (label, round(distance, 4))
+    return archetypes, assignments
+
+
+def cluster(rows):
+    """
+    Cluster `rows` of (id, pitch_type, velocity_range, spin, induced vertical
+    break, horizontal break, arm angle); returns (unsaved `PitchArchetype`s,
+    {pitcher id: (label, distance)}).
+    """
+    groups = defaultdict(lambda: ([], []))
+    for pitcher_id, pitch_type, *values in rows:
+        features = feature_row(*values)
+        if features is not None and pitch_type:
+            ids, matrix = groups[pitch_type]
+            ids.append(pitcher_id)
+            matrix.append(features)
+
+    archetypes = []
+    assignments = {}
+    for pitch_type in sorted(groups):
+        ids, matrix = groups[pitch_type]
+        found, assigned = cluster_pitch_type(
+            pitch_type, np.array(ids, dtype=np.int64), np.array(matrix, dtype=np.float64)
+        )
+        archetypes.extend(found)
+        assignments.update(assigned)
+    return archetypes, assignments
+
+
+def assign():
+    """Recluster all pitches and store the results; returns the number of archetypes"""
+    started = time.perf_counter()
+    rows = list(Pitcher.objects.order_by('id').values_list(
+        'id', 'pitch_type', 'velocity_range', 'avg_spin_rate', 'avg_induced_vert_break', 'avg_horz_break',
+        'arm_angle', 'archetype', 'archetype_distance'
+    ))
+    archetypes, assignments = cluster(row[:7] for row in rows)
+    clustered = time.perf_counter()
+
+    # Only rows whose archetype moved are rewritten (and sent to delta sync clients).
+    changed = []
+    for pitcher_id, *_, label, distance in rows:
+        assigned = assignments.get(pitcher_id, ('', None))
+        if assigned != (label, distance):
+            changed.append((pitcher_id, *assigned))
+    with dataset_change() if changed else nullcontext() as version, transaction.atomic():
+        PitchArchetype.objects.all().delete()
+        PitchArchetype.objects.bulk_create(archetypes)
+        if changed:
+            # A prepared UPDATE per row: `bulk_update`'s CASE expressions are far slower at this size.
+            quote = connection.ops.quote_name
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f"UPDATE {quote(Pitcher._meta.db_table)} SET {quote('archetype')} = %s, "
+                    f"{quote('archetype_distance')} = %s, {quote('row_version')} = %s WHERE {quote('id')} = %s",
+                    [(label, distance, version, pitcher_id) for pitcher_id, label, distance in changed]
+                )
+    logger.info(
+        f"Clustered {len(assignments)} pitches into {len(archetypes)} archetypes in "
+        f"{clustered - started:.3f}s ({len(changed)} rows updated in {time.perf_counter() - clustered:.3f}s)"
+    )
+    return len(archetypes)
@@ -0,0 +1,184 @@
+"""
+Batched reads in the shape the client declares, in one request.
+
+`POST /api/query/` takes a document naming the roots and fields a page needs:
+
+    {
+        "user": ["id", "username", "email"],
+        "favorites": ["id", "created_at", {"pitcher": ["id", "player_name", {"archetype": ["label", "name"]}]}],
+        "pitchers": {"ids": [12, 40], "fields": ["id", "player_name", "team_name"]}
+    }
+
+A selection is a list of field names and `{relation: selection}` objects
+(`"archetype"` alone is the pitcher's archetype label; `{"archetype": [...]}`
+is the archetype itself). The response mirrors the query, with `null` for
+pitcher ids that don't exist.
+
+Resolution works like DataLoader. Every key the query references is collected
+per type by a `Loader`. Loaders run once each, in dependency order (favorites,
+then pitchers, then archetypes), so each type costs a single `IN` query, and
+that query reads only the selected columns. Keys found while loading one type,
+eg the pitchers of the favorites, join the batch of the next. The user comes
+from the authenticated request without a query.
+"""
+from django.conf import settings
+
+from .models import FavoritePitcher, Pitcher, PitchArchetype
+
+
+class QueryError(ValueError):
+    pass
+
+
+class Type:
+    """A loadable type: its fields, and relations as {name: (field holding the key, related type)}"""
+
+    def __init__(self, name, model, key, fields, relations=None):
+        self.name = name
+        self.model = model
+        self.key = key
+        self.fields = frozenset(fields)
+        self.relations = relations or {}
+
+
+# In load order: a type's relations only point at types after it.
+TYPES = {
+    'favorite': Type(
+        'favorite', FavoritePitcher, 'id', ('id', 'created_at', 'pitcher_id'), {'pitcher': ('pitcher_id', 'pitcher')}
+    ),
+    'pitcher': Type(
+        'pitcher', Pitcher, 'id', [field.attname for field in Pitcher._meta.concrete_fields],
+        {'archetype': ('archetype', 'archetype')}
+    ),
+    'archetype': Type(
+        'archetype', PitchArchetype, 'label', ('label', 'pitch_type', 'rank', 'name', 'size', 'centroid', 'spread')
+    ),
+}
+USER_FIELDS = frozenset(('id', 'username', 'email', 'is_staff', 'date_joined'))
+
+
+class Loader:
+    """Collects the keys and columns wanted of one type, then fetches them with one query"""
+
+    def __init__(self, type_, queryset=None):
+        self.type = type_
+        self.queryset = queryset if queryset is not None else type_.model.objects.all()
+        self.columns = {type_.key}
+        self.keys = set()
+        self.everything = False
+        self.order = []
+        self.rows = {}
+        # (selection, keys) pairs whose relations are expanded once this type is loaded.
+        self.selections = []
+
+    def want(self, keys, selection):
+        self.keys.update(key for key in keys if key is not None and key != '')
+        self.selections.append((selection, keys))
+
+    def want_all(self, selection):
+        """Every row of the queryset (for roots like the user's favorites), in order"""
+        self.everything = True
+        self.selections.append((selection, None))
+
+    def load(self):
+        if not self.everything and not self.keys:
+            return
+        queryset = self.queryset if self.everything else self.queryset.filter(**{f"{self.type.key}__in": self.keys})
+        for row in queryset.order_by(self.type.key).values(*sorted(self.columns)):
+            self.rows[row[self.type.key]] = row
+            self.order.append(row[self.type.key])
+
+
+class BatchQuery:
+    def __init__(self, user, document):
+        self.user = user
+        self.document = document
+        self.loaders = {name: Loader(type_) for name, type_ in TYPES.items()}
+        self.loaders['favorite'].queryset = FavoritePitcher.objects.filter(user=user)
+
+    def plan(self, type_, selection):
+        """Validate `selection` on `type_` and add the columns it reads to the loaders"""
+        if not isinstance(selection, list) or not selection:
+            raise QueryError(f"Selection on {type_.name} must be a non-empty list")
+        columns = self.loaders[type_.name].columns
+        for item in selection:
+            if isinstance(item, str):
+                if item not in type_.fields:
+                    raise QueryError(f"Unknown field '{item}' on {type_.name}")
+                columns.add(item)
+            elif isinstance(item, dict):
+                for name, nested in item.items():
+                    if name not in type_.relations:
+                        raise QueryError(f"Unknown relation '{name}' on {type_.name}")
+                    field, related = type_.relations[name]
+                    columns.add(field)
+                    self.plan(TYPES[related], nested)
+            else:
+                raise QueryError(f"Selection items on {type_.name} must be field names or relation objects")
+
+    def resolve(self):
+        document = self.document
+        if not isinstance(document, dict) or not document:
+            raise QueryError('The query must be an object with user, favorites and/or pitchers')
+        unknown = set(document) - {'user', 'favorites', 'pitchers'}
+        if unknown:
+            raise QueryError(f"Unknown roots: {', '.join(sorted(unknown))}")
+
+        result = {}
+        if 'user' in document:
+            fields = document['user']
+            if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+                raise QueryError('Selection on user must be a list of field names')
+            if set(fields) - USER_FIELDS:
+                raise QueryError(f"Unknown fields on user: {', '.join(sorted(set(fields) - USER_FIELDS))}")
+            result['user'] = {field: getattr(self.user, field) for field in fields}
+        if 'favorites' in document:
+            self.plan(TYPES['favorite'], document['favorites'])
+            self.loaders['favorite'].want_all(document['favorites'])
+        pitcher_ids = None
+        if 'pitchers' in document:
+            root = document['pitchers']
+            if not isinstance(root, dict) or not isinstance(root.get('ids'), list) \
+                    or not all(isinstance(pk, int) and not isinstance(pk, bool) for pk in root['ids']):
+                raise QueryError('pitchers must be {"ids": [...], "fields": [...]}')
+            if len(root['ids']) > settings.QUERY_MAX_IDS:
+                raise QueryError(f"At most {settings.QUERY_MAX_IDS} pitcher ids per query")
+            pitcher_ids = root['ids']
+            self.plan(TYPES['pitcher'], root.get('fields'))
+            self.loaders['pitcher'].want(pitcher_ids, root['fields'])
+
+        for name in TYPES:
+            loader = self.loaders[name]
+            loader.load()
+            # Keys of related rows join the next loaders' batches before those run.
+            for selection, keys in loader.selections:
+                keys = loader.order if keys is None else keys
+                for item in selection:
+                    if isinstance(item, dict):
+                        for relation, nested in item.items():
+                            field, related = loader.type.relations[relation]
+                            self.loaders[related].want(
+                                [loader.rows[key][field] for key in keys if key in loader.rows], nested
+                            )
+
+        if 'favorites' in document:
+            result['favorites'] = [
+                self.render('favorite', key, document['favorites']) for key in self.loaders['favorite'].order
+            ]
+        if pitcher_ids is not None:
+            result['pitchers'] = [self.render('pitcher', pk, document['pitchers']['fields']) for pk in pitcher_ids]
+        return result
+
+    def render(self, name, key, selection):
+        row = self.loaders[name].rows.get(key)
+        if row is None:
+            return None
+        rendered = {}
+        for item in selection:
+            if isinstance(item, str):
+                rendered[item] = row[item]
+            else:
+                for relation, nested in item.items():
+                    field, related = TYPES[name].relations[relation]
+                    rendered[relation] = self.render(related, row[field], nested)
+        return rendered
@@ -0,0 +1,85 @@
+"""
+Per-user favorites as bitsets over pitcher ids.
+
+Pitcher ids are dense (loads update rows in place), so bit i of a user's
+bitset says whether they follow pitcher i. The whole dataset fits in a few
+hundred bytes per user. Bitsets are plain Python ints, so membership is a
+shift and mask, and intersecting or uniting any number of users is one `&` or
+`|` per user over a few dozen machine words.
+
+`recommendations.sync_user` stores each user's bitset in
+`AppliedFavorites.bits`, in the same transaction that updates the
+co-occurrence counts, and refreshes the cache on commit. `get_many` reads the
+cache first and fetches every miss with one query. Annotating a pitcher list
+or comparing users therefore costs a constant number of queries.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import AppliedFavorites
+
+
+def get_cache():
+    return caches[settings.RECOMMENDATIONS_CACHE_ALIAS]
+
+
+def bits_key(user_id):
+    return f"favorites:bits:{user_id}"
+
+
+def encode(pitcher_ids):
+    """Little-endian bitset bytes with the bit of each of `pitcher_ids` set"""
+    pitcher_ids = list(pitcher_ids)
+    if not pitcher_ids:
+        return b''
+    buffer = bytearray(max(pitcher_ids) // 8 + 1)
+    for pitcher_id in pitcher_ids:
+        buffer[pitcher_id >> 3] |= 1 << (pitcher_id & 7)
+    return bytes(buffer)
+
+
+def decode(data):
+    return int.from_bytes(data, 'little')
+
+
+def fingerprint(bits):
+    """Short digest of a bitset, for validators of responses that depend on it"""
+    return hashlib.md5(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')).hexdigest()[:16]
+
+
+def members(bits):
+    """Pitcher ids set in `bits`, ascending"""
+    pitcher_ids = []
+    while bits:
+        lowest = bits & -bits
+        pitcher_ids.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return pitcher_ids
+
+
+def get_many(user_ids):
+    """{user id: favorites bitset} for `user_ids`, with one query for all cache misses"""
+    cache = get_cache()
+    keys = {bits_key(user_id): user_id for user_id in user_ids}
+    found = {keys[key]: data for key, data in cache.get_many(list(keys)).items()}
+    missing = [user_id for user_id in user_ids if user_id not in found]
+    if missing:
+        loaded = dict.fromkeys(missing, b'')
+        loaded.update(AppliedFavorites.objects.filter(user_id__in=missing).values_list('user_id', 'bits'))
+        loaded = {user_id: bytes(data) for user_id, data in loaded.items()}
+        cache.set_many({bits_key(user_id): data for user_id, data in loaded.items()}, settings.FAVORITE_BITS_CACHE_TIMEOUT)
+        found.update(loaded)
+    return {user_id: decode(data) for user_id, data in found.items()}
+
+
+def get(user_id):
+    return get_many([user_id])[user_id]
+
+
+def cache_bits(bits_by_user):
+    """Cache freshly stored `{user id: bitset bytes}` (empty bytes for users with no favorites)"""
+    get_cache().set_many(
+        {bits_key(user_id): data for user_id, data in bits_by_user.items()}, settings.FAVORITE_BITS_CACHE_TIMEOUT
+    )
@@ -0,0 +1,279 @@
+"""
+Read-only SQLite bundles of the pitcher table.
+
+The pitcher dataset only changes on loads, yet it lives in the primary
+database with users and favorites, so every pitcher read is a network round
+trip. With `PITCHER_BUNDLE_DIR` set, each dataset version is also written to
+a local SQLite file (`pitchers-v<version>.sqlite3`, same table and indexes as
+the primary) and `PitcherBundleRouter` sends `Pitcher` reads to it through the
+`pitchers_bundle` database alias. That alias opens the file with
+`immutable=1` (no locking or change detection) and `mmap_size`, so a query is
+a read from the OS page cache.
+
+A process starts serving a bundle once it has seen the matching version:
+`load_pitchers --bundle` writes one, and otherwise the first process to need
+a version builds it (under a file lock, so workers sharing a disk build it
+once). `current.sqlite3` is a symlink to the newest bundle, swapped
+atomically; connections reopen on the new file on their next query, so no
+restart is needed. Older bundles are deleted beyond `PITCHER_BUNDLE_KEEP`
+(connections still reading one keep it alive until they close).
+
+Reads stay on the primary while this process knows of a newer version than
+its bundle, inside transactions (read-your-writes) and during a dataset change.
+A process learns of versions it didn't publish itself (eg a reload in
+`run_jobs`) from `check_primary`, which compares its bundle against the
+primary's `DatasetVersion` at the start of every request and job.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router
+
+from .models import Pitcher
+
+logger = logging.getLogger(__name__)
+
+ALIAS = 'pitchers_bundle'
+CURRENT = 'current.sqlite3'
+
+_lock = threading.Lock()
+_latest_seen = None
+_serving = None
+_default_name = None
+
+
+def enabled():
+    return bool(settings.PITCHER_BUNDLE_DIR) and ALIAS in settings.DATABASES
+
+
+def bundle_dir():
+    return Path(settings.PITCHER_BUNDLE_DIR)
+
+
+def bundle_path(version):
+    return bundle_dir() / f"pitchers-v{version}.sqlite3"
+
+
+def bundle_uri(path):
+    return f"file:{path}?mode=ro&immutable=1"
+
+
+def bundle_version(path):
+    """Dataset version recorded in the bundle at `path`"""
+    connection = sqlite3.connect(bundle_uri(path), uri=True)
+    try:
+        return int(connection.execute("SELECT value FROM bundle_meta WHERE key = 'version'").fetchone()[0])
+    finally:
+        connection.close()
+
+
+def write_bundle(version, using=DEFAULT_DB_ALIAS):
+    """Write the pitcher table as of `version` from `using` to a new bundle; returns its path"""
+    started = time.perf_counter()
+    directory = bundle_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = bundle_path(version)
+    building = directory / f".{path.name}.{os.getpid()}.tmp"
+    building.unlink(missing_ok=True)
+
+    from django.db.backends.sqlite3.base import DatabaseWrapper
+
+    # A throwaway Django connection, so the table and its indexes match the primary exactly.
+    wrapper = DatabaseWrapper({**connections.settings[ALIAS], 'NAME': str(building), 'OPTIONS': {}}, alias=f"{ALIAS}_build")
+    try:
+        with wrapper.schema_editor(atomic=False) as editor:
+            editor.create_model(Pitcher)
+            editor.execute("CREATE TABLE bundle_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        fields = Pitcher._meta.concrete_fields
+        columns = ', '.join(wrapper.ops.quote_name(field.column) for field in fields)
+        insert = (
+            f"INSERT INTO {wrapper.ops.quote_name(Pitcher._meta.db_table)} ({columns}) "
+            f"VALUES ({', '.join(['%s'] * len(fields))})"
+        )
+        rows = Pitcher.objects.using(using).order_by('pk').values_list(*(field.attname for field in fields))
+        count = 0
+        with wrapper.cursor() as cursor:
+            batch = []
+            for row in rows.iterator(chunk_size=2000):
+                batch.append(row)
+                if len(batch) == 2000:
+                    cursor.executemany(insert, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(insert, batch)
+                count += len(batch)
+            cursor.executemany(
+                "INSERT INTO bundle_meta (key, value) VALUES (%s, %s)",
+                [('version', str(version)), ('rows', str(count)), ('created_at', str(time.time()))]
+            )
+            # Planner statistics for the indexes.
+            cursor.execute("ANALYZE")
+        wrapper.close()
+        os.replace(building, path)
+    finally:
+        wrapper.close()
+        building.unlink(missing_ok=True)
+    logger.info(f"Wrote pitcher bundle v{version} ({count} rows) in {time.perf_counter() - started:.3f}s")
+    return path
+
+
+def point_current(path):
+    """Atomically repoint `current.sqlite3` at `path`"""
+    link = bundle_dir() / CURRENT
+    swapping = bundle_dir() / f".{CURRENT}.{os.getpid()}.tmp"
+    swapping.unlink(missing_ok=True)
+    os.symlink(path.name, swapping)
+    os.replace(swapping, link)
+
+
+def prune():
+    """Delete all but the newest `PITCHER_BUNDLE_KEEP` bundles (and never the current one)"""
+    current = (bundle_dir() / CURRENT).resolve()
+    bundles = sorted(
+        bundle_dir().glob('pitchers-v*.sqlite3'), key=lambda path: int(path.stem.removeprefix('pitchers-v'))
+    )
+    for path in bundles[:-settings.PITCHER_BUNDLE_KEEP]:
+        if path.resolve() != current:
+            path.unlink(missing_ok=True)
+
+
+def observe(version):
+    """Note that the dataset reached `version`; reads use the primary until a bundle for it is served"""
+    global _latest_seen
+    if not enabled():
+        return
+    with _lock:
+        if _latest_seen is None or version > _latest_seen:
+            _latest_seen = version
+
+
+def check_primary(**kwargs):
+    """
+    request_started: observe the primary's dataset version, switching straight to
+    its bundle if another process already wrote it. One primary key lookup, and
+    only while this process serves a bundle.
+    """
+    if _serving is None:
+        return
+    from .models import DatasetVersion
+
+    version = DatasetVersion.objects.using(DEFAULT_DB_ALIAS).filter(pk=1).values_list('version', flat=True).first()
+    if version is None or version <= _serving:
+        return
+    observe(version)
+    path = bundle_path(version)
+    if path.exists():
+        serve(path, version)
+
+
+def serve(path, version):
+    """Point the alias at the bundle for `version`; each thread's connection reopens on its next read"""
+    global _serving, _default_name
+    settings_dict = connections.settings[ALIAS]
+    with _lock:
+        if _default_name is None:
+            _default_name = settings_dict['NAME']
+        settings_dict['NAME'] = bundle_uri(path)
+        _serving = version
+
+
+def sync(version):
+    """
+    Make this process read pitchers from the bundle for `version`, building it
+    if no process has yet. Returns the bundle's path, or None when bundles are off.
+    """
+    if not enabled():
+        return None
+    observe(version)
+    path = bundle_path(version)
+    if not path.exists():
+        import fcntl
+
+        bundle_dir().mkdir(parents=True, exist_ok=True)
+        with open(bundle_dir() / '.build.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not path.exists():
+                write_bundle(version)
+                point_current(path)
+                prune()
+    serve(path, version)
+    return path
+
+
+def publish(version, using=DEFAULT_DB_ALIAS):
+    """Write and switch to the bundle for `version` (eg right after a load)"""
+    path = write_bundle(version, using=using)
+    point_current(path)
+    prune()
+    if enabled():
+        observe(version)
+        serve(path, version)
+    return path
+
+
+def reset():
+    """Stop serving bundles in this process and restore the alias settings"""
+    global _latest_seen, _serving, _default_name
+    with _lock:
+        if _default_name is not None:
+            connection = connections[ALIAS]
+            connection.close()
+            connection.__dict__.pop('bundle_version', None)
+            connections.settings[ALIAS]['NAME'] = _default_name
+        _latest_seen = _serving = _default_name = None
+
+
+def read_alias():
+    """The alias to read pitchers from: the bundle when it's current for this process, else None"""
+    from .changes import active_version
+
+    version = _serving
+    if version is None or version != _latest_seen or active_version() is not None:
+        return None
+    if connections[router.db_for_write(Pitcher)].in_atomic_block:
+        return None
+    connection = connections[ALIAS]
+    if getattr(connection, 'bundle_version', None) != version:
+        # This thread's connection (if any) is on an older bundle file.
+        connection.close()
+        connection.bundle_version = version
+    return ALIAS
+
+
+class PitcherBundleRouter:
+    """Sends `Pitcher` reads to the bundle alias while it's current; all writes go to the primary"""
+
+    def db_for_read(self, model, **hints):
+        if model is Pitcher:
+            return read_alias()
+        return self.primary_for(hints)
+
+    def db_for_write(self, model, **hints):
+        # Django would otherwise write an instance back to the database it was read from.
+        if model is Pitcher:
+            return DEFAULT_DB_ALIAS
+        return self.primary_for(hints)
+
+    def primary_for(self, hints):
+        """Related lookups from a bundle row (eg `pitcher.favorited_by`) must go to the primary"""
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == ALIAS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Bundle rows are copies of primary rows, so favorites etc can point at them.
+        if {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, ALIAS}:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == ALIAS:
+            return False
+        return None
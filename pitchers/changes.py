@@ -0,0 +1,108 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import bundles, events
+from .models import Pitcher, PitcherTombstone, DatasetVersion
+
+logger = logging.getLogger(__name__)
+
+_active = threading.local()
+
+
+@contextmanager
+def dataset_change():
+    """
+    Group pitcher writes under a single new dataset version.
+
+    The next version is reserved up front (see `DatasetVersion.reserve`) and
+    only published once the block finishes. Rows saved inside the block are
+    stamped with it by the `pre_save` receiver below; bulk writers (which
+    bypass signals) stamp `row_version` with the yielded version themselves.
+    Versions are published in order: one that finishes while an older
+    reservation is still being written waits for it, and is published along
+    with it. Since rows become visible before the version that announces them,
+    a client syncing midway just receives some rows twice, and never misses
+    one. No transaction is held open, so long loads can keep reporting job
+    progress.
+    """
+    if getattr(_active, 'version', None) is not None:
+        # Nested: join the outer change.
+        yield _active.version
+        return
+    _active.version = DatasetVersion.reserve(settings.DATASET_CHANGE_TIMEOUT)
+    try:
+        yield _active.version
+    finally:
+        version, _active.version = _active.version, None
+        publish_version(version)
+
+
+def publish_version(version):
+    dataset = DatasetVersion.publish(version)
+    if dataset.version < version:
+        logger.info(f"Dataset v{version} written, published once v{dataset.version + 1} finishes")
+        return dataset
+    # Pitcher reads in this process go back to the primary until a bundle for this version is served.
+    bundles.observe(dataset.version)
+    events.publish('dataset', {'version': dataset.version})
+    return dataset
+
+
+def active_version():
+    return getattr(_active, 'version', None)
+
+
+def stamp_pitcher(sender, instance, raw=False, **kwargs):
+    """pre_save: stamp the row with the active change's version, or reserve one for a one-off save"""
+    if raw:
+        return
+    version = active_version()
+    instance.row_version = version if version is not None else DatasetVersion.reserve(settings.DATASET_SAVE_TIMEOUT)
+
+
+def publish_pitcher(sender, instance, raw=False, **kwargs):
+    """post_save: publish the version of a one-off save (changes publish when they finish)"""
+    if raw or active_version() is not None:
+        return
+    publish_version(instance.row_version)
+
+
+def record_tombstone(sender, instance, **kwargs):
+    """post_delete: leave a tombstone so clients syncing from an older version drop the row"""
+    version = active_version()
+    if version is not None:
+        PitcherTombstone.objects.create(pitcher_id=instance.pk, version=version)
+        return
+    version = DatasetVersion.reserve(settings.DATASET_SAVE_TIMEOUT)
+    PitcherTombstone.objects.create(pitcher_id=instance.pk, version=version)
+    publish_version(version)
+
+
+def prune_tombstones(keep_versions):
+    """Drop tombstones older than `keep_versions` versions; older clients must resync from a snapshot"""
+    dataset = DatasetVersion.current()
+    floor = max(dataset.version - keep_versions, 0)
+    if floor <= dataset.history_floor:
+        return 0
+    deleted, _ = PitcherTombstone.objects.filter(version__lte=floor).delete()
+    DatasetVersion.objects.filter(pk=dataset.pk).update(history_floor=floor)
+    logger.info(f"Pruned {deleted} tombstones, delta sync now available from v{floor}")
+    return deleted
+
+
+def changes_since(since, max_rows):
+    """
+    Return (version, upserts queryset, deleted ids), or (version, None, None) when
+    the client must reload a full snapshot instead.
+    """
+    dataset = DatasetVersion.current()
+    if since > dataset.version or since < dataset.history_floor:
+        return dataset.version, None, None
+    upserts = Pitcher.objects.filter(row_version__gt=since).order_by('id')
+    if upserts.count() > max_rows:
+        return dataset.version, None, None
+    deleted = list(PitcherTombstone.objects.filter(version__gt=since).values_list('pitcher_id', flat=True).distinct())
+    return dataset.version, upserts, deleted
@@ -0,0 +1,60 @@
+import logging
+from threading import Event, Lock
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical work within a process.
+
+    The first caller for a key runs `fn`; callers arriving while it is still
+    running block and receive the same result (or exception), so a refresh
+    storm costs one query and one serialization per key instead of one per
+    request. Nothing is cached once the call completes.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters:
+                logger.info(f"Coalesced {call.waiters} concurrent request(s) for {key}")
+            call.event.set()
+
+
+single_flight = SingleFlight()
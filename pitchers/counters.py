@@ -0,0 +1,251 @@
+"""
+Denormalized favorite counts and time-decayed trending scores.
+
+Favorites writes reach this module through `recommendations.sync_user`, which
+already diffs each user's favorites on commit, so re-saving an unchanged list
+counts nothing. Changes are buffered in memory per process and flushed in
+batches: every `COUNTERS_FLUSH_INTERVAL` seconds by a background thread, or
+sooner once `COUNTERS_MAX_PENDING` changes are waiting. A flush issues one
+UPDATE per distinct delta value (`count = count + delta WHERE pitcher_id IN
+...`), so a hot pitcher's counter row is written at most once per flush per
+process, however many users favorite it in between.
+
+Trending is the number of new favorites per hourly bucket, decayed with a
+half-life of `TRENDING_HALF_LIFE` seconds. Buckets older than `TRENDING_WINDOW`
+are pruned by flushes, once per bucket per process. Both top-N lists are
+computed at most once every `TRENDING_REFRESH_SECONDS` and served pre-sorted
+from the cache.
+
+Pending changes are also flushed when the process exits (`atexit`, and
+gunicorn's `worker_exit` hook), so restarts and deploys don't drop them. Only a
+process killed outright loses them; `reconcile` (the `reconcile_popularity`
+job) recounts the totals from the favorites table, but trending activity can't
+be recovered.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .coalesce import single_flight
+from .models import FavoritePitcher, Pitcher, PitcherActivity, PitcherPopularity
+
+logger = logging.getLogger(__name__)
+
+TOP_KEY = 'counters:top'
+
+
+def get_cache():
+    return caches[settings.RECOMMENDATIONS_CACHE_ALIAS]
+
+
+def bucket_start(timestamp):
+    size = settings.TRENDING_BUCKET_SECONDS
+    return datetime.fromtimestamp(timestamp // size * size, tz=dt_timezone.utc)
+
+
+def grouped_by_delta(deltas):
+    grouped = defaultdict(list)
+    for key, delta in deltas.items():
+        if delta:
+            grouped[delta].append(key)
+    return grouped
+
+
+class CounterBuffer:
+    """Per-process pending counter changes"""
+
+    def __init__(self):
+        self._favorites = defaultdict(int)
+        self._activity = defaultdict(int)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._pruned_before = None
+
+    def record(self, added=(), removed=()):
+        bucket = bucket_start(time.time())
+        with self._lock:
+            for pitcher_id in added:
+                self._favorites[pitcher_id] += 1
+                self._activity[pitcher_id, bucket] += 1
+            for pitcher_id in removed:
+                self._favorites[pitcher_id] -= 1
+            self._pending += len(added) + len(removed)
+            full = self._pending >= settings.COUNTERS_MAX_PENDING
+        self.start()
+        if full:
+            self.flush()
+
+    def clear(self):
+        with self._lock:
+            self._favorites.clear()
+            self._activity.clear()
+            self._pending = 0
+            self._pruned_before = None
+
+    def start(self):
+        """Start the background flusher in this process, once (threads don't survive a fork)"""
+        if not settings.COUNTERS_FLUSH_INTERVAL:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.run, name='counter-flusher', daemon=True)
+            self._thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(settings.COUNTERS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing counters: {str(e)}", exc_info=True)
+            finally:
+                connection.close()
+
+    def flush(self):
+        """Write pending changes; returns the number of counter rows touched"""
+        with self._flush_lock:
+            with self._lock:
+                favorites, self._favorites = self._favorites, defaultdict(int)
+                activity, self._activity = self._activity, defaultdict(int)
+                self._pending = 0
+            if not favorites and not activity:
+                return 0
+            try:
+                touched = write_counters(favorites, activity)
+            except Exception as e:
+                # Dropped rather than retried, so a bad row can't wedge the buffer; `reconcile` repairs the counts.
+                logger.error(f"Dropped {len(favorites)} counter changes: {str(e)}", exc_info=True)
+                return 0
+            cutoff = activity_cutoff()
+            if cutoff != self._pruned_before:
+                prune_activity(cutoff)
+                self._pruned_before = cutoff
+            get_cache().delete(TOP_KEY)
+            logger.debug(f"Flushed counters for {len(favorites)} pitchers")
+            return touched
+
+
+@transaction.atomic
+def write_counters(favorites, activity):
+    # Pitchers deleted since the change was recorded have nothing left to count.
+    existing = set(Pitcher.objects.filter(pk__in=list(favorites)).values_list('pk', flat=True))
+    favorites = {pitcher_id: delta for pitcher_id, delta in favorites.items() if pitcher_id in existing}
+    activity = {key: count for key, count in activity.items() if key[0] in existing}
+
+    PitcherPopularity.objects.bulk_create(
+        [PitcherPopularity(pitcher_id=pitcher_id) for pitcher_id in favorites], ignore_conflicts=True
+    )
+    for delta, pitcher_ids in grouped_by_delta(favorites).items():
+        PitcherPopularity.objects.filter(pitcher_id__in=pitcher_ids).update(favorite_count=F('favorite_count') + delta)
+
+    PitcherActivity.objects.bulk_create(
+        [PitcherActivity(pitcher_id=pitcher_id, bucket=bucket) for pitcher_id, bucket in activity], ignore_conflicts=True
+    )
+    for count, keys in grouped_by_delta(activity).items():
+        by_bucket = defaultdict(list)
+        for pitcher_id, bucket in keys:
+            by_bucket[bucket].append(pitcher_id)
+        for bucket, pitcher_ids in by_bucket.items():
+            PitcherActivity.objects.filter(bucket=bucket, pitcher_id__in=pitcher_ids).update(count=F('count') + count)
+    return len(favorites) + len(activity)
+
+
+buffer = CounterBuffer()
+
+
+def record(added=(), removed=()):
+    buffer.record(added, removed)
+
+
+def flush_at_exit():
+    """Write what this process still has buffered (atexit, and gunicorn's `worker_exit`)"""
+    try:
+        buffer.flush()
+    except Exception as e:
+        logger.error(f"Error flushing counters at exit: {str(e)}", exc_info=True)
+
+
+# Registered at import, so gunicorn workers forked from a preloaded master inherit it.
+atexit.register(flush_at_exit)
+
+
+def activity_cutoff(now=None):
+    """Start of the oldest bucket still inside `TRENDING_WINDOW`"""
+    now = now or timezone.now()
+    return bucket_start(now.timestamp() - settings.TRENDING_WINDOW)
+
+
+def prune_activity(cutoff=None):
+    """Delete buckets that have decayed out of the trending window; returns how many"""
+    deleted, _ = PitcherActivity.objects.filter(bucket__lt=cutoff or activity_cutoff()).delete()
+    return deleted
+
+
+def trending_scores(now=None):
+    """Decayed sum of recent new favorites per pitcher"""
+    now = now or timezone.now()
+    cutoff = activity_cutoff(now)
+    scores = defaultdict(float)
+    for pitcher_id, bucket, count in PitcherActivity.objects.filter(bucket__gte=cutoff).values_list(
+        'pitcher_id', 'bucket', 'count'
+    ):
+        age = max(now.timestamp() - bucket.timestamp() - settings.TRENDING_BUCKET_SECONDS, 0)
+        scores[pitcher_id] += count * 0.5 ** (age / settings.TRENDING_HALF_LIFE)
+    return scores
+
+
+def compute_top():
+    scores = trending_scores()
+    trending = sorted(
+        ((pitcher_id, score) for pitcher_id, score in scores.items() if score > 0),
+        key=lambda item: (-item[1], item[0])
+    )[:settings.TRENDING_TOP_N]
+    favorites = list(PitcherPopularity.objects.filter(favorite_count__gt=0).order_by(
+        '-favorite_count', 'pitcher_id'
+    ).values_list('pitcher_id', 'favorite_count')[:settings.TRENDING_TOP_N])
+    counts = dict(favorites)
+    missing = [pitcher_id for pitcher_id, _ in trending if pitcher_id not in counts]
+    counts.update(PitcherPopularity.objects.filter(pitcher_id__in=missing).values_list('pitcher_id', 'favorite_count'))
+    return {
+        'trending': [(pitcher_id, score, counts.get(pitcher_id, 0)) for pitcher_id, score in trending],
+        'favorites': [(pitcher_id, scores.get(pitcher_id, 0.0), count) for pitcher_id, count in favorites],
+    }
+
+
+def top(by, limit):
+    """Pre-sorted (pitcher_id, trending_score, favorite_count) for `by` in ('trending', 'favorites')"""
+    cache = get_cache()
+    lists = cache.get(TOP_KEY)
+    if lists is None:
+        lists = single_flight.do(TOP_KEY, compute_top)
+        cache.set(TOP_KEY, lists, settings.TRENDING_REFRESH_SECONDS)
+    return lists[by][:limit]
+
+
+def reconcile():
+    """Recount favorite totals from the favorites table; returns the number of pitchers with favorites"""
+    buffer.flush()
+    counts = FavoritePitcher.objects.values('pitcher_id').annotate(total=Count('id')).values_list('pitcher_id', 'total')
+    with transaction.atomic():
+        PitcherPopularity.objects.all().delete()
+        rows = PitcherPopularity.objects.bulk_create(
+            [PitcherPopularity(pitcher_id=pitcher_id, favorite_count=total) for pitcher_id, total in counts],
+            batch_size=2000
+        )
+    get_cache().delete(TOP_KEY)
+    return len(rows)
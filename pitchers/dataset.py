@@ -0,0 +1,225 @@
+import gc
+import logging
+import os
+import re
+import sys
+import time
+from array import array
+from collections import namedtuple
+from threading import Lock
+
+from django.db import connections
+from django.utils.http import quote_etag
+from rest_framework.renderers import JSONRenderer
+
+from .models import Pitcher, DatasetVersion
+
+logger = logging.getLogger(__name__)
+
+# Field order matches `PitcherSerializer` (fields = '__all__'), so encoded rows are
+# byte-identical to what the serializer would produce.
+PITCHER_FIELDS = tuple(field.attname for field in Pitcher._meta.concrete_fields)
+
+# namedtuple instances use `__slots__ = ()`, so each row costs one tuple and no dict.
+PitcherRow = namedtuple('PitcherRow', PITCHER_FIELDS)
+
+_ROW_BOUNDARY = re.compile(rb'\},\{"id":')
+_FAVORITE_FLAGS = (b',"is_favorite":false', b',"is_favorite":true')
+
+_STRING_FIELDS = frozenset(
+    field.attname for field in Pitcher._meta.concrete_fields
+    if field.get_internal_type() in ('CharField', 'URLField')
+)
+
+
+def dataset_etag(version, suffix=''):
+    return quote_etag(f"pitchers-v{version}{suffix}")
+
+
+class PitcherSnapshot:
+    """
+    Immutable, compact copy of the pitcher table for one dataset version.
+
+    Rows are namedtuples with interned strings (the same image/logo URLs repeat
+    on every pitch type row), and the full list is pre-encoded once. Built in
+    the gunicorn master when `preload_app` is on, so forked workers share the
+    pages copy-on-write instead of each building their own ORM/serializer state.
+    """
+
+    __slots__ = ('version', 'rows', 'index', 'list_body', 'row_ends', 'build_seconds')
+
+    def __init__(self, version, rows, build_seconds):
+        self.version = version
+        self.rows = rows
+        self.index = {row.id: position for position, row in enumerate(rows)}
+        self.list_body = encode_rows(rows)
+        # Offset of each row's closing brace. `id` is the first field and quotes inside strings are
+        # escaped, so `},{"id":` only ever occurs between rows.
+        ends = [match.start() for match in _ROW_BOUNDARY.finditer(self.list_body)]
+        self.row_ends = array('L', ends + [len(self.list_body) - 2] if rows else [])
+        self.build_seconds = build_seconds
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, pk):
+        position = self.index.get(pk)
+        return None if position is None else self.rows[position]
+
+    def etag(self, suffix=''):
+        return dataset_etag(self.version, suffix)
+
+    def flagged_list_body(self, favorite_ids):
+        """`list_body` with an `is_favorite` field on every row, spliced in without re-encoding"""
+        body = memoryview(self.list_body)
+        parts = []
+        start = 0
+        for row, end in zip(self.rows, self.row_ends):
+            parts.append(body[start:end])
+            parts.append(_FAVORITE_FLAGS[row.id in favorite_ids])
+            start = end
+        parts.append(body[start:])
+        return b''.join(parts)
+
+
+def encode_rows(rows):
+    return JSONRenderer().render([row._asdict() for row in rows])
+
+
+def encode_row(row):
+    return JSONRenderer().render(row._asdict())
+
+
+def team_summaries(snapshot):
+    """Per-team staff overview: pitchers by hand, pitch types thrown and average velocity and spin"""
+    from .archetypes import velocity
+
+    teams = {}
+    for row in snapshot.rows:
+        team = teams.get(row.team_name)
+        if team is None:
+            team = teams[row.team_name] = {
+                'logo': row.team_logo, 'pitchers': {}, 'pitch_types': {}, 'velocities': [], 'spin_rates': [],
+            }
+        team['pitchers'].setdefault(row.player_name, row.throws)
+        team['pitch_types'].setdefault(row.pitch_type, set()).add(row.player_name)
+        mph = velocity(row.velocity_range)
+        if mph is not None:
+            team['velocities'].append(mph)
+        if row.avg_spin_rate:
+            team['spin_rates'].append(row.avg_spin_rate)
+
+    def mean(values):
+        return round(sum(values) / len(values), 1) if values else None
+
+    return [
+        {
+            'team_name': team_name,
+            'team_logo': team['logo'],
+            'pitchers': len(team['pitchers']),
+            'throws': {hand: list(team['pitchers'].values()).count(hand) for hand in ('L', 'R')},
+            'pitch_types': {pitch_type: len(names) for pitch_type, names in sorted(team['pitch_types'].items())},
+            'avg_velocity': mean(team['velocities']),
+            'avg_spin_rate': mean(team['spin_rates']),
+        }
+        for team_name, team in sorted(teams.items())
+    ]
+
+
+def build_snapshot(version=None):
+    started = time.perf_counter()
+    if version is None:
+        version = DatasetVersion.current().version
+    intern = sys.intern
+    string_positions = [i for i, name in enumerate(PITCHER_FIELDS) if name in _STRING_FIELDS]
+    rows = []
+    for values in Pitcher.objects.order_by('id').values_list(*PITCHER_FIELDS).iterator(chunk_size=2000):
+        values = list(values)
+        for i in string_positions:
+            values[i] = intern(values[i])
+        rows.append(PitcherRow._make(values))
+    return PitcherSnapshot(version, tuple(rows), time.perf_counter() - started)
+
+
+_snapshot = None
+_snapshot_lock = Lock()
+
+
+def get_snapshot(version):
+    """Return the snapshot for `version`, rebuilding it if the dataset moved on"""
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.version != version:
+            sync_bundle(version)
+            _snapshot = build_snapshot(version)
+            logger.info(f"Built pitcher snapshot v{version}: {len(_snapshot)} rows in {_snapshot.build_seconds:.3f}s")
+        return _snapshot
+
+
+def sync_bundle(version):
+    """Switch pitcher reads to the bundle for `version` when bundles are on (see `pitchers/bundles.py`)"""
+    from . import bundles
+
+    try:
+        bundles.sync(version)
+    except Exception as e:
+        # Reads fall back to the primary database.
+        logger.error(f"Couldn't switch to pitcher bundle v{version}: {str(e)}", exc_info=True)
+
+
+def clear_snapshot():
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = None
+
+
+def preload_snapshot():
+    """
+    Build the snapshot before gunicorn forks its workers.
+
+    Primes the in-process caches (compressed list bodies, leaderboards, etc)
+    from the artifacts stored by `warm_caches`, closes the DB connections
+    opened while loading (they must not be shared with forked workers) and
+    freezes the GC so collections in the workers don't touch, and therefore
+    copy, the preloaded pages.
+    """
+    from .warming import prime
+
+    snapshot = get_snapshot(DatasetVersion.current().version)
+    prime(snapshot)
+    connections.close_all()
+    gc.collect()
+    gc.freeze()
+    return snapshot
+
+
+def memory_usage():
+    """Return (rss, private) in bytes for the current process; private is None off Linux"""
+    rss = private = None
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+
+        def kb(name):
+            return int(fields[name].strip().split()[0]) * 1024
+
+        rss = kb('Rss')
+        private = kb('Private_Clean') + kb('Private_Dirty')
+    except (OSError, KeyError, ValueError):
+        # ru_maxrss is a peak rather than a current value, but it is the best portable fallback.
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            rss *= 1024
+    return rss, private
+
+
+def format_memory(pid=None):
+    rss, private = memory_usage()
+    text = f"pid={pid or os.getpid()} rss={rss / 2**20:.1f}MiB"
+    if private is not None:
+        text += f" private={private / 2**20:.1f}MiB"
+    return text
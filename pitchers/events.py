@@ -0,0 +1,226 @@
+"""
+Server-push of dataset and favorites changes over Server-Sent Events.
+
+Clients open one long-lived `GET /api/events/` stream instead of polling the
+list endpoints. Two kinds of events are pushed:
+
+- `dataset`: `{"version": n}` whenever a new dataset version is published
+  (loads, ingests, single row edits); clients follow up with
+  `/api/pitchers/changes/?since=<their version>`.
+- `favorites`: `{"action": ...}` when the user's favorites are written.
+
+Fan-out goes through a per-process `Broker` holding one small asyncio queue per
+open stream; an idle stream is a coroutine parked on that queue plus a
+keepalive timer, so thousands of them cost almost no CPU. How events reach the
+broker is up to the backend (`EVENTS_BACKEND`): `LocalBackend` delivers within
+the publishing process only, `DatabaseBackend` carries them between processes
+(web workers, `run_jobs`, management commands) through the `PushEvent` table,
+polled once per interval per process rather than once per client.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import DatasetVersion, PushEvent
+
+logger = logging.getLogger(__name__)
+
+
+def user_channel(user_id):
+    return f"favorites:{user_id}"
+
+
+class Subscription:
+    """Queue of (channel, data) pairs for one open stream"""
+
+    def __init__(self, channels, loop, max_size):
+        self.channels = channels
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_size)
+
+    def put(self, channel, data):
+        # Events only say "something changed", so when a slow client falls behind the
+        # newest event is dropped rather than growing the queue.
+        def put_nowait():
+            try:
+                self.queue.put_nowait((channel, data))
+            except asyncio.QueueFull:
+                pass
+        self.loop.call_soon_threadsafe(put_nowait)
+
+    async def get(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class Broker:
+    """Process-wide registry of open streams by channel"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = Subscription(channels, asyncio.get_running_loop(), settings.EVENTS_QUEUE_SIZE)
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        self.backend.listen(self)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscription for subscribers in self._subscribers.values() for subscription in subscribers})
+
+    def deliver(self, channel, data):
+        """Hand an event to this process' streams; safe to call from any thread"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(channel, data)
+
+    def publish(self, channel, data):
+        self.backend.publish(channel, data)
+
+
+class LocalBackend:
+    """Delivers events to streams in the publishing process only (development, tests, single-process setups)"""
+
+    def __init__(self):
+        self.broker = None
+
+    def listen(self, broker):
+        self.broker = broker
+
+    def publish(self, channel, data):
+        if self.broker is not None:
+            self.broker.deliver(channel, data)
+
+
+class DatabaseBackend:
+    """
+    Carries events between processes through the `PushEvent` table.
+
+    Publishing is an INSERT; each process with open streams runs one poller task
+    on its event loop that reads new rows every `EVENTS_POLL_INTERVAL` seconds
+    and prunes rows older than `EVENTS_RETENTION` seconds. The poller outlives
+    the request that started it, so it runs in a context of its own and handles
+    its database connection like a request would, around every poll.
+    """
+
+    def __init__(self):
+        self.broker = None
+        self._task = None
+
+    def listen(self, broker):
+        self.broker = broker
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.poll(), context=contextvars.Context())
+
+    def publish(self, channel, data):
+        PushEvent.objects.create(channel=channel, data=data)
+
+    def fetch(self, after_id):
+        return list(PushEvent.objects.filter(id__gt=after_id).order_by('id').values_list('id', 'channel', 'data')[:500])
+
+    def prune(self):
+        PushEvent.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=settings.EVENTS_RETENTION)).delete()
+
+    def query(self, method, *args):
+        # As around a request: drop a connection that broke or outlived CONN_MAX_AGE since the last poll.
+        close_old_connections()
+        try:
+            return method(*args)
+        finally:
+            close_old_connections()
+
+    async def poll(self):
+        last_id = await sync_to_async(self.query)(
+            lambda: PushEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        )
+        polls = 0
+        while self.broker.subscriber_count():
+            await asyncio.sleep(settings.EVENTS_POLL_INTERVAL)
+            try:
+                rows = await sync_to_async(self.query)(self.fetch, last_id)
+                for last_id, channel, data in rows:
+                    self.broker.deliver(channel, data)
+                polls += 1
+                if polls % 100 == 0:
+                    await sync_to_async(self.query)(self.prune)
+            except Exception as e:
+                logger.error(f"Error polling push events: {str(e)}", exc_info=True)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None or not isinstance(_broker.backend, import_string(settings.EVENTS_BACKEND)):
+            _broker = Broker(import_string(settings.EVENTS_BACKEND)())
+        return _broker
+
+
+def publish(channel, data):
+    """Publish once the current transaction commits, so clients never refetch ahead of the data"""
+    def send():
+        try:
+            get_broker().publish(channel, data)
+        except Exception as e:
+            # Push is best-effort, clients still see the change on their next fetch.
+            logger.error(f"Error publishing {channel} event: {str(e)}", exc_info=True)
+    transaction.on_commit(send)
+
+
+def format_event(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+async def event_stream(user):
+    """SSE frames for `user`: the current dataset version first, then changes as they happen"""
+    broker = get_broker()
+    subscription = broker.subscribe(['dataset', user_channel(user.pk)])
+    try:
+        version = await sync_to_async(lambda: DatasetVersion.current().version)()
+        yield f"retry: {settings.EVENTS_RETRY_MS}\n\n".encode()
+        yield format_event('dataset', {'version': version}, event_id=version)
+        while True:
+            try:
+                channel, data = await subscription.get(settings.EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Comment line, keeps proxies (and the Heroku router's 55s idle timeout) from
+                # closing the connection.
+                yield b': keepalive\n\n'
+                continue
+            if channel == 'dataset':
+                yield format_event('dataset', data, event_id=data.get('version'))
+            else:
+                yield format_event('favorites', data)
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,237 @@
+"""
+Favorites writes: versioned, diff-based and idempotent.
+
+Each user's favorites have a version (`FavoritesVersion`). `apply` starts its
+transaction by writing that one row. The write locks the row on MySQL and
+Postgres and takes the write lock on SQLite, so concurrent writers for the
+same user queue behind it. Writers for other users, and readers, are never
+blocked. It then diffs the wanted favorites against the stored ones. Only the
+differences are inserted or deleted, so an unchanged favorite keeps its row.
+Inserts ignore conflicts, so a writer that skips the lock (eg the admin) can't
+make them fail. The version is bumped only when something changed. A client
+can send the version it last saw as `If-Match: "favorites-v<version>"`, and
+`apply` raises `VersionConflict` if another device wrote in between.
+`recommendations.sync_user` takes the same lock before it reads the favorites.
+
+`idempotent` wraps write actions. A request sent with an `Idempotency-Key`
+header is recorded with its response in the same transaction as its writes,
+and a retry with the same key gets that response back instead of running
+again. A concurrent retry waits on the key's unique index until the first
+request commits. Keys are kept for `IDEMPOTENCY_KEY_TTL` seconds. Work that
+mustn't run inside that transaction (eg creating pitchers, a dataset change)
+goes in the view before it calls an `idempotent` helper, after checking
+`recorded_response` and `check`.
+"""
+import hashlib
+import json
+import logging
+import re
+from collections import namedtuple
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.http import quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import events, recommendations
+from .models import FavoritePitcher, FavoritesVersion, IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+FavoritesWrite = namedtuple('FavoritesWrite', ('version', 'added', 'removed'))
+
+_VERSION_TAG = re.compile(r'^(?:W/)?"favorites-v(\d+)"$')
+
+
+class VersionConflict(Exception):
+    def __init__(self, version):
+        super().__init__(f"Favorites changed since this version, now at v{version}")
+        self.version = version
+
+
+def etag(version):
+    return quote_etag(f"favorites-v{version}")
+
+
+def expected_version(request):
+    """Version in the request's `If-Match` header, None without one; raises ValueError for other tags"""
+    header = request.headers.get('If-Match', '').strip()
+    if not header or header == '*':
+        return None
+    match = _VERSION_TAG.match(header)
+    if match is None:
+        raise ValueError('If-Match must be a "favorites-v<version>" tag')
+    return int(match.group(1))
+
+
+def current_version(user_id):
+    return FavoritesVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first() or 0
+
+
+def check(user_id, expected):
+    """
+    Raise `VersionConflict` if `user_id`'s favorites aren't at `expected`, before a
+    view does any other work; `lock` checks again once the write holds the lock.
+    """
+    if expected is not None:
+        version = current_version(user_id)
+        if version != expected:
+            raise VersionConflict(version)
+
+
+def lock(user_id, expected=None):
+    """
+    Lock `user_id`'s favorites until the transaction ends; returns their version.
+    Raises `VersionConflict` if it isn't `expected`.
+    """
+    version = FavoritesVersion.lock(user_id)
+    if expected is not None and expected != version:
+        raise VersionConflict(version)
+    return version
+
+
+def bump(user_id, version):
+    """Count a change to `user_id`'s favorites at `version`, as returned by `lock`; returns the new version"""
+    FavoritesVersion.objects.filter(user_id=user_id).update(version=F('version') + 1)
+    return version + 1
+
+
+def apply(user_id, add=(), remove=(), replace=None, expected=None, action='save'):
+    """
+    Change `user_id`'s favorites to the pitcher ids in `replace`, or add and
+    remove the ones given. Only rows that differ are written. Returns a
+    `FavoritesWrite` of the resulting version and the ids added and removed.
+    """
+    with transaction.atomic():
+        version = lock(user_id, expected)
+        current = set(FavoritePitcher.objects.filter(user_id=user_id).values_list('pitcher_id', flat=True))
+        if replace is not None:
+            added, removed = set(replace) - current, current - set(replace)
+        else:
+            added, removed = set(add) - current, set(remove) & current
+        if removed:
+            FavoritePitcher.objects.filter(user_id=user_id, pitcher_id__in=removed).delete()
+        if added:
+            FavoritePitcher.objects.bulk_create(
+                [FavoritePitcher(user_id=user_id, pitcher_id=pitcher_id) for pitcher_id in sorted(added)],
+                ignore_conflicts=True
+            )
+        if added or removed:
+            version = bump(user_id, version)
+            # bulk_create sends no post_save, so the recommendations/counters sync is scheduled here.
+            recommendations.schedule_sync(user_id)
+            events.publish(events.user_channel(user_id), {'action': action})
+    return FavoritesWrite(version, sorted(added), sorted(removed))
+
+
+def conflict_response(error):
+    response = Response(
+        {'detail': str(error), 'version': error.version}, status=status.HTTP_412_PRECONDITION_FAILED
+    )
+    response['ETag'] = etag(error.version)
+    return response
+
+
+def versioned(view):
+    """
+    Check a write action's `If-Match` version: the view gets it as
+    `request.expected_version`, and a `VersionConflict` it raises becomes a 412.
+    """
+    @wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        try:
+            request.expected_version = expected_version(request)
+        except ValueError as e:
+            return Response({'If-Match': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            return view(self, request, *args, **kwargs)
+        except VersionConflict as e:
+            return conflict_response(e)
+    return wrapper
+
+
+def request_fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method} {request.get_full_path()} {body}".encode()).hexdigest()
+
+
+def key_expiry():
+    return timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+
+
+def replay(record, fingerprint):
+    """The response recorded for `record`, a 422 if it's for a different request, or None while it's running"""
+    if record.fingerprint != fingerprint:
+        return Response(
+            {'detail': 'Idempotency-Key was already used for a different request'},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    if record.status_code is None:
+        return None
+    logger.info(f"Replaying response to idempotency key {record.key} for user {record.user_id}")
+    response = Response(record.body, status=record.status_code, headers=record.headers)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def invalid_key(key):
+    if len(key) > 255:
+        return Response({'detail': 'Idempotency-Key must be at most 255 characters'}, status=status.HTTP_400_BAD_REQUEST)
+    return None
+
+
+def recorded_response(request):
+    """
+    What `idempotent` would return for a retry of `request` without running the
+    write, or None: lets a view skip the work it does before its write.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return None
+    error = invalid_key(key)
+    if error is not None:
+        return error
+    record = IdempotencyKey.objects.filter(user=request.user, key=key, created_at__gte=key_expiry()).first()
+    return None if record is None else replay(record, request_fingerprint(request))
+
+
+def idempotent(view):
+    """Make a write action replay its first response to retries sent with the same `Idempotency-Key`"""
+    @wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(self, request, *args, **kwargs)
+        error = invalid_key(key)
+        if error is not None:
+            return error
+
+        fingerprint = request_fingerprint(request)
+        with transaction.atomic():
+            keys = IdempotencyKey.objects.filter(user=request.user)
+            keys.filter(created_at__lt=key_expiry()).delete()
+            # Waits for a concurrent request holding the same key, then finds its committed record.
+            IdempotencyKey.objects.bulk_create(
+                [IdempotencyKey(user=request.user, key=key, fingerprint=fingerprint)], ignore_conflicts=True
+            )
+            record = keys.get(key=key)
+            recorded = replay(record, fingerprint)
+            if recorded is not None:
+                return recorded
+
+            response = view(self, request, *args, **kwargs)
+            if response.status_code >= 500:
+                # Nothing is recorded, so the write and its key roll back and a retry runs again.
+                transaction.set_rollback(True)
+                return response
+            record.status_code = response.status_code
+            record.body = response.data
+            record.headers = {name: response[name] for name in ('ETag',) if response.has_header(name)}
+            record.save(update_fields=['status_code', 'body', 'headers'])
+        return response
+    return wrapper
@@ -0,0 +1,99 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.views import exception_handler
+
+logger = logging.getLogger(__name__)
+
+BUSY_DETAIL = 'Too many sign-ups and logins right now, please retry shortly.'
+BUSY_RETRY_AFTER = 1
+
+
+class HashingBusy(Exception):
+    """
+    Raised when a password hash can't start within `PASSWORD_HASH_QUEUE_TIMEOUT`.
+
+    Hashes also run outside DRF (the admin login form, `authenticate()`), so this
+    is a plain exception: `api_exception_handler` turns it into a 503 for API
+    views and `HashingBusyMiddleware` for everything else.
+    """
+
+
+class HashingUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = BUSY_DETAIL
+    default_code = 'hashing_busy'
+    # DRF's exception handler turns this into a Retry-After header.
+    wait = BUSY_RETRY_AFTER
+
+
+def api_exception_handler(exc, context):
+    if isinstance(exc, HashingBusy):
+        exc = HashingUnavailable()
+    return exception_handler(exc, context)
+
+
+def busy_response():
+    response = JsonResponse({'detail': BUSY_DETAIL}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(BUSY_RETRY_AFTER)
+    return response
+
+
+_slots = None
+_waiting = 0
+_slots_lock = threading.Lock()
+
+
+def hash_slots():
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(settings.PASSWORD_HASH_CONCURRENCY)
+        return _slots
+
+
+def acquire_slot():
+    """Take a hashing slot, waiting for one only while fewer than `PASSWORD_HASH_MAX_WAITING` requests are"""
+    global _waiting
+    slots = hash_slots()
+    if slots.acquire(blocking=False):
+        return True
+    with _slots_lock:
+        if _waiting >= settings.PASSWORD_HASH_MAX_WAITING:
+            return False
+        _waiting += 1
+    try:
+        return slots.acquire(timeout=settings.PASSWORD_HASH_QUEUE_TIMEOUT)
+    finally:
+        with _slots_lock:
+            _waiting -= 1
+
+
+class BoundedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2 (same algorithm and hashes as Django's default) with a per-process cap
+    on concurrent hashes.
+
+    A signup or login burst otherwise has every request thread running a
+    ~0.5s key derivation at once, starving the read API. Here at most
+    `PASSWORD_HASH_CONCURRENCY` hashes run at a time. Waiting for a slot still
+    blocks the request's thread, so only `PASSWORD_HASH_MAX_WAITING` requests
+    may wait, for up to `PASSWORD_HASH_QUEUE_TIMEOUT` seconds; any others are
+    turned away with a 503 at once.
+    """
+
+    def encode(self, password, salt, iterations=None):
+        # `verify` and `harden_runtime` derive through here too, so this covers logins.
+        if not acquire_slot():
+            logger.warning("Password hashing queue full, rejecting request")
+            raise HashingBusy()
+        slots = hash_slots()
+        try:
+            return super().encode(password, salt, iterations)
+        finally:
+            slots.release()
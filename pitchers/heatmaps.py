@@ -0,0 +1,307 @@
+"""
+Pitch location density grids and on-demand heatmap rendering.
+
+Grids are built while ingesting raw pitch data (see `ingest_pitches
+--heatmap-store`): for every (pitcher, pitch type, batter side) group, pitch
+locations are binned into a 2D histogram per ball-strike count. The store is a
+single `.npy` array opened with `mmap_mode='r'`, so workers only page in the
+grids they render, and share those pages through the OS page cache.
+
+Rendering sums the selected counts, smooths the histogram with a Gaussian
+kernel (a KDE over the binned locations) and encodes a PNG or SVG. Rendered
+variants are kept in a bounded LRU cache keyed by the store version, and the
+hottest ones can be rendered ahead of time by `manage.py warm_caches`.
+"""
+import json
+import os
+import struct
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+
+# Plate coordinates in feet, from the catcher's view. 24x24 cells of 2 inches.
+X_RANGE = (-2.0, 2.0)
+Z_RANGE = (0.5, 4.5)
+GRID_SIZE = 24
+# Ball-strike counts 0-0 .. 3-2, index = balls * 3 + strikes.
+COUNTS = [f"{balls}-{strikes}" for balls in range(4) for strikes in range(3)]
+COUNT_INDEX = {count: i for i, count in enumerate(COUNTS)}
+# Approximate rulebook zone drawn on top of the heatmap.
+STRIKE_ZONE = (-0.83, 0.83, 1.5, 3.5)
+
+GRID_SHAPE = (len(COUNTS), GRID_SIZE, GRID_SIZE)
+
+# Dark blue -> teal -> yellow -> red, interpolated into a 256 entry palette.
+_ANCHORS = np.array([
+    [0.00, 24, 29, 77],
+    [0.35, 33, 145, 140],
+    [0.70, 253, 231, 37],
+    [1.00, 203, 24, 29],
+])
+PALETTE = np.stack([
+    np.interp(np.linspace(0, 1, 256), _ANCHORS[:, 0], _ANCHORS[:, channel]) for channel in (1, 2, 3)
+], axis=1).astype(np.uint8)
+
+
+def group_key(player_name, pitch_type, stand):
+    return f"{player_name}|{pitch_type}|{stand}"
+
+
+def to_bins(values, value_range):
+    """Grid cell per value; locations outside the grid are clamped to the edge cells"""
+    low, high = value_range
+    return np.clip(np.floor((values - low) / (high - low) * GRID_SIZE).astype(int), 0, GRID_SIZE - 1)
+
+
+class HeatmapAggregator:
+    """Accumulates location histograms per group; mergeable like `PitchAggregator`"""
+
+    def __init__(self):
+        self.grids = {}
+
+    def add(self, keys, plate_x, plate_z, balls, strikes):
+        """Vectorized binning of one chunk; rows with a missing location or count are skipped"""
+        valid = ~(np.isnan(plate_x) | np.isnan(plate_z) | np.isnan(balls) | np.isnan(strikes))
+        valid &= (balls >= 0) & (balls <= 3) & (strikes >= 0) & (strikes <= 2)
+        if not valid.any():
+            return
+        keys = keys[valid]
+        x_bin = to_bins(plate_x[valid], X_RANGE)
+        z_bin = to_bins(plate_z[valid], Z_RANGE)
+        count = balls[valid].astype(int) * 3 + strikes[valid].astype(int)
+        cells = np.ravel_multi_index((count, z_bin, x_bin), GRID_SHAPE)
+
+        # Sort once by group, then histogram each group's contiguous slice of cells.
+        order = np.argsort(keys, kind='stable')
+        keys, cells = keys[order], cells[order]
+        unique, starts = np.unique(keys, return_index=True)
+        size = int(np.prod(GRID_SHAPE))
+        for key, group_cells in zip(unique, np.split(cells, starts[1:])):
+            counts = np.bincount(group_cells, minlength=size).astype(np.uint32).reshape(GRID_SHAPE)
+            key = str(key)
+            if key in self.grids:
+                self.grids[key] += counts
+            else:
+                self.grids[key] = counts
+
+    def merge(self, other):
+        for key, grid in other.grids.items():
+            if key in self.grids:
+                self.grids[key] += grid
+            else:
+                self.grids[key] = grid
+        return self
+
+    def write(self, store_dir):
+        """
+        Write a new version of the store and switch `index.json` to it atomically.
+
+        Readers keep using the previous grids file until they notice the new index.
+        """
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        previous = read_index(store_dir)
+        version = (previous['version'] + 1) if previous else 1
+        keys = sorted(self.grids)
+        grids_name = f"grids-v{version}.npy"
+        out = np.lib.format.open_memmap(
+            store_dir / grids_name, mode='w+', dtype=np.uint32, shape=(len(keys), *GRID_SHAPE)
+        )
+        for row, key in enumerate(keys):
+            out[row] = self.grids[key]
+        out.flush()
+        del out
+
+        index = {
+            'version': version,
+            'grids': grids_name,
+            'x_range': X_RANGE,
+            'z_range': Z_RANGE,
+            'counts': COUNTS,
+            'keys': {key: row for row, key in enumerate(keys)},
+        }
+        tmp = store_dir / 'index.json.tmp'
+        tmp.write_text(json.dumps(index))
+        os.replace(tmp, store_dir / 'index.json')
+        if previous and previous['grids'] != grids_name:
+            # Workers that still have the old file mapped keep their pages until they reopen.
+            (store_dir / previous['grids']).unlink(missing_ok=True)
+        return version
+
+
+def read_index(store_dir):
+    try:
+        return json.loads((Path(store_dir) / 'index.json').read_text())
+    except FileNotFoundError:
+        return None
+
+
+class GridStore:
+    """Read-only, memory-mapped view of one version of the grid store"""
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        index = read_index(self.store_dir)
+        if index is None:
+            raise FileNotFoundError(f"No heatmap grid store in {self.store_dir}")
+        self.version = index['version']
+        self.keys = index['keys']
+        self.grids = np.load(self.store_dir / index['grids'], mmap_mode='r')
+
+    def grid(self, key, counts=None):
+        """Histogram for `key`, summed over `counts` (all counts if None), or None if unknown"""
+        row = self.keys.get(key)
+        if row is None:
+            return None
+        grids = self.grids[row]
+        if counts:
+            grids = grids[[COUNT_INDEX[count] for count in counts]]
+        return grids.sum(axis=0, dtype=np.float64)
+
+
+_store = None
+_store_mtime = None
+_store_lock = Lock()
+
+
+def get_store():
+    """Process-wide store, reopened when `index.json` is replaced; None if there is no store yet"""
+    global _store, _store_mtime
+    index_path = Path(settings.HEATMAP_STORE_DIR) / 'index.json'
+    try:
+        mtime = index_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    with _store_lock:
+        if _store is None or mtime != _store_mtime:
+            _store = GridStore(settings.HEATMAP_STORE_DIR)
+            _store_mtime = mtime
+        return _store
+
+
+def gaussian_matrix(size, bandwidth):
+    """Dense smoothing operator, so a 2D separable blur is two small matrix products"""
+    if bandwidth <= 0:
+        return np.eye(size)
+    offsets = np.arange(size)[:, None] - np.arange(size)[None, :]
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    return kernel / kernel.sum(axis=1, keepdims=True)
+
+
+def smooth(grid, bandwidth):
+    kernel = gaussian_matrix(grid.shape[0], bandwidth)
+    density = kernel @ grid @ kernel.T
+    total = density.sum()
+    return density / total if total else density
+
+
+def to_colors(density):
+    """Map a density grid to RGB, top row = highest plate_z"""
+    peak = density.max()
+    levels = np.zeros(density.shape, dtype=np.uint8) if peak == 0 else (density / peak * 255).astype(np.uint8)
+    return PALETTE[levels[::-1]]
+
+
+def zone_pixels(scale):
+    left, right, bottom, top = STRIKE_ZONE
+
+    def to_x(x):
+        return int(round((x - X_RANGE[0]) / (X_RANGE[1] - X_RANGE[0]) * GRID_SIZE * scale))
+
+    def to_y(z):
+        return int(round((Z_RANGE[1] - z) / (Z_RANGE[1] - Z_RANGE[0]) * GRID_SIZE * scale))
+
+    return to_x(left), to_x(right), to_y(top), to_y(bottom)
+
+
+def encode_png(rgb):
+    """Minimal truecolor PNG encoder (no image library needed)"""
+    height, width, _ = rgb.shape
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width * 3)]).tobytes()
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+
+
+def render_rgb(density, scale=10):
+    """The heatmap as a (height, width, 3) RGB array, with the strike zone drawn on"""
+    image = np.repeat(np.repeat(to_colors(density), scale, axis=0), scale, axis=1)
+    left, right, top, bottom = zone_pixels(scale)
+    white = np.array([255, 255, 255], dtype=np.uint8)
+    image[top:bottom + 1, [left, right]] = white
+    image[[top, bottom], left:right + 1] = white
+    return image
+
+
+def render_png(density, scale=10):
+    return encode_png(render_rgb(density, scale))
+
+
+def render_svg(density, scale=10):
+    colors = to_colors(density)
+    size = GRID_SIZE * scale
+    cells = [
+        f'<rect x="{x * scale}" y="{y * scale}" width="{scale}" height="{scale}" fill="#{r:02x}{g:02x}{b:02x}"/>'
+        for y, row in enumerate(colors) for x, (r, g, b) in enumerate(row)
+    ]
+    left, right, top, bottom = zone_pixels(scale)
+    zone = (
+        f'<rect x="{left}" y="{top}" width="{right - left}" height="{bottom - top}" '
+        'fill="none" stroke="#fff" stroke-width="2"/>'
+    )
+    header = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+        f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+    )
+    return (header + ''.join(cells) + zone + '</svg>').encode()
+
+
+# Bodies rendered ahead of traffic (see `pitchers/warming.py`), by the same key as `_render_cached`.
+prerendered = {}
+
+
+class StoreChanged(Exception):
+    """The store was replaced between a request looking it up and rendering from it"""
+
+
+def render(store, keys, counts, image_format, bandwidth):
+    key = (store.version, tuple(keys), tuple(counts or ()), image_format, bandwidth)
+    body = prerendered.get(key)
+    if body is not None:
+        return body
+    try:
+        return _render_cached(*key)
+    except StoreChanged:
+        # Rendered from the request's own store, uncached.
+        return render_density(density(store, keys, counts, bandwidth), image_format)
+
+
+@lru_cache(maxsize=settings.HEATMAP_RENDER_CACHE_SIZE)
+def _render_cached(version, keys, counts, image_format, bandwidth):
+    # The store is looked up again, rather than passed in, so the cache never pins an old mmap.
+    # Raising keeps a body from another version out of the cache under this one's key.
+    store = get_store()
+    if store is None or store.version != version:
+        raise StoreChanged()
+    return render_density(density(store, keys, counts, bandwidth), image_format)
+
+
+def render_density(result, image_format):
+    if result is None:
+        return None
+    return render_svg(result) if image_format == 'svg' else render_png(result)
+
+
+def density(store, keys, counts, bandwidth):
+    """Smoothed density of the grids of `keys` summed over `counts`, or None if none has a grid"""
+    grids = [grid for grid in (store.grid(key, counts) for key in keys) if grid is not None]
+    if not grids:
+        return None
+    return smooth(np.sum(grids, axis=0), bandwidth)
@@ -0,0 +1,319 @@
+"""
+Aggregation of raw pitch-by-pitch tracking data into `Pitcher` rows.
+
+Input files are CSV or NDJSON with one pitch per row, using Statcast-style
+column names (see `COLUMNS`). They are read in fixed-size chunks, and each
+chunk is folded into per-group accumulators with vectorized NumPy group-bys,
+so memory is bounded by the chunk size plus one small histogram per
+(pitcher, pitch type, batter side) group. Accumulators from different files
+are merged, which lets files be processed in parallel.
+"""
+import csv
+import json
+import logging
+from itertools import islice
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from .changes import dataset_change, prune_tombstones
+from .heatmaps import HeatmapAggregator
+from .models import Pitcher
+
+logger = logging.getLogger(__name__)
+
+# Input column for each value we need. `pfx_x`/`pfx_z` are in feet (Statcast), breaks are
+# reported in inches; `zone` 1-9 is inside the strike zone.
+COLUMNS = {
+    'player_name': 'player_name',
+    'pitch_type': 'pitch_type',
+    'stand': 'stand',
+    'throws': 'p_throws',
+    'velocity': 'release_speed',
+    'spin': 'release_spin_rate',
+    'pfx_x': 'pfx_x',
+    'pfx_z': 'pfx_z',
+    'zone': 'zone',
+    'arm_angle': 'arm_angle',
+    # Only used for heatmap grids.
+    'plate_x': 'plate_x',
+    'plate_z': 'plate_z',
+    'balls': 'balls',
+    'strikes': 'strikes',
+}
+NUMERIC_COLUMNS = ('velocity', 'spin', 'pfx_x', 'pfx_z', 'zone', 'arm_angle')
+LOCATION_COLUMNS = ('plate_x', 'plate_z', 'balls', 'strikes')
+
+# Velocity histogram used for percentiles: 0.1 mph bins from 40 to 110 mph. Histograms
+# merge by addition, unlike exact percentiles, which would need every pitch in memory.
+VELOCITY_MIN = 40.0
+VELOCITY_BIN = 0.1
+VELOCITY_BINS = 700
+
+# Summed per group. Means are taken over non-missing values, so each sum has a count.
+SUM_FIELDS = ('spin', 'pfx_x', 'pfx_z', 'arm_angle')
+
+DEFAULT_METADATA = {
+    'player_image': 'https://example.com/default.jpg',
+    'team_name': 'Unknown Team',
+    'team_logo': 'https://example.com/default_logo.jpg',
+}
+
+
+def read_chunks(path, chunk_size):
+    """Yield dicts of column -> list of raw values, `chunk_size` rows at a time"""
+    wanted = {source: name for name, source in COLUMNS.items()}
+    with open(path, newline='') as f:
+        if path.endswith(('.ndjson', '.jsonl')):
+            rows = (json.loads(line) for line in f if line.strip())
+        elif path.endswith('.json'):
+            # A plain JSON array has to be parsed in one go; prefer NDJSON for large files.
+            rows = iter(json.load(f))
+        else:
+            rows = csv.DictReader(f)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield {name: [row.get(source) for row in chunk] for source, name in wanted.items()}
+
+
+def to_float(values):
+    """Convert raw values to float64, with blanks/None as NaN (and anything unparseable, slowly)"""
+    raw = np.asarray(values, dtype=object)
+    raw[(raw == '') | (raw == None)] = 'nan'  # noqa: E711 - elementwise comparison
+    try:
+        return raw.astype(np.float64)
+    except (TypeError, ValueError):
+        out = np.full(len(raw), np.nan)
+        for i, value in enumerate(raw):
+            try:
+                out[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return out
+
+
+class PitchAggregator:
+    """Mergeable per-group accumulators for pitch-level data"""
+
+    def __init__(self, heatmaps=False):
+        self.heatmaps = HeatmapAggregator() if heatmaps else None
+        self.keys = []
+        self.index = {}
+        self.throws = []
+        self.count = np.zeros(0, dtype=np.int64)
+        self.in_zone = np.zeros(0, dtype=np.int64)
+        self.zone_known = np.zeros(0, dtype=np.int64)
+        self.sums = {field: np.zeros(0) for field in SUM_FIELDS}
+        self.counts = {field: np.zeros(0, dtype=np.int64) for field in SUM_FIELDS}
+        self.velocity_hist = np.zeros((0, VELOCITY_BINS), dtype=np.int64)
+        self.rows_seen = 0
+
+    def _grow(self, size):
+        extra = size - len(self.count)
+        if extra <= 0:
+            return
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.in_zone = np.concatenate([self.in_zone, np.zeros(extra, dtype=np.int64)])
+        self.zone_known = np.concatenate([self.zone_known, np.zeros(extra, dtype=np.int64)])
+        for field in SUM_FIELDS:
+            self.sums[field] = np.concatenate([self.sums[field], np.zeros(extra)])
+            self.counts[field] = np.concatenate([self.counts[field], np.zeros(extra, dtype=np.int64)])
+        self.velocity_hist = np.vstack([self.velocity_hist, np.zeros((extra, VELOCITY_BINS), dtype=np.int64)])
+
+    def group_ids(self, keys, throws):
+        """Map each row's key to a global group id, registering new groups"""
+        unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        local_to_global = np.empty(len(unique), dtype=np.int64)
+        for i, key in enumerate(unique):
+            gid = self.index.get(key)
+            if gid is None:
+                key = str(key)
+                gid = self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.throws.append(throws[first[i]] or 'R')
+            local_to_global[i] = gid
+        self._grow(len(self.keys))
+        return local_to_global[inverse]
+
+    def add_chunk(self, chunk):
+        player = np.asarray([value or '' for value in chunk['player_name']], dtype=object)
+        pitch_type = np.asarray([value or '' for value in chunk['pitch_type']], dtype=object)
+        stand = np.asarray([value or '' for value in chunk['stand']], dtype=object)
+        valid = (player != '') & (pitch_type != '') & np.isin(stand, ['L', 'R'])
+        if not valid.any():
+            return
+        keys = player[valid] + '\x1f' + pitch_type[valid] + '\x1f' + stand[valid]
+        throws = [value for value, ok in zip(chunk['throws'], valid) if ok]
+        gids = self.group_ids(keys.astype(str), throws)
+        size = len(self.keys)
+        self.rows_seen += int(valid.sum())
+
+        self.count += np.bincount(gids, minlength=size)
+
+        numeric = {name: to_float(chunk[name])[valid] for name in NUMERIC_COLUMNS}
+        zone = numeric['zone']
+        known = ~np.isnan(zone)
+        self.zone_known += np.bincount(gids[known], minlength=size)
+        self.in_zone += np.bincount(gids[known & (zone >= 1) & (zone <= 9)], minlength=size)
+
+        for field in SUM_FIELDS:
+            values = numeric[field]
+            present = ~np.isnan(values)
+            self.sums[field] += np.bincount(gids[present], weights=values[present], minlength=size)
+            self.counts[field] += np.bincount(gids[present], minlength=size)
+
+        if self.heatmaps is not None:
+            location = {name: to_float(chunk[name])[valid] for name in LOCATION_COLUMNS}
+            heatmap_keys = (player[valid] + '|' + pitch_type[valid] + '|' + stand[valid]).astype(str)
+            self.heatmaps.add(heatmap_keys, location['plate_x'], location['plate_z'], location['balls'], location['strikes'])
+
+        velocity = numeric['velocity']
+        present = ~np.isnan(velocity)
+        # The small epsilon keeps values on a bin edge (95.0 -> 549.99999...) in the right bin.
+        bins = np.floor((velocity[present] - VELOCITY_MIN) / VELOCITY_BIN + 1e-6).astype(np.int64)
+        bins = np.clip(bins, 0, VELOCITY_BINS - 1)
+        flat = np.bincount(gids[present] * VELOCITY_BINS + bins, minlength=size * VELOCITY_BINS)
+        self.velocity_hist += flat.reshape(size, VELOCITY_BINS)
+
+    def merge(self, other):
+        mapping = np.empty(len(other.keys), dtype=np.int64)
+        for i, key in enumerate(other.keys):
+            gid = self.index.get(key)
+            if gid is None:
+                gid = self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.throws.append(other.throws[i])
+            mapping[i] = gid
+        self._grow(len(self.keys))
+        np.add.at(self.count, mapping, other.count)
+        np.add.at(self.in_zone, mapping, other.in_zone)
+        np.add.at(self.zone_known, mapping, other.zone_known)
+        for field in SUM_FIELDS:
+            np.add.at(self.sums[field], mapping, other.sums[field])
+            np.add.at(self.counts[field], mapping, other.counts[field])
+        np.add.at(self.velocity_hist, mapping, other.velocity_hist)
+        if other.heatmaps is not None:
+            self.heatmaps = (self.heatmaps or HeatmapAggregator()).merge(other.heatmaps)
+        self.rows_seen += other.rows_seen
+        return self
+
+    def velocity_percentiles(self, low, high):
+        """Per-group (low, high) velocity percentiles read off the cumulative histograms"""
+        cumulative = np.cumsum(self.velocity_hist, axis=1)
+        totals = cumulative[:, -1:]
+        empty = totals[:, 0] == 0
+
+        def percentile(p):
+            # First bin holding the ceil(p% * n)-th pitch (at least the first pitch). Its lower
+            # edge is the tracked value itself, since release speeds come with one decimal.
+            rank = np.maximum(np.ceil(totals * p / 100.0), 1)
+            bins = np.argmax(cumulative >= rank, axis=1)
+            return np.where(empty, np.nan, VELOCITY_MIN + bins * VELOCITY_BIN)
+
+        return percentile(low), percentile(high)
+
+    def summarise(self, velocity_percentiles=(10, 90)):
+        """Return one dict per group in the `pitchers-5-4-25.json` shape"""
+        names = [key.split('\x1f') for key in self.keys]
+        player_side = {}
+        for (player, _, stand), count in zip(names, self.count):
+            player_side[(player, stand)] = player_side.get((player, stand), 0) + int(count)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = {field: self.sums[field] / self.counts[field] for field in SUM_FIELDS}
+            zone_rate = self.in_zone / self.zone_known * 100.0
+        velocity_low, velocity_high = self.velocity_percentiles(*velocity_percentiles)
+
+        rows = []
+        for gid, (player, pitch_type, stand) in enumerate(names):
+            usage = 100.0 * self.count[gid] / player_side[(player, stand)]
+            rows.append({
+                'player_name': player,
+                'stand_side': stand,
+                'pitch_type': pitch_type,
+                'velocity_range': format_range(velocity_low[gid], velocity_high[gid]),
+                'usage_rate': f"{usage:.1f}%",
+                'zone_rate': format_percent(zone_rate[gid]),
+                'avg_spin_rate': round_or_zero(means['spin'][gid], 0),
+                # Statcast reports movement in feet.
+                'avg_horz_break': round_or_zero(means['pfx_x'][gid] * 12, 1),
+                'avg_induced_vert_break': round_or_zero(means['pfx_z'][gid] * 12, 1),
+                'arm_angle': round_or_zero(means['arm_angle'][gid], 1),
+                'throws': self.throws[gid],
+                'heatmap_path': heatmap_path(player, pitch_type, stand),
+                'pitches': int(self.count[gid]),
+            })
+        return rows
+
+
+def format_range(low, high):
+    if np.isnan(low):
+        return ''
+    return f"{low:.1f}-{high:.1f}"
+
+
+def format_percent(value):
+    return '0.0%' if np.isnan(value) else f"{value:.1f}%"
+
+
+def round_or_zero(value, digits):
+    return 0.0 if np.isnan(value) else round(float(value), digits)
+
+
+def heatmap_path(player_name, pitch_type, stand):
+    """'Wheeler, Zack' -> 'heatmaps/Wheeler_Zack_CU_R.png', matching the existing images"""
+    slug = '_'.join(part.strip().replace(' ', '_') for part in player_name.split(','))
+    return f"heatmaps/{slug}_{pitch_type}_{stand}.png"
+
+
+def aggregate_file(path, chunk_size, heatmaps=False):
+    """Aggregate one file; runs in a worker process when ingesting in parallel"""
+    aggregator = PitchAggregator(heatmaps=heatmaps)
+    for chunk in read_chunks(path, chunk_size):
+        aggregator.add_chunk(chunk)
+    logger.info(f"Aggregated {aggregator.rows_seen} pitches into {len(aggregator.keys)} groups from {path}")
+    return aggregator
+
+
+def write_pitchers(rows, metadata=None, batch_size=500):
+    """
+    Upsert aggregated rows keyed on (player_name, pitch_type, stand_side).
+
+    Existing rows are updated in place rather than deleted and recreated, so
+    favorites pointing at them survive a re-ingest. Returns (created, updated).
+    """
+    with dataset_change() as version, transaction.atomic():
+        written = _write_pitchers(rows, metadata or {}, version, batch_size)
+    prune_tombstones(settings.DELTA_SYNC_MAX_VERSIONS)
+    return written
+
+
+def _write_pitchers(rows, metadata, version, batch_size):
+    names = {row['player_name'] for row in rows}
+    existing = {
+        (pitcher.player_name, pitcher.pitch_type, pitcher.stand_side): pitcher
+        for pitcher in Pitcher.objects.filter(player_name__in=names)
+    }
+    fields = [
+        'player_image', 'team_name', 'team_logo', 'velocity_range', 'usage_rate', 'zone_rate',
+        'avg_spin_rate', 'avg_horz_break', 'avg_induced_vert_break', 'arm_angle', 'throws', 'heatmap_path',
+        'row_version',
+    ]
+    to_create, to_update = [], []
+    for row in rows:
+        values = {**DEFAULT_METADATA, **metadata.get(row['player_name'], {}), **row, 'row_version': version}
+        values.pop('pitches', None)
+        pitcher = existing.get((row['player_name'], row['pitch_type'], row['stand_side']))
+        if pitcher is None:
+            key_fields = ['player_name', 'pitch_type', 'stand_side']
+            to_create.append(Pitcher(**{key: values[key] for key in fields + key_fields}))
+        else:
+            for key in fields:
+                setattr(pitcher, key, values[key])
+            to_update.append(pitcher)
+    Pitcher.objects.bulk_create(to_create, batch_size=batch_size)
+    Pitcher.objects.bulk_update(to_update, fields, batch_size=batch_size)
+    return len(to_create), len(to_update)
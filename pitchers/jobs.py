@@ -0,0 +1,215 @@
+import csv
+import io
+import logging
+import os
+import socket
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import bundles
+from .models import Job, JobKind, Pitcher, DatasetVersion
+
+logger = logging.getLogger(__name__)
+
+# kind -> (handler, max concurrently running jobs of that kind across all workers)
+registry = {}
+
+
+def job(kind, concurrency=1):
+    """Register `fn(job)` as the handler for jobs of `kind`"""
+    def decorator(fn):
+        registry[kind] = (fn, concurrency)
+        return fn
+    return decorator
+
+
+def enqueue(kind, payload=None, user=None, max_attempts=3, run_after=None):
+    if kind not in registry:
+        raise ValueError(f"Unknown job kind: {kind}")
+    return Job.objects.create(
+        kind=kind,
+        payload=payload or {},
+        created_by=user,
+        max_attempts=max_attempts,
+        run_after=run_after or timezone.now(),
+    )
+
+
+class Worker:
+    """
+    Polls the `Job` table and runs handlers in a small thread pool.
+
+    Jobs are claimed with a conditional UPDATE (queued -> running), so several
+    worker processes can share the table without `SELECT ... FOR UPDATE`,
+    which SQLite doesn't support. The per-kind limit is checked and the job
+    claimed while holding the kind's `JobKind` row, so two workers can't both
+    take its last slot. Failed jobs are retried with exponential backoff until
+    `max_attempts`. While its jobs run, the worker refreshes their `locked_at`
+    every `heartbeat_interval` seconds (a tenth of `lock_timeout` by default);
+    jobs whose worker died are requeued once their lock is older than
+    `lock_timeout`.
+    """
+
+    def __init__(self, threads=2, poll_interval=2.0, lock_timeout=600, heartbeat_interval=None, retry_backoff=30,
+                 name=None):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self.heartbeat_interval = heartbeat_interval or lock_timeout / 10
+        self.retry_backoff = retry_backoff
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self._last_heartbeat = 0.0
+
+    def run(self, once=False):
+        logger.info(f"Job worker {self.name} started with {self.threads} thread(s)")
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            running = set()
+            while True:
+                running = {future for future in running if not future.done()}
+                if running and time.monotonic() - self._last_heartbeat >= self.heartbeat_interval:
+                    self.heartbeat()
+                self.requeue_stale()
+                while len(running) < self.threads:
+                    claimed = self.claim()
+                    if claimed is None:
+                        break
+                    running.add(pool.submit(self.execute, claimed))
+                if once and not running and not self.has_runnable():
+                    break
+                time.sleep(self.poll_interval if not once else 0.05)
+
+    def has_runnable(self):
+        return Job.objects.filter(status=Job.QUEUED, run_after__lte=timezone.now()).exists()
+
+    def claim(self):
+        now = timezone.now()
+        candidates = Job.objects.filter(
+            status=Job.QUEUED, run_after__lte=now, kind__in=list(registry)
+        ).order_by('run_after', 'id').values_list('id', 'kind')[:20]
+        for job_id, kind in candidates:
+            _, concurrency = registry[kind]
+            with transaction.atomic():
+                JobKind.lock(kind)
+                if Job.objects.filter(kind=kind, status=Job.RUNNING).count() >= concurrency:
+                    continue
+                claimed = Job.objects.filter(pk=job_id, status=Job.QUEUED).update(
+                    status=Job.RUNNING, locked_by=self.name, locked_at=now, attempts=F('attempts') + 1
+                )
+            if claimed:
+                return Job.objects.get(pk=job_id)
+        return None
+
+    def heartbeat(self):
+        """Refresh the locks of this worker's running jobs, so long ones aren't requeued as stale"""
+        self._last_heartbeat = time.monotonic()
+        Job.objects.filter(status=Job.RUNNING, locked_by=self.name).update(locked_at=timezone.now())
+
+    def execute(self, claimed):
+        handler, _ = registry[claimed.kind]
+        started = time.perf_counter()
+        try:
+            bundles.check_primary()
+            result = handler(claimed)
+        except Exception as e:
+            logger.error(f"Job {claimed} failed on attempt {claimed.attempts}: {str(e)}", exc_info=True)
+            self.fail(claimed, traceback.format_exc())
+        else:
+            Job.objects.filter(pk=claimed.pk).update(
+                status=Job.SUCCEEDED, result=result, progress=1.0, error='',
+                finished_at=timezone.now(), locked_by='', locked_at=None
+            )
+            logger.info(f"Job {claimed} succeeded in {time.perf_counter() - started:.2f}s")
+        finally:
+            # As Django does between requests, but never mid-transaction (eg a job run inside a test's).
+            if not transaction.get_connection().in_atomic_block:
+                close_old_connections()
+
+    def fail(self, claimed, error):
+        if claimed.attempts < claimed.max_attempts:
+            delay = self.retry_backoff * 2 ** (claimed.attempts - 1)
+            Job.objects.filter(pk=claimed.pk).update(
+                status=Job.QUEUED, error=error, locked_by='', locked_at=None,
+                run_after=timezone.now() + timedelta(seconds=delay)
+            )
+        else:
+            Job.objects.filter(pk=claimed.pk).update(
+                status=Job.FAILED, error=error, locked_by='', locked_at=None, finished_at=timezone.now()
+            )
+
+    def requeue_stale(self):
+        now = timezone.now()
+        stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=self.lock_timeout))
+        # Out of attempts: as in `fail`, rather than letting a job that kills its worker (eg OOM) loop forever.
+        failed = stale.filter(attempts__gte=F('max_attempts')).update(
+            status=Job.FAILED, error='Worker stopped while running the job (lock expired)', locked_by='',
+            locked_at=None, finished_at=now
+        )
+        requeued = stale.update(status=Job.QUEUED, locked_by='', locked_at=None)
+        if failed:
+            logger.error(f"Failed {failed} job(s) with expired locks and no attempts left")
+        if requeued:
+            logger.warning(f"Requeued {requeued} job(s) with expired locks")
+
+
+@job('reload_pitchers')
+def reload_pitchers(current):
+    """Run the `load_pitchers` import off the request path, then store the new version's cache artifacts"""
+    from .loading import read_pitchers_file, load_pitchers
+    from .warming import build
+
+    pitchers_data = read_pitchers_file(current.payload['json_file'])
+    dataset = load_pitchers(
+        pitchers_data,
+        progress=lambda done, total: current.report_progress(done / total, f"{done}/{total} rows")
+    )
+    artifacts = build(dataset.version)
+    return {'dataset_version': dataset.version, 'rows': len(pitchers_data), 'artifacts': sum(artifacts.values())}
+
+
+@job('export_pitchers', concurrency=2)
+def export_pitchers(current):
+    """Write the pitcher table as CSV to the default storage"""
+    from .dataset import PITCHER_FIELDS
+
+    version = DatasetVersion.current().version
+    queryset = Pitcher.objects.order_by('id').values_list(*PITCHER_FIELDS)
+    total = queryset.count() or 1
+    # Spooled to disk as rows stream in, so memory stays at one chunk however large the table.
+    with tempfile.TemporaryFile() as f:
+        text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(PITCHER_FIELDS)
+        for done, row in enumerate(queryset.iterator(chunk_size=2000), start=1):
+            writer.writerow(row)
+            if done % 1000 == 0:
+                current.report_progress(done / total, f"{done}/{total} rows")
+        # Flushes, and leaves `f` open for the storage to read back.
+        text.detach()
+        f.seek(0)
+        path = default_storage.save(f"exports/pitchers-v{version}.csv", File(f))
+    return {'path': path, 'url': default_storage.url(path), 'dataset_version': version}
+
+
+@job('rebuild_recommendations')
+def rebuild_recommendations(current):
+    """Recompute the favorites co-occurrence counts from scratch"""
+    from .recommendations import rebuild
+
+    return {'cells': rebuild()}
+
+
+@job('reconcile_popularity')
+def reconcile_popularity(current):
+    """Recount the denormalized favorite counts, repairing changes lost with a killed process"""
+    from .counters import reconcile
+
+    return {'pitchers': reconcile()}
@@ -0,0 +1,65 @@
+import json
+import logging
+
+from django.conf import settings
+
+from . import archetypes, bundles
+from .changes import dataset_change, prune_tombstones
+from .models import Pitcher, DatasetVersion
+
+logger = logging.getLogger(__name__)
+
+PITCHER_DATA_FIELDS = (
+    'player_image', 'team_name', 'team_logo', 'stand_side', 'pitch_type', 'velocity_range',
+    'usage_rate', 'zone_rate', 'avg_spin_rate', 'avg_horz_break', 'avg_induced_vert_break',
+    'arm_angle', 'throws', 'heatmap_path',
+)
+
+
+def read_pitchers_file(json_file):
+    with open(json_file, 'r') as f:
+        return json.load(f)
+
+
+def load_pitchers(pitchers_data, progress=None, bundle=False):
+    """
+    Upsert pitcher rows (in the `pitchers-5-4-25.json` shape), recluster pitch
+    archetypes (see `pitchers/archetypes.py`) and bump the dataset version.
+    Only rows that changed are saved, and rows missing from `pitchers_data`
+    are deleted, so the changes feed carries just the difference.
+
+    `progress`, if given, is called as `progress(done, total)` every 100 rows.
+    With `bundle`, also writes the new version's read-only SQLite bundle to
+    `PITCHER_BUNDLE_DIR` (see `pitchers/bundles.py`). Returns the new `DatasetVersion`.
+    """
+    total = len(pitchers_data)
+    with dataset_change():
+        # Rows are keyed like `ingest.write_pitchers` upserts them: one per pitch type and batter side.
+        existing = {
+            (pitcher.player_name, pitcher.pitch_type, pitcher.stand_side): pitcher
+            for pitcher in Pitcher.objects.all()
+        }
+        for done, pitcher_data in enumerate(pitchers_data, start=1):
+            values = {field: pitcher_data[field] for field in PITCHER_DATA_FIELDS}
+            pitcher = existing.get((pitcher_data['player_name'], pitcher_data['pitch_type'], pitcher_data['stand_side']))
+            if pitcher is None:
+                Pitcher.objects.create(player_name=pitcher_data['player_name'], **values)
+            elif any(getattr(pitcher, field) != value for field, value in values.items()):
+                # Updated in place, so favorites of the row survive the reload.
+                for field, value in values.items():
+                    setattr(pitcher, field, value)
+                pitcher.save()
+            if progress and (done % 100 == 0 or done == total):
+                progress(done, total)
+        # The file is the whole dataset: rows missing from it are deleted, leaving tombstones for delta sync.
+        loaded = {(row['player_name'], row['pitch_type'], row['stand_side']) for row in pitchers_data}
+        missing = [pitcher.pk for key, pitcher in existing.items() if key not in loaded]
+        if missing:
+            Pitcher.objects.filter(pk__in=missing).delete()
+        archetypes.assign()
+    prune_tombstones(settings.DELTA_SYNC_MAX_VERSIONS)
+    dataset = DatasetVersion.current()
+    logger.info(f"Loaded {total} pitcher rows, dataset is now v{dataset.version}")
+    if bundle:
+        bundles.publish(dataset.version)
+    return dataset
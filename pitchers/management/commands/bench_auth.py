@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+
+def send(request, timeout, retries=0):
+    """Returns (status, seconds, body); 503s are retried up to `retries` times after their Retry-After"""
+    started = time.perf_counter()
+    body = b''
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                body = response.read()
+                code = response.status
+        except urllib.error.HTTPError as e:
+            code = e.code
+            if code == 503 and attempt < retries:
+                time.sleep(float(e.headers.get('Retry-After') or 1))
+                continue
+        except (urllib.error.URLError, TimeoutError):
+            code = 'error'
+        break
+    return code, time.perf_counter() - started, body
+
+
+def post_json(url, payload, timeout, retries=0):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'}, method='POST'
+    )
+    code, latency, _ = send(request, timeout, retries)
+    return code, latency
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Measure signups and logins per second against a running server (eg one web dyno)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:5006', help='Base URL of the server under test')
+        parser.add_argument('--signups', type=int, default=100, help='Number of accounts to create')
+        parser.add_argument('--logins', type=int, default=300, help='Number of token requests to make')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent client threads')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Per request timeout in seconds')
+        parser.add_argument(
+            '--retries', type=int, default=5,
+            help='Times to retry a 503 (hashing queue full) after its Retry-After, as clients are asked to'
+        )
+        parser.add_argument(
+            '--probe', default='/api/user/info/',
+            help='Authenticated GET timed back to back during the logins, to see how the burst affects other '
+                 'requests (empty to skip)'
+        )
+        parser.add_argument(
+            '--cleanup', action='store_true',
+            help='Delete the benchmark accounts afterwards (needs this process to share the server\'s database)'
+        )
+
+    def handle(self, *args, **options):
+        base = options['url'].rstrip('/')
+        prefix = f"bench-{uuid.uuid4().hex[:8]}"
+        password = f"Bench-{uuid.uuid4().hex}"
+        accounts = [
+            {'username': f"{prefix}-{i}", 'email': f"{prefix}-{i}@example.com", 'password': password}
+            for i in range(options['signups'])
+        ]
+
+        created = self.run_phase('signups', f"{base}/api/users/", accounts, options)
+        logins = [
+            {'username': account['username'], 'password': password}
+            for account, code in zip(accounts, created) if code == 201
+        ]
+        if logins and options['logins']:
+            probe = self.start_probe(base, logins[0], options) if options['probe'] else None
+            self.run_phase(
+                'logins', f"{base}/api/token/", [logins[i % len(logins)] for i in range(options['logins'])], options
+            )
+            if probe is not None:
+                self.report_probe(*probe)
+
+        if options['cleanup']:
+            deleted, _ = User.objects.filter(username__startswith=f"{prefix}-").delete()
+            self.stdout.write(f"Deleted {deleted} benchmark rows")
+
+    def start_probe(self, base, login, options):
+        code, _, body = send(urllib.request.Request(
+            f"{base}/api/token/", data=json.dumps(login).encode(), headers={'Content-Type': 'application/json'},
+            method='POST'
+        ), options['timeout'], options['retries'])
+        if code != 200:
+            self.stdout.write(self.style.WARNING(f"  Skipping the probe, its login failed ({code})"))
+            return None
+        request = urllib.request.Request(
+            f"{base}{options['probe']}", headers={'Authorization': f"Bearer {json.loads(body)['access']}"}
+        )
+        results, stop = [], threading.Event()
+
+        def run():
+            while not stop.is_set():
+                code, latency, _ = send(request, options['timeout'])
+                results.append((code, latency))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread, stop, results
+
+    def report_probe(self, thread, stop, results):
+        stop.set()
+        thread.join()
+        codes = Counter(code for code, _ in results)
+        latencies = [latency for code, latency in results if isinstance(code, int) and code < 300]
+        self.stdout.write(
+            f"  GET probe during logins: p50 {percentile(latencies, 50) * 1000:.0f}ms, "
+            f"p95 {percentile(latencies, 95) * 1000:.0f}ms, max {max(latencies, default=0) * 1000:.0f}ms; "
+            f"status codes {dict(codes)}"
+        )
+
+    def run_phase(self, name, url, payloads, options):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            results = list(pool.map(
+                lambda payload: post_json(url, payload, options['timeout'], options['retries']), payloads
+            ))
+        elapsed = time.perf_counter() - started
+
+        codes = Counter(code for code, _ in results)
+        latencies = [latency for code, latency in results if isinstance(code, int) and code < 300]
+        self.stdout.write(self.style.SUCCESS(
+            f"{name}: {len(latencies)}/{len(payloads)} succeeded in {elapsed:.2f}s, "
+            f"{len(latencies) / elapsed:.1f}/s at concurrency {options['concurrency']}"
+        ))
+        self.stdout.write(
+            f"  latency p50 {percentile(latencies, 50) * 1000:.0f}ms, p95 {percentile(latencies, 95) * 1000:.0f}ms, "
+            f"p99 {percentile(latencies, 99) * 1000:.0f}ms; status codes {dict(codes)}"
+        )
+        if codes.get(429):
+            self.stdout.write(self.style.WARNING(
+                '  Throttled (429): raise THROTTLE_RATE_SIGNUP / THROTTLE_RATE_LOGIN / THROTTLE_RATE_IP on the '
+                'server to measure raw throughput'
+            ))
+        if codes.get(503):
+            self.stdout.write(self.style.WARNING(
+                '  Hashing queue full (503): PASSWORD_HASH_CONCURRENCY slots are saturated'
+            ))
+        return [code for code, _ in results]
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from pitchers.archetypes import assign
+
+class Command(BaseCommand):
+    help = 'Recompute pitch archetypes and assign every pitch to one'
+
+    def handle(self, *args, **options):
+        archetypes = assign()
+        self.stdout.write(self.style.SUCCESS(f'Clustered pitches into {archetypes} archetypes'))
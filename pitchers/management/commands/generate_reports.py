@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pitchers.reports import FORMATS, generate
+
+class Command(BaseCommand):
+    help = 'Write CSV/HTML/PDF scouting reports per team or pitcher, built in parallel from one dataset snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--by', choices=('team', 'pitcher'), default='team', help='One report per team or per pitcher')
+        parser.add_argument('--format', dest='formats', choices=FORMATS, action='append',
+                            help='Output format, repeatable (default: csv and html)')
+        parser.add_argument('--output', type=str, default=None, help='Output directory (default: REPORTS_DIR)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes building reports in parallel (default: one per CPU)')
+        parser.add_argument('--name', dest='names', action='append',
+                            help='Only this team (or pitcher with --by pitcher), repeatable')
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        def progress(done, total, name, seconds):
+            self.stdout.write(f"[{done}/{total}] {name} ({seconds:.2f}s)")
+
+        summary = generate(
+            options['output'] or settings.REPORTS_DIR,
+            by=options['by'],
+            formats=options['formats'] or ('csv', 'html'),
+            workers=options['workers'],
+            names=options['names'],
+            progress=progress,
+        )
+        if not summary['tasks']:
+            raise CommandError('No matching teams or pitchers')
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {summary['tasks']} {options['by']} reports with {summary['workers']} workers in "
+            f"{summary['seconds']:.2f}s ({summary['utilization']:.0%} pool utilization)"
+        ))
+        if summary['combined_csv']:
+            self.stdout.write(f"Combined CSV: {summary['combined_csv']}")
@@ -0,0 +1,81 @@
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pitchers.ingest import PitchAggregator, aggregate_file, write_pitchers
+
+class Command(BaseCommand):
+    help = 'Aggregate raw pitch-by-pitch CSV/NDJSON files into Pitcher rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', type=str, help='Pitch-level CSV, NDJSON (.ndjson/.jsonl) or JSON files')
+        parser.add_argument('--chunk-size', type=int, default=100_000, help='Rows held in memory per file at a time')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes used to aggregate files in parallel (default: one per CPU)')
+        parser.add_argument('--metadata', type=str,
+                            help='JSON object mapping player_name to player_image/team_name/team_logo')
+        parser.add_argument('--velocity-percentiles', type=float, nargs=2, default=(10, 90), metavar=('LOW', 'HIGH'),
+                            help='Percentiles reported as velocity_range')
+        parser.add_argument('--heatmap-store', type=str,
+                            help='Also bin pitch locations into density grids, written to this directory '
+                                 '(defaults to HEATMAP_STORE_DIR when given without a value)',
+                            nargs='?', const='')
+        parser.add_argument('--dry-run', action='store_true', help='Aggregate and report without writing rows')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        files = options['files']
+        metadata = {}
+        if options['metadata']:
+            with open(options['metadata']) as f:
+                metadata = json.load(f)
+
+        heatmaps = options['heatmap_store'] is not None
+        heatmap_store = options['heatmap_store'] or settings.HEATMAP_STORE_DIR
+
+        aggregator = PitchAggregator(heatmaps=heatmaps)
+        parallel = len(files) > 1 and options['workers'] != 1
+        if parallel and 'fork' not in multiprocessing.get_all_start_methods():
+            # As in `pitchers/reports.py`: spawned workers wouldn't have Django set up.
+            self.stderr.write("Process pools need the 'fork' start method here, aggregating files in-process")
+            parallel = False
+        if not parallel:
+            for path in files:
+                aggregator.merge(self.aggregate(path, options['chunk_size'], heatmaps))
+        else:
+            # Each file is aggregated independently; the accumulators are merged as they finish.
+            pool = ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('fork'))
+            with pool:
+                futures = {
+                    pool.submit(aggregate_file, path, options['chunk_size'], heatmaps): path for path in files
+                }
+                for future in as_completed(futures):
+                    try:
+                        aggregator.merge(future.result())
+                    except OSError as e:
+                        raise CommandError(f"Could not read {futures[future]}: {e}")
+                    self.stdout.write(f"Aggregated {futures[future]}")
+
+        rows = aggregator.summarise(velocity_percentiles=options['velocity_percentiles'])
+        self.stdout.write(f"{aggregator.rows_seen} pitches -> {len(rows)} pitcher/pitch type/side rows")
+        if options['dry_run']:
+            self.stdout.write(json.dumps(rows[:5], indent=2))
+            return
+
+        created, updated = write_pitchers(rows, metadata)
+        if heatmaps:
+            version = aggregator.heatmaps.write(heatmap_store)
+            self.stdout.write(f"Wrote {len(aggregator.heatmaps.grids)} heatmap grids to {heatmap_store} (v{version})")
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Ingested {len(files)} file(s): {created} created, {updated} updated in {elapsed:.1f}s'
+        ))
+
+    def aggregate(self, path, chunk_size, heatmaps):
+        try:
+            return aggregate_file(path, chunk_size, heatmaps)
+        except OSError as e:
+            raise CommandError(f"Could not read {path}: {e}")
@@ -0,0 +1,181 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter under `-X importtime`, so nothing is already imported. Phases are timed
+# with perf_counter and printed as JSON on stdout; the import log goes to stderr.
+BOOT_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+from django.apps import AppConfig
+
+phases = {}
+app_timings = {}
+create = AppConfig.create.__func__
+import_models = AppConfig.import_models
+
+
+def timed_create(cls, entry):
+    begin = time.perf_counter()
+    config = create(cls, entry)
+    app_timings[config.name] = {'import': time.perf_counter() - begin, 'models': 0.0, 'ready': 0.0}
+    ready = config.ready
+
+    def timed_ready():
+        begin = time.perf_counter()
+        ready()
+        app_timings[config.name]['ready'] = time.perf_counter() - begin
+
+    config.ready = timed_ready
+    return config
+
+
+def timed_import_models(self):
+    begin = time.perf_counter()
+    import_models(self)
+    app_timings[self.name]['models'] = time.perf_counter() - begin
+
+
+AppConfig.create = classmethod(timed_create)
+AppConfig.import_models = timed_import_models
+
+from django.conf import settings
+settings.INSTALLED_APPS
+phases['settings'] = time.perf_counter() - started
+
+begin = time.perf_counter()
+django.setup()
+phases['apps'] = time.perf_counter() - begin
+
+from django.utils.module_loading import import_string
+begin = time.perf_counter()
+import_string(settings.ASGI_APPLICATION)
+phases['application'] = time.perf_counter() - begin
+
+# What the first request would otherwise pay: importing the urlconf (views, serializers, DRF,
+# simplejwt) and building the reverse lookup tables.
+from django.urls import get_resolver
+begin = time.perf_counter()
+get_resolver().reverse_dict
+phases['urlconf'] = time.perf_counter() - begin
+
+phases['total'] = time.perf_counter() - started
+print(json.dumps({'phases': phases, 'apps': app_timings}))
+'''
+
+
+def parse_importtime(log):
+    """(module, self_us, cumulative_us) for each `-X importtime` line"""
+    rows = []
+    for line in log.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        rows.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+    return rows
+
+
+def owner(module, app_names):
+    """Installed app (longest matching package) or top-level package the module belongs to"""
+    for name in app_names:
+        if module == name or module.startswith(f"{name}."):
+            return name
+    return module.split('.')[0]
+
+
+def profile_once():
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'gettingstarted.settings')}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT],
+        capture_output=True, text=True, env=env, cwd=settings.BASE_DIR
+    )
+    if result.returncode != 0:
+        raise CommandError(f"Boot failed:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+
+    app_names = sorted((config.name for config in apps.get_app_configs()), key=len, reverse=True)
+    packages = defaultdict(int)
+    modules = parse_importtime(result.stderr)
+    for module, self_us, _ in modules:
+        packages[owner(module, app_names)] += self_us
+    timings['packages'] = {name: total / 1000 for name, total in packages.items()}
+    timings['modules'] = {module: cumulative / 1000 for module, _, cumulative in modules}
+    return timings
+
+
+def median_of(runs, key):
+    names = set().union(*(run[key] for run in runs))
+    return {name: statistics.median(run[key].get(name, 0.0) for run in runs) for name in names}
+
+
+class Command(BaseCommand):
+    help = (
+        'Profile process boot: per-phase and per-app wall time and import time by package, '
+        'measured in fresh interpreters, and checked against STARTUP_BUDGET_MS'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3, help='Boots to measure; medians are reported')
+        parser.add_argument('--top', type=int, default=15, help='Number of packages and modules to list')
+        parser.add_argument(
+            '--budget', type=float, default=None,
+            help='Fail if the median total boot takes longer than this many ms (default STARTUP_BUDGET_MS)'
+        )
+        parser.add_argument('--json', action='store_true', help='Print the medians as JSON')
+
+    def handle(self, *args, **options):
+        runs = [profile_once() for _ in range(max(options['runs'], 1))]
+        phases = {name: seconds * 1000 for name, seconds in median_of(runs, 'phases').items()}
+        app_phases = {
+            name: {
+                phase: statistics.median(run['apps'].get(name, {}).get(phase, 0.0) for run in runs) * 1000
+                for phase in ('import', 'models', 'ready')
+            }
+            for name in set().union(*(run['apps'] for run in runs))
+        }
+        packages = median_of(runs, 'packages')
+        modules = median_of(runs, 'modules')
+        budget = options['budget'] if options['budget'] is not None else settings.STARTUP_BUDGET_MS
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'budget_ms': budget, 'phases_ms': phases, 'apps_ms': app_phases,
+                'packages_self_ms': packages, 'runs': len(runs),
+            }, indent=2, sort_keys=True))
+        else:
+            self.report(phases, app_phases, packages, modules, options['top'], len(runs))
+
+        if budget and phases['total'] > budget:
+            raise CommandError(f"Boot took {phases['total']:.0f}ms, over the {budget:.0f}ms budget")
+        if budget and not options['json']:
+            self.stdout.write(self.style.SUCCESS(f"Within the {budget:.0f}ms budget"))
+
+    def report(self, phases, app_phases, packages, modules, top, runs):
+        self.stdout.write(f"Median of {runs} boot(s), in ms (import times include -X importtime overhead)")
+        for name in ('settings', 'apps', 'application', 'urlconf', 'total'):
+            self.stdout.write(f"  {name:<12} {phases.get(name, 0.0):8.1f}")
+
+        self.stdout.write('Apps (import / models / ready):')
+        by_cost = sorted(app_phases.items(), key=lambda item: -sum(item[1].values()))
+        for name, timing in by_cost[:top]:
+            self.stdout.write(
+                f"  {name:<40} {timing['import']:7.1f} {timing['models']:7.1f} {timing['ready']:7.1f}"
+            )
+
+        self.stdout.write('Import time by package (self):')
+        for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+            self.stdout.write(f"  {name:<40} {ms:8.1f}")
+
+        self.stdout.write('Slowest modules (cumulative):')
+        for name, ms in sorted(modules.items(), key=lambda item: -item[1])[:top]:
+            self.stdout.write(f"  {name:<40} {ms:8.1f}")
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from pitchers.recommendations import rebuild
+
+class Command(BaseCommand):
+    help = 'Recompute the favorites co-occurrence counts used for recommendations'
+
+    def handle(self, *args, **options):
+        cells = rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt recommendations ({cells} co-occurrence cells)'))
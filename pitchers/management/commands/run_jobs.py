@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from pitchers.jobs import Worker
+
+class Command(BaseCommand):
+    help = 'Run the background job worker (dataset reloads, exports, precomputations)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=2, help='Jobs run concurrently by this worker')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between polls when idle')
+        parser.add_argument('--lock-timeout', type=int, default=600,
+                            help='Seconds without a heartbeat after which a running job is assumed lost and requeued')
+        parser.add_argument('--once', action='store_true', help='Drain runnable jobs and exit')
+
+    def handle(self, *args, **options):
+        worker = Worker(
+            threads=options['threads'],
+            poll_interval=options['poll_interval'],
+            lock_timeout=options['lock_timeout'],
+        )
+        worker.run(once=options['once'])
+        if options['once']:
+            self.stdout.write(self.style.SUCCESS('Drained job queue'))
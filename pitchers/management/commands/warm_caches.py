@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from pitchers.warming import build
+
+class Command(BaseCommand):
+    help = 'Precompute the cached artifacts of the current dataset version for web workers to load at boot'
+
+    def handle(self, *args, **options):
+        built = build()
+        summary = ', '.join(f'{count} {kind}' for kind, count in built.items())
+        self.stdout.write(self.style.SUCCESS(f'Stored artifacts: {summary}'))
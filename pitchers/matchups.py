@@ -0,0 +1,216 @@
+"""
+How pitchers attack left- and right-handed batters.
+
+Rows are per (pitcher, pitch type, batter side), as written by `ingest_pitches`.
+`MatchupTable` turns one pitcher snapshot into NumPy columns (usage and zone
+rate parsed from their percent strings, velocity from the midpoint of
+`velocity_range`) sorted by pitcher. In the same pass it computes each row's
+delta from the league baseline. The baseline is the average over all rows
+with the same pitcher hand, batter side and pitch type. For usage, pitchers
+who don't throw that pitch to that side count as 0%.
+
+The table is built once per snapshot, so a request only slices it:
+`split_report` lays out one pitcher's mix against each side, and
+`lineup_report` blends a whole staff's splits by a lineup's handedness in a
+few `bincount`s. Switch hitters bat from the side opposite the pitcher's hand.
+"""
+import math
+from collections import defaultdict
+from threading import Lock
+
+import numpy as np
+
+from .archetypes import velocity
+
+METRICS = ('usage', 'zone_rate', 'velocity', 'spin_rate', 'horz_break', 'induced_vert_break')
+USAGE, ZONE_RATE = 0, 1
+SIDES = ('L', 'R')
+
+
+def percent(value):
+    """37.8 from '37.8%', or NaN"""
+    try:
+        return float(value.rstrip('%'))
+    except (AttributeError, ValueError):
+        return math.nan
+
+
+def rounded(value, digits=2):
+    return None if math.isnan(value) else round(float(value), digits)
+
+
+def grouped_mean(keys, values, weights, size):
+    """Weighted mean of `values` per key (NaN values are skipped, empty keys are NaN)"""
+    valid = ~np.isnan(values)
+    weights = np.where(valid, weights, 0.0)
+    totals = np.bincount(keys, weights=np.where(valid, values, 0.0) * weights, minlength=size)
+    counts = np.bincount(keys, weights=weights, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, totals / counts, np.nan)
+
+
+class MatchupTable:
+    """One snapshot's rows as NumPy columns, with deltas from the league baselines"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        rows = sorted(snapshot.rows, key=lambda row: (row.player_name, row.stand_side, row.pitch_type))
+        self.pitch_types = sorted({row.pitch_type for row in rows})
+        type_codes = {pitch_type: code for code, pitch_type in enumerate(self.pitch_types)}
+        self.types = np.array([type_codes[row.pitch_type] for row in rows], dtype=np.intp)
+        self.sides = np.array([row.stand_side == 'R' for row in rows], dtype=np.intp)
+        throws = np.array([row.throws == 'R' for row in rows], dtype=np.intp)
+        self.values = np.array(
+            [
+                (
+                    percent(row.usage_rate), percent(row.zone_rate), velocity(row.velocity_range) or math.nan,
+                    row.avg_spin_rate, row.avg_horz_break, row.avg_induced_vert_break,
+                )
+                for row in rows
+            ],
+            dtype=np.float64
+        ).reshape(len(rows), len(METRICS))
+
+        self.slices = {}
+        self.throws = {}
+        self.staffs = defaultdict(list)
+        for position, row in enumerate(rows):
+            if row.player_name not in self.slices:
+                self.slices[row.player_name] = [position, position]
+                self.throws[row.player_name] = row.throws
+                self.staffs[row.team_name].append(row.player_name)
+            self.slices[row.player_name][1] = position + 1
+
+        # Baseline group of each row: pitcher hand x batter side x pitch type.
+        matchups = throws * 2 + self.sides
+        groups = matchups * len(self.pitch_types) + self.types
+        size = 4 * len(self.pitch_types)
+        ones = np.ones(len(rows))
+        baselines = np.stack(
+            [grouped_mean(groups, self.values[:, metric], ones, size) for metric in range(len(METRICS))], axis=1
+        )
+        # Average usage over every pitcher of that hand who faced that side, throwing the pitch or not.
+        owners = np.repeat(np.arange(len(self.slices)), [stop - start for start, stop in self.slices.values()])
+        faced = np.bincount(np.unique(owners * 4 + matchups) % 4, minlength=4)
+        usage_totals = np.bincount(groups, weights=np.nan_to_num(self.values[:, USAGE]), minlength=size)
+        baselines[:, USAGE] = usage_totals / np.maximum(np.repeat(faced, len(self.pitch_types)), 1)
+        # League usage by [pitcher hand][batter side][pitch type], including pitches a pitcher doesn't throw.
+        self.league_usage = baselines[:, USAGE].reshape(2, 2, len(self.pitch_types))
+        self.baselines = baselines[groups]
+        self.deltas = self.values - self.baselines
+
+    def __contains__(self, player_name):
+        return player_name in self.slices
+
+    def rows_of(self, player_name):
+        start, stop = self.slices[player_name]
+        return np.arange(start, stop)
+
+    def split_report(self, player_name):
+        """`player_name`'s pitch mix, zone rate and movement against each batter side, vs the league"""
+        rows = self.rows_of(player_name)
+        splits = {}
+        for code, side in enumerate(SIDES):
+            facing = rows[self.sides[rows] == code]
+            facing = facing[np.argsort(-np.nan_to_num(self.values[facing, USAGE]), kind='stable')]
+            # Zone rates over all pitches to this side, weighted by this pitcher's usage.
+            usage = self.values[facing, USAGE]
+            single = np.zeros(len(facing), dtype=np.intp)
+            zone_rate = grouped_mean(single, self.values[facing, ZONE_RATE], usage, 1)[0]
+            league_zone_rate = grouped_mean(single, self.baselines[facing, ZONE_RATE], usage, 1)[0]
+            splits[side] = {
+                'zone_rate': rounded(zone_rate),
+                'zone_rate_delta': rounded(zone_rate - league_zone_rate),
+                'pitches': [self.pitch_report(row) for row in facing.tolist()],
+            }
+        return {
+            'player_name': player_name,
+            'throws': self.throws[player_name],
+            'splits': splits,
+        }
+
+    def pitch_report(self, row):
+        report = {'pitch_type': self.pitch_types[self.types[row]]}
+        for metric, name in enumerate(METRICS):
+            report[name] = rounded(self.values[row, metric])
+            report[f"{name}_delta"] = rounded(self.deltas[row, metric])
+        return report
+
+    def lineup_report(self, player_names, lineup):
+        """
+        Expected pitch mix, zone rate and movement of each of `player_names`
+        against a lineup of `lineup['L']` left-handed, `lineup['R']` right-handed
+        and `lineup['S']` switch hitters, each vs the league facing the same lineup.
+        """
+        found = [player_name for player_name in player_names if player_name in self.slices]
+        if not found:
+            return []
+        lengths = [self.slices[player_name][1] - self.slices[player_name][0] for player_name in found]
+        rows = np.concatenate([self.rows_of(player_name) for player_name in found])
+        owners = np.repeat(np.arange(len(found)), lengths)
+        throws_right = np.array([self.throws[player_name] == 'R' for player_name in found])
+        total = lineup['L'] + lineup['R'] + lineup['S']
+        share_right = (lineup['R'] + lineup['S'] * ~throws_right) / total
+        weights = np.where(self.sides[rows] == 1, share_right[owners], 1 - share_right[owners])
+
+        types = len(self.pitch_types)
+        keys = owners * types + self.types[rows]
+        size = len(found) * types
+        values = self.values[rows]
+        baselines = self.baselines[rows]
+        # Share of each pitcher's pitches to the lineup that each row accounts for, in percent.
+        thrown = weights * np.nan_to_num(values[:, USAGE])
+        usage = np.bincount(keys, weights=thrown, minlength=size)
+        league = self.league_usage[throws_right.astype(np.intp)]
+        league_usage = ((1 - share_right)[:, None] * league[:, 0] + share_right[:, None] * league[:, 1]).ravel()
+        # Everything else is averaged over the pitches actually thrown to the lineup.
+        means = {
+            metric: grouped_mean(keys, values[:, metric], thrown, size) for metric in range(ZONE_RATE, len(METRICS))
+        }
+        deltas = {
+            metric: grouped_mean(keys, values[:, metric] - baselines[:, metric], thrown, size)
+            for metric in range(ZONE_RATE, len(METRICS))
+        }
+        zone_rate = grouped_mean(owners, values[:, ZONE_RATE], thrown, len(found))
+        league_zone_rate = grouped_mean(owners, baselines[:, ZONE_RATE], thrown, len(found))
+
+        reports = []
+        for owner, player_name in enumerate(found):
+            pitches = []
+            for code in np.flatnonzero(usage[owner * types:(owner + 1) * types] > 0).tolist():
+                key = owner * types + code
+                pitch = {
+                    'pitch_type': self.pitch_types[code],
+                    'usage': rounded(usage[key]),
+                    'usage_delta': rounded(usage[key] - league_usage[key]),
+                }
+                for metric in range(ZONE_RATE, len(METRICS)):
+                    pitch[METRICS[metric]] = rounded(means[metric][key])
+                    pitch[f"{METRICS[metric]}_delta"] = rounded(deltas[metric][key])
+                pitches.append(pitch)
+            pitches.sort(key=lambda pitch: -pitch['usage'])
+            reports.append({
+                'player_name': player_name,
+                'throws': self.throws[player_name],
+                'faces': {'L': rounded(1 - share_right[owner], 3), 'R': rounded(share_right[owner], 3)},
+                'zone_rate': rounded(zone_rate[owner]),
+                'zone_rate_delta': rounded(zone_rate[owner] - league_zone_rate[owner]),
+                'pitches': pitches,
+            })
+        return reports
+
+
+_table = None
+_table_lock = Lock()
+
+
+def get_table(snapshot):
+    """The `MatchupTable` of `snapshot`, built on first use"""
+    global _table
+    table = _table
+    if table is not None and table.snapshot is snapshot:
+        return table
+    with _table_lock:
+        if _table is None or _table.snapshot is not snapshot:
+            _table = MatchupTable(snapshot)
+        return _table
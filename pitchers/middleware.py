@@ -0,0 +1,299 @@
+import asyncio
+import gzip
+import logging
+import zlib
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+
+from .hashers import HashingBusy, busy_response
+from .querybudget import budget_for, capture_queries
+
+try:
+    import brotli
+except ImportError:  # Brotli ships with whitenoise[brotli], but keep gzip working without it
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+def parse_accept_encoding(header):
+    """Return the set of codings the client accepts (q=0 entries are dropped)"""
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def choose_encoding(header):
+    accepted = parse_accept_encoding(header or '')
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress_body(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content, quality=settings.API_COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=settings.API_COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor:
+    """Brotli or gzip compressor for a streamed body, flushing after each chunk so rows reach the client promptly"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=settings.API_COMPRESSION_BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(settings.API_COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def process(self, chunk):
+        if self.encoding == 'br':
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    for chunk in chunks:
+        yield compressor.process(chunk)
+    yield compressor.finish()
+
+
+async def acompress_stream(chunks, encoding):
+    """`compress_stream` for async bodies, as served under ASGI"""
+    compressor = StreamCompressor(encoding)
+    async for chunk in chunks:
+        yield compressor.process(chunk)
+    yield compressor.finish()
+
+
+class CompressedBodyCache:
+    """Small LRU of compressed bodies keyed by (ETag, encoding)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+compressed_bodies = CompressedBodyCache(max_entries=32)
+
+
+class APICompressionMiddleware:
+    """
+    Brotli/gzip content negotiation for JSON API responses, buffered or streamed.
+
+    Static files are already compressed by WhiteNoise; this covers the dynamic
+    `/api/` responses. Bodies smaller than `API_COMPRESSION_MIN_SIZE` are sent
+    as-is, since the framing overhead outweighs the savings. Responses carrying
+    an ETag are cached in compressed form, so a repeated pitcher list costs a
+    dictionary lookup rather than a fresh compression pass.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not request.path.startswith(settings.API_COMPRESSION_PATH_PREFIX):
+            return response
+        return self.compress(request, response)
+
+    def compress(self, request, response):
+        if response.status_code != 200 or response.has_header('Content-Encoding'):
+            return response
+        if 'json' not in response.get('Content-Type', ''):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        if response.streaming:
+            return self.compress_streaming(request, response)
+
+        if len(response.content) < settings.API_COMPRESSION_MIN_SIZE:
+            return response
+
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None:
+            return response
+
+        etag = response.get('ETag')
+        cache_key = (etag, encoding) if etag else None
+        compressed = compressed_bodies.get(cache_key) if cache_key else None
+        if compressed is None:
+            compressed = compress_body(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            if cache_key:
+                compressed_bodies.set(cache_key, compressed)
+
+        original_size = len(response.content)
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The compressed representation is no longer byte-identical to the
+        # uncompressed one, so a strong validator must be weakened (as Django's
+        # GZipMiddleware does).
+        if etag and not etag.startswith('W/'):
+            response['ETag'] = 'W/' + etag
+        logger.debug(f"Compressed {request.path} with {encoding}: {original_size} -> {len(compressed)} bytes")
+        return response
+
+    def compress_streaming(self, request, response):
+        # Streamed bodies have no known size, so the threshold doesn't apply.
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None:
+            return response
+        compress = acompress_stream if response.is_async else compress_stream
+        response.streaming_content = compress(response.streaming_content, encoding)
+        del response['Content-Length']
+        response['Content-Encoding'] = encoding
+        etag = response.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+
+class ConcurrencyLimit:
+    """
+    ASGI wrapper capping how many HTTP requests a worker process serves at once.
+
+    Django's ASGI handler runs each request's sync middleware and view in a
+    thread of its own, with no upper bound, so a burst of N requests would open
+    N threads and N database connections. Here at most `limit` run at a time,
+    as with gthread's fixed pool, and the rest wait for a slot. Requests under
+    `unlimited_paths` (the event streams, which are async and spend their life
+    parked on a queue) don't take one.
+    """
+
+    def __init__(self, app, limit, unlimited_paths=()):
+        self.app = app
+        self.unlimited_paths = tuple(unlimited_paths)
+        self.slots = asyncio.Semaphore(limit)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(self.unlimited_paths):
+            return await self.app(scope, receive, send)
+        async with self.slots:
+            return await self.app(scope, receive, send)
+
+
+class HashingBusyMiddleware:
+    """Answers a full password hashing queue outside DRF (eg the admin login) with a 503 rather than a 500"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, HashingBusy):
+            return busy_response()
+        return None
+
+
+class RequestProfilerMiddleware:
+    """
+    Profiles a request when staff ask for it with `X-Profile` or `?_profile=` (see `pitchers/profiling.py`).
+
+    Other requests only pay for checking the header and query string. The profile
+    id is returned in `X-Profile-Id`, or the profile replaces the body for `inline`.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILER_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if 'HTTP_X_PROFILE' not in request.META and '_profile' not in request.META.get('QUERY_STRING', ''):
+            return self.get_response(request)
+
+        from .profiling import requested_mode, is_staff, profile_request, get_store
+
+        requested = requested_mode(request)
+        if requested is None or not is_staff(request):
+            return self.get_response(request)
+        mode, inline = requested
+        response, profile = profile_request(request, self.get_response, mode)
+        logger.info(
+            f"Profiled {profile['method']} {profile['path']} ({mode}): {profile['ms']}ms, "
+            f"{profile['query_count']} queries in {profile['query_ms']}ms"
+        )
+        if inline:
+            return JsonResponse(profile)
+        if get_store().add(profile):
+            response['X-Profile-Id'] = profile['id']
+            response['X-Profile-Url'] = reverse('profile-detail', args=[profile['id']])
+        return response
+
+
+class QueryBudgetMiddleware:
+    """Warns about requests over their query budget or with N+1 patterns (see `pitchers/querybudget.py`)"""
+
+    def __init__(self, get_response):
+        if not settings.QUERY_BUDGETS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with capture_queries() as log:
+            response = self.get_response(request)
+        match = request.resolver_match
+        budget = budget_for(match.func, request.method) if match else None
+        response['X-Query-Count'] = str(len(log))
+        problems = log.problems(budget)
+        if problems:
+            details = '\n'.join(f"  {query['origin']}: {query['sql']}" for query in log.queries)
+            logger.warning(
+                f"Query budget problems on {request.method} {request.path}: {'; '.join(problems)}\n{details}"
+            )
+        elif budget is None and match and request.path.startswith(settings.API_COMPRESSION_PATH_PREFIX):
+            logger.debug(f"No query budget for {request.method} {request.path} ({len(log)} queries)")
+        return response
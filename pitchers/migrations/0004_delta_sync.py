@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0003_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PitcherTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pitcher_id', models.BigIntegerField()),
+                ('version', models.PositiveBigIntegerField(db_index=True)),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='datasetversion',
+            name='history_floor',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pitcher',
+            name='row_version',
+            field=models.PositiveBigIntegerField(db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0005_push_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppliedFavorites',
+            fields=[
+                ('user_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('pitcher_ids', models.JSONField(default=list)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PitcherCooccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pitchers.pitcher')),
+                ('pitcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pitchers.pitcher')),
+            ],
+            options={
+                'unique_together': {('pitcher', 'other')},
+            },
+        ),
+    ]
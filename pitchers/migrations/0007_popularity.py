@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0006_recommendations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PitcherPopularity',
+            fields=[
+                ('pitcher', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='popularity', serialize=False, to='pitchers.pitcher')),
+                ('favorite_count', models.IntegerField(db_index=True, default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PitcherActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(db_index=True)),
+                ('count', models.IntegerField(default=0)),
+                ('pitcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pitchers.pitcher')),
+            ],
+            options={
+                'unique_together': {('pitcher', 'bucket')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:30
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+INDEX_NAME = 'auth_user_email_ci_uniq'
+
+
+def create_index(apps, schema_editor):
+    # `auth_user` belongs to django.contrib.auth, so the index can't be declared on the model.
+    # Blank emails map to NULL, which unique indexes allow any number of.
+    User = apps.get_model('auth', 'User')
+    duplicates = list(
+        User.objects.exclude(email='').annotate(normalized=Lower('email')).values('normalized')
+        .annotate(total=Count('id')).filter(total__gt=1).values_list('normalized', flat=True)[:20]
+    )
+    if duplicates:
+        raise RuntimeError(
+            f"Can't add a case-insensitive unique index on auth_user.email, these emails are used by "
+            f"more than one account: {', '.join(duplicates)}"
+        )
+    expression = "NULLIF(LOWER(email), '')"
+    if schema_editor.connection.vendor == 'mysql':
+        # MySQL (8.0.13+) needs functional key parts wrapped in their own parentheses.
+        expression = f"({expression})"
+    schema_editor.execute(f"CREATE UNIQUE INDEX {INDEX_NAME} ON auth_user ({expression})")
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute(f"DROP INDEX {INDEX_NAME} ON auth_user")
+    else:
+        schema_editor.execute(f"DROP INDEX {INDEX_NAME}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('pitchers', '0007_popularity'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
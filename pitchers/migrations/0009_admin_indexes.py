@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0008_user_email_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='favoritepitcher',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='pitcher',
+            name='player_name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='pitcher',
+            name='team_name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0009_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PitchArchetype',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(max_length=10, unique=True)),
+                ('pitch_type', models.CharField(max_length=2)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('name', models.CharField(max_length=100)),
+                ('size', models.PositiveIntegerField()),
+                ('centroid', models.JSONField(default=dict)),
+                ('spread', models.FloatField()),
+            ],
+            options={
+                'ordering': ('pitch_type', 'rank'),
+            },
+        ),
+        migrations.AddField(
+            model_name='pitcher',
+            name='archetype',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='pitcher',
+            name='archetype_distance',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='pitcher',
+            index=models.Index(fields=['archetype', 'archetype_distance'], name='pitchers_pitcher_archetype_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pitcharchetype',
+            index=models.Index(fields=['pitch_type', 'rank'], name='pitchers_archetype_type_idx'),
+        ),
+    ]
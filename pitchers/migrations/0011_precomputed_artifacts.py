@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0010_archetypes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrecomputedArtifact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=100)),
+                ('version', models.PositiveBigIntegerField()),
+                ('body', models.BinaryField()),
+                ('meta', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('version', 'kind', 'key'), name='pitchers_artifact_unique')],
+            },
+        ),
+    ]
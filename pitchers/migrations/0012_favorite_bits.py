@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:17
+
+from django.db import migrations, models
+
+
+def fill_bits(apps, schema_editor):
+    # Same encoding as `pitchers.bitsets.encode`, inlined so the migration doesn't depend on app code.
+    AppliedFavorites = apps.get_model('pitchers', 'AppliedFavorites')
+    for state in AppliedFavorites.objects.exclude(pitcher_ids=[]).iterator(chunk_size=2000):
+        buffer = bytearray(max(state.pitcher_ids) // 8 + 1)
+        for pitcher_id in state.pitcher_ids:
+            buffer[pitcher_id >> 3] |= 1 << (pitcher_id & 7)
+        AppliedFavorites.objects.filter(pk=state.pk).update(bits=bytes(buffer))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0011_precomputed_artifacts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appliedfavorites',
+            name='bits',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(fill_bits, migrations.RunPython.noop),
+    ]
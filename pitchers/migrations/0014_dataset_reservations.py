@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:49
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_reserved(apps, schema_editor):
+    apps.get_model('pitchers', 'DatasetVersion').objects.update(reserved=F('version'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0013_favorites_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetReservation',
+            fields=[
+                ('version', models.PositiveBigIntegerField(primary_key=True, serialize=False)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='datasetversion',
+            name='reserved',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_reserved, migrations.RunPython.noop),
+    ]
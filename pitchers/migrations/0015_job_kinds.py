@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pitchers', '0014_dataset_reservations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobKind',
+            fields=[
+                ('kind', models.CharField(max_length=50, primary_key=True, serialize=False)),
+            ],
+        ),
+    ]
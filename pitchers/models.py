@@ -1,10 +1,15 @@
-from django.db import models
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.db.models import F, Min
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class Pitcher(models.Model):
-    player_name = models.CharField(max_length=100)
+    player_name = models.CharField(max_length=100, db_index=True)
     player_image = models.URLField()
-    team_name = models.CharField(max_length=100)
+    team_name = models.CharField(max_length=100, db_index=True)
     team_logo = models.URLField()
     stand_side = models.CharField(max_length=1)
     pitch_type = models.CharField(max_length=2)
@@ -17,6 +22,16 @@ class Pitcher(models.Model):
     arm_angle = models.FloatField()
     throws = models.CharField(max_length=1)
     heatmap_path = models.CharField(max_length=200)
+    # Dataset version of the last insert/update of this row, for delta sync (see `pitchers/changes.py`).
+    row_version = models.PositiveBigIntegerField(default=0, db_index=True)
+    # Pitch archetype and distance to its centroid, maintained by `pitchers.archetypes`.
+    archetype = models.CharField(max_length=10, blank=True, default='')
+    archetype_distance = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['archetype', 'archetype_distance'], name='pitchers_pitcher_archetype_idx'),
+        ]
 
     def __str__(self):
         return self.player_name
@@ -24,10 +39,300 @@ class Pitcher(models.Model):
 class FavoritePitcher(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='favorites')
     pitcher = models.ForeignKey(Pitcher, on_delete=models.CASCADE, related_name='favorited_by')
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     class Meta:
         unique_together = ('user', 'pitcher')
 
     def __str__(self):
         return f"{self.user.username}'s favorite: {self.pitcher.player_name}"
+
+
+class DatasetVersion(models.Model):
+    """Single-row counter bumped whenever the pitcher dataset changes"""
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+    # Oldest version clients can sync from; tombstones before it have been pruned.
+    history_floor = models.PositiveBigIntegerField(default=0)
+    # Highest version handed out by `reserve`; the ones above `version` are still being written.
+    reserved = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        obj, _ = cls.objects.get_or_create(pk=1)
+        return obj
+
+    @classmethod
+    def bump(cls):
+        with transaction.atomic():
+            updated = cls.objects.filter(pk=1).update(
+                version=F('version') + 1,
+                reserved=Greatest('reserved', F('version') + 1),
+                updated_at=timezone.now()
+            )
+            if not updated:
+                cls.objects.create(pk=1, version=1, reserved=1)
+        return cls.current()
+
+    @classmethod
+    def reserve(cls, timeout):
+        """
+        Hand out the next version, never the same one twice, even across processes.
+        It must be `publish`ed once its rows are written, or it is given up after
+        `timeout` seconds.
+        """
+        with transaction.atomic():
+            # The UPDATE locks the row, so concurrent reservations queue here.
+            if not cls.objects.filter(pk=1).update(reserved=Greatest('reserved', 'version') + 1):
+                cls.objects.create(pk=1, reserved=1)
+            version = cls.objects.filter(pk=1).values_list('reserved', flat=True).get()
+            DatasetReservation.objects.create(version=version, expires_at=timezone.now() + timedelta(seconds=timeout))
+        return version
+
+    @classmethod
+    def publish(cls, version):
+        """
+        Finish the reservation of `version`, then advance (never backwards) to the
+        newest version with no reservation at or below it still being written.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            # Expired reservations are given up: their writers died, or were killed mid-load.
+            DatasetReservation.objects.filter(models.Q(version=version) | models.Q(expires_at__lt=now)).delete()
+            dataset, _ = cls.objects.select_for_update().get_or_create(pk=1)
+            pending = DatasetReservation.objects.aggregate(first=Min('version'))['first']
+            newest = max(dataset.reserved, version) if pending is None else pending - 1
+            if newest > dataset.version:
+                cls.objects.filter(pk=1).update(version=newest, updated_at=now)
+                dataset.version, dataset.updated_at = newest, now
+        return dataset
+
+    def __str__(self):
+        return f"Dataset v{self.version}"
+
+
+class DatasetReservation(models.Model):
+    """A dataset version handed out by `DatasetVersion.reserve` whose rows are still being written"""
+    version = models.PositiveBigIntegerField(primary_key=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Reserved v{self.version}"
+
+
+class PitchArchetype(models.Model):
+    """A cluster of similar pitches of one pitch type, computed by `pitchers.archetypes`"""
+    label = models.CharField(max_length=10, unique=True)
+    pitch_type = models.CharField(max_length=2)
+    # Position within the pitch type, by descending velocity.
+    rank = models.PositiveSmallIntegerField()
+    name = models.CharField(max_length=100)
+    size = models.PositiveIntegerField()
+    # Feature averages of the members, in the units of the `Pitcher` fields.
+    centroid = models.JSONField(default=dict)
+    # Mean distance of the members to the centroid, in standard deviations.
+    spread = models.FloatField()
+
+    class Meta:
+        ordering = ('pitch_type', 'rank')
+        indexes = [
+            models.Index(fields=['pitch_type', 'rank'], name='pitchers_archetype_type_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.label}: {self.name}"
+
+
+class PitcherTombstone(models.Model):
+    """Records a deleted pitcher so delta sync can tell clients to drop it"""
+    pitcher_id = models.BigIntegerField()
+    version = models.PositiveBigIntegerField(db_index=True)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Pitcher {self.pitcher_id} deleted in v{self.version}"
+
+
+class PitcherCooccurrence(models.Model):
+    """
+    Number of users who favorite both `pitcher` and `other`, stored in both
+    directions. The diagonal (`pitcher == other`) holds the pitcher's favorite
+    count. Maintained by `pitchers.recommendations`.
+    """
+    pitcher = models.ForeignKey(Pitcher, on_delete=models.CASCADE, related_name='+')
+    other = models.ForeignKey(Pitcher, on_delete=models.CASCADE, related_name='+')
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('pitcher', 'other')
+
+    def __str__(self):
+        return f"{self.pitcher_id} & {self.other_id}: {self.count}"
+
+
+class AppliedFavorites(models.Model):
+    """
+    The favorites of a user currently counted in `PitcherCooccurrence`, also
+    as a bitset over pitcher ids (see `pitchers.bitsets`)
+    """
+    # Not a foreign key: the row has to outlive a deleted user until their counts are removed.
+    user_id = models.IntegerField(primary_key=True)
+    pitcher_ids = models.JSONField(default=list)
+    bits = models.BinaryField(default=b'')
+
+    def __str__(self):
+        return f"{self.user_id}: {len(self.pitcher_ids)} favorites counted"
+
+
+class FavoritesVersion(models.Model):
+    """Version of a user's favorites, bumped by every write that changes them (see `pitchers.favorites`)"""
+    # Not a foreign key, like `AppliedFavorites`: `recommendations.sync_user` still takes the lock
+    # after a user is deleted, to remove their counts.
+    user_id = models.IntegerField(primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def lock(cls, user_id):
+        """Lock `user_id`'s favorites until the current transaction ends; returns their version"""
+        rows = cls.objects.filter(user_id=user_id)
+        # A write rather than SELECT ... FOR UPDATE, which SQLite ignores: it has to come first so
+        # SQLite takes its write lock before the transaction reads anything.
+        if not rows.update(version=F('version')):
+            cls.objects.bulk_create([cls(user_id=user_id)], ignore_conflicts=True)
+            rows.update(version=F('version'))
+        return rows.values_list('version', flat=True).get()
+
+    def __str__(self):
+        return f"{self.user_id}'s favorites v{self.version}"
+
+
+class IdempotencyKey(models.Model):
+    """Response of a write sent with an `Idempotency-Key` header, replayed when the request is retried"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    # Digest of the method, path and body, so a key reused for a different request is refused.
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    body = models.JSONField(null=True)
+    headers = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='pitchers_idempotency_key_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.key} ({self.status_code})"
+
+
+class PitcherPopularity(models.Model):
+    """Denormalized favorite count per pitcher, maintained by `pitchers.counters`"""
+    pitcher = models.OneToOneField(Pitcher, on_delete=models.CASCADE, primary_key=True, related_name='popularity')
+    favorite_count = models.IntegerField(default=0, db_index=True)
+
+    def __str__(self):
+        return f"{self.pitcher_id}: {self.favorite_count} favorites"
+
+
+class PitcherActivity(models.Model):
+    """New favorites of a pitcher per time bucket, the input to trending scores"""
+    pitcher = models.ForeignKey(Pitcher, on_delete=models.CASCADE, related_name='+')
+    bucket = models.DateTimeField(db_index=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('pitcher', 'bucket')
+
+    def __str__(self):
+        return f"{self.pitcher_id} @ {self.bucket}: {self.count}"
+
+
+class PushEvent(models.Model):
+    """Event relayed between processes by `pitchers.events.DatabaseBackend`"""
+    channel = models.CharField(max_length=100)
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.channel} event {self.pk}"
+
+
+class Job(models.Model):
+    """Unit of background work picked up by `manage.py run_jobs`"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    progress = models.FloatField(default=0.0)
+    progress_message = models.CharField(max_length=200, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-created_at',)
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='pitchers_job_claim_idx'),
+        ]
+
+    def report_progress(self, progress, message=''):
+        """Persist progress without touching the rest of the row"""
+        self.progress = max(0.0, min(1.0, progress))
+        self.progress_message = message[:200]
+        Job.objects.filter(pk=self.pk).update(progress=self.progress, progress_message=self.progress_message)
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+
+class JobKind(models.Model):
+    """Row per job kind, locked by a worker while it checks and takes one of the kind's running slots"""
+    kind = models.CharField(max_length=50, primary_key=True)
+
+    @classmethod
+    def lock(cls, kind):
+        """Lock `kind` until the current transaction ends"""
+        rows = cls.objects.filter(kind=kind)
+        # A write first rather than SELECT ... FOR UPDATE, as in `FavoritesVersion.lock`.
+        if not rows.update(kind=F('kind')):
+            cls.objects.bulk_create([cls(kind=kind)], ignore_conflicts=True)
+            rows.update(kind=F('kind'))
+
+    def __str__(self):
+        return self.kind
+
+
+class PrecomputedArtifact(models.Model):
+    """A response body or cache entry built ahead of traffic by `manage.py warm_caches`"""
+    kind = models.CharField(max_length=50)
+    key = models.CharField(max_length=100)
+    version = models.PositiveBigIntegerField()
+    body = models.BinaryField()
+    meta = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['version', 'kind', 'key'], name='pitchers_artifact_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}:{self.key} v{self.version} ({len(self.body)} bytes)"
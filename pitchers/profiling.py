@@ -0,0 +1,215 @@
+"""
+On-demand profiling of single requests, for staff.
+
+A request is profiled when it carries an `X-Profile` header or a `_profile`
+query parameter and comes from a staff user (session or JWT). Everything else
+passes straight through `RequestProfilerMiddleware` after a dictionary lookup.
+
+Two profilers are available, chosen by the flag's value:
+
+- `sample` (default): a background thread records the request thread's stack
+  every `PROFILER_SAMPLE_INTERVAL` seconds. The result is folded stacks
+  (`frame;frame;frame count`), which flamegraph.pl, speedscope and inferno
+  read directly. Overhead is low enough for realistic timings.
+- `cprofile`: deterministic cProfile, reported as the top functions by
+  cumulative time. Exact call counts, but it slows Python-heavy code down.
+
+Each profile also lists the SQL the request issued, with timings. Profiles are
+kept in a per-process store bounded to `PROFILER_STORE_MAX_BYTES` and fetched
+from `/api/profiles/<id>/` (add `?folded=1` for the raw stacks). With
+several workers the fetch may land on a different process, so the flag value
+`inline` (or `cprofile-inline`) returns the profile as the response body instead.
+Streamed responses are only profiled up to the point the view returns them.
+"""
+import cProfile
+import io
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+MODES = ('sample', 'cprofile')
+
+
+def requested_mode(request):
+    """(mode, inline) if the request asks to be profiled, else None"""
+    value = request.META.get('HTTP_X_PROFILE') or request.GET.get('_profile')
+    if not value:
+        return None
+    value = value.strip().lower()
+    inline = value.endswith('inline')
+    mode = value.removesuffix('inline').strip('-') or 'sample'
+    if mode not in MODES:
+        mode = 'sample'
+    return mode, inline
+
+
+def is_staff(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.is_staff
+    # API clients authenticate with JWTs, which only DRF views see, so check the header here too.
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except (InvalidToken, AuthenticationFailed):
+        return False
+    return bool(result and result[0].is_staff)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    module = frame.f_globals.get('__name__', code.co_filename)
+    return f"{module}:{code.co_qualname}:{frame.f_lineno}"
+
+
+class StackSampler:
+    """Samples one thread's stack from a background thread, counting identical stacks"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class QueryRecorder:
+    """Records the SQL run on every database connection, via `execute_wrapper`"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.queries = []
+        self.count = 0
+        self.total = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.total += elapsed
+            if len(self.queries) < self.limit:
+                self.queries.append({
+                    'alias': context['connection'].alias, 'sql': sql, 'ms': round(elapsed * 1000, 3), 'many': many
+                })
+
+
+class ProfileStore:
+    """LRU of serialized profiles, bounded by their total size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        body = json.dumps(profile).encode()
+        if len(body) > self.max_bytes:
+            logger.warning(f"Profile {profile['id']} is {len(body)} bytes, too large to store")
+            return False
+        with self._lock:
+            self._entries[profile['id']] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+        return True
+
+    def get(self, profile_id):
+        with self._lock:
+            body = self._entries.get(profile_id)
+        return json.loads(body) if body is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ProfileStore(settings.PROFILER_STORE_MAX_BYTES)
+        return _store
+
+
+def profile_request(request, get_response, mode):
+    """Run `get_response` under the profiler; returns (response, profile)"""
+    recorder = QueryRecorder(settings.PROFILER_MAX_QUERIES)
+    profile = {
+        'id': uuid.uuid4().hex, 'method': request.method, 'path': request.get_full_path(), 'mode': mode,
+    }
+    started = time.perf_counter()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = get_response(request)
+            finally:
+                profiler.disable()
+        else:
+            sampler = stack.enter_context(StackSampler(threading.get_ident(), settings.PROFILER_SAMPLE_INTERVAL))
+            response = get_response(request)
+    profile['ms'] = round((time.perf_counter() - started) * 1000, 3)
+
+    if mode == 'cprofile':
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(settings.PROFILER_TOP_FUNCTIONS)
+        profile['functions'] = output.getvalue()
+    else:
+        profile['samples'] = sampler.samples
+        profile['interval'] = settings.PROFILER_SAMPLE_INTERVAL
+        profile['folded'] = sampler.folded()
+    profile['status'] = response.status_code
+    profile['queries'] = recorder.queries
+    profile['query_count'] = recorder.count
+    profile['query_ms'] = round(recorder.total * 1000, 3)
+    return response, profile
@@ -0,0 +1,113 @@
+"""
+Per-endpoint SQL query budgets.
+
+Views declare how many queries a request may run: viewsets and APIViews with a
+`query_budgets` dict keyed by action (or HTTP method, for plain APIViews),
+function views (or `as_view()` results) with the `query_budget` decorator.
+Budgets are ceilings for a request against any amount of data, so they must not
+depend on the number of rows involved.
+
+`pitchers.middleware.QueryBudgetMiddleware` (on when `QUERY_BUDGETS_ENABLED`,
+by default with `DEBUG`) logs a warning with the offending SQL and the line of
+project code that issued it when a request goes over budget, or repeats the
+same statement from the same place `QUERY_BUDGET_REPEAT_THRESHOLD` times or
+more (the usual N+1 signature). The same checks back the route tests in `pitchers/tests.py`.
+"""
+import logging
+import re
+import time
+import traceback
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_PLACEHOLDER_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+_TRANSACTION_CONTROL = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+def query_budget(limit):
+    """Declare the query budget of a function view"""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+
+def budget_for(view, method):
+    """The budget declared for `view` (a resolved view function) handling `method`, or None"""
+    if getattr(view, 'query_budget', None) is not None:
+        return view.query_budget
+    cls = getattr(view, 'cls', None) or getattr(view, 'view_class', None)
+    if cls is None:
+        return None
+    actions = getattr(view, 'actions', None)
+    name = actions.get(method.lower()) if actions else method.lower()
+    return getattr(cls, 'query_budgets', {}).get(name)
+
+
+def normalize(sql):
+    """Statement shape, ignoring literal values and the length of IN lists"""
+    return _NUMBER.sub('N', _PLACEHOLDER_LIST.sub('(...)', sql))
+
+
+def origin():
+    """`file:line function` of the innermost project frame outside this module"""
+    base = str(settings.BASE_DIR)
+    here = str(Path(__file__))
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        if frame.filename.startswith(base) and frame.filename != here and 'site-packages' not in frame.filename:
+            return f"{Path(frame.filename).relative_to(base)}:{frame.lineno} {frame.name}"
+    return 'unknown'
+
+
+class QueryLog:
+    """Queries run on any connection while `capture_queries` is active"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql, 'ms': round((time.perf_counter() - started) * 1000, 3), 'origin': origin(),
+            })
+
+    def __len__(self):
+        return len(self.queries)
+
+    def repeated(self, threshold):
+        """(normalized sql, origin, count) for statements issued `threshold` or more times from one place"""
+        shapes = Counter(
+            (normalize(query['sql']), query['origin']) for query in self.queries
+            if not query['sql'].lstrip().upper().startswith(_TRANSACTION_CONTROL)
+        )
+        return [(sql, where, count) for (sql, where), count in shapes.most_common() if count >= threshold]
+
+    def problems(self, budget, threshold=None):
+        """Descriptions of every budget overrun and N+1 pattern, empty if there are none"""
+        threshold = threshold or settings.QUERY_BUDGET_REPEAT_THRESHOLD
+        problems = []
+        if budget is not None and len(self) > budget:
+            problems.append(f"{len(self)} queries, over the budget of {budget}")
+        for sql, where, count in self.repeated(threshold):
+            problems.append(f"{count}x from {where}: {sql}")
+        return problems
+
+
+@contextmanager
+def capture_queries():
+    log = QueryLog()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(log))
+        yield log
+
@@ -0,0 +1,236 @@
+"""
+"Users who follow X also follow Y" and "recommended for you".
+
+The user x pitcher favorites matrix X is kept as its item-item co-occurrence
+X^T X in `PitcherCooccurrence`, one row per non-zero (pitcher, other) cell.
+The diagonal is each pitcher's favorite count, so cosine similarity needs no
+other table: sim(i, j) = c(i, j) / sqrt(c(i, i) * c(j, j)).
+
+Counts are maintained incrementally. Any favorites write schedules
+`sync_user` on commit, which diffs the user's favorites against the set last
+counted (`AppliedFavorites`) and applies only the changed pairs. It also
+stores the user's favorites bitset (see `pitchers/bitsets.py`). `rebuild`
+recomputes everything from the favorites table, to bootstrap or repair.
+
+Each pitcher's top-k neighbor list is cached, so a recommendation costs one
+`get_many` plus a merge of a few short lists.
+"""
+import heapq
+import logging
+import math
+from collections import defaultdict
+from functools import reduce
+from itertools import product
+from operator import or_
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, Q
+
+from . import bitsets, counters
+from .models import AppliedFavorites, FavoritePitcher, FavoritesVersion, PitcherCooccurrence
+
+logger = logging.getLogger(__name__)
+
+def get_cache():
+    return caches[settings.RECOMMENDATIONS_CACHE_ALIAS]
+
+
+def neighbors_key(pitcher_id):
+    return f"recommendations:neighbors:{pitcher_id}"
+
+
+def pair_deltas(old, new):
+    """
+    Co-occurrence changes when a user's favorites go from `old` to `new` (sets of
+    pitcher ids): only cells involving an added or removed pitcher move, by +1 or -1.
+    """
+    def cells(changed, favorites):
+        return {pair for i, j in product(changed, favorites) for pair in ((i, j), (j, i))}
+
+    deltas = dict.fromkeys(cells(new - old, new), 1)
+    deltas.update(dict.fromkeys(cells(old - new, old), -1))
+    return deltas
+
+
+def apply_deltas(deltas):
+    """One UPDATE per delta value (+1 / -1); missing cells are created first with a zero count"""
+    additions = [PitcherCooccurrence(pitcher_id=i, other_id=j) for (i, j), delta in deltas.items() if delta > 0]
+    PitcherCooccurrence.objects.bulk_create(additions, ignore_conflicts=True)
+    grouped = defaultdict(lambda: defaultdict(list))
+    for (i, j), delta in deltas.items():
+        grouped[delta][i].append(j)
+    for delta, by_pitcher in grouped.items():
+        cells = reduce(or_, (Q(pitcher_id=i, other_id__in=others) for i, others in by_pitcher.items()))
+        PitcherCooccurrence.objects.filter(cells).update(count=F('count') + delta)
+
+
+@transaction.atomic
+def sync_user(user_id):
+    """Bring the counts in line with `user_id`'s current favorites; returns the number of cells changed"""
+    # The lock favorites writes take, so the favorites read below can't change until this commits.
+    FavoritesVersion.lock(user_id)
+    state, _ = AppliedFavorites.objects.get_or_create(user_id=user_id)
+    old = set(state.pitcher_ids)
+    new = set(FavoritePitcher.objects.filter(user_id=user_id).values_list('pitcher_id', flat=True))
+    if old == new:
+        return 0
+    added, removed = sorted(new - old), sorted(old - new)
+    transaction.on_commit(lambda: counters.record(added, removed))
+    deltas = pair_deltas(old, new)
+    apply_deltas(deltas)
+    bits = bitsets.encode(new)
+    if new:
+        state.pitcher_ids = sorted(new)
+        state.bits = bits
+        state.save(update_fields=['pitcher_ids', 'bits'])
+    else:
+        state.delete()
+    transaction.on_commit(lambda: bitsets.cache_bits({user_id: bits}))
+    get_cache().delete_many([neighbors_key(pitcher_id) for pitcher_id in old | new])
+    return len(deltas)
+
+
+def favorites_changed(sender, instance, raw=False, **kwargs):
+    """post_save/post_delete on `FavoritePitcher`"""
+    if raw:
+        return
+    schedule_sync(instance.user_id)
+
+
+class PendingSync:
+    """`sync_user(user_id)` as an on-commit callback that knows whether it has run yet"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.done = False
+        # Named in Django's log message if the sync fails.
+        self.__qualname__ = f"sync_user({user_id})"
+
+    def __call__(self):
+        self.done = True
+        sync_user(self.user_id)
+
+
+def schedule_sync(user_id):
+    """
+    Run `sync_user` once the current transaction commits, once per user however
+    many favorites rows changed, so a bulk delete + re-create (eg `save_favorites`)
+    is counted as one diff.
+    """
+    connection = transaction.get_connection()
+    if any(
+        isinstance(func, PendingSync) and func.user_id == user_id and not func.done
+        for _, func, _ in connection.run_on_commit
+    ):
+        return
+    transaction.on_commit(PendingSync(user_id), robust=True)
+
+
+@transaction.atomic
+def rebuild():
+    """Recompute all counts from the favorites table; returns the number of non-zero cells"""
+    # Imported here rather than at module level: this module loads in `AppConfig.ready`, and numpy
+    # would otherwise add ~50ms to every process boot for a rarely run maintenance task.
+    import numpy as np
+
+    pairs = np.array(
+        FavoritePitcher.objects.order_by('user_id', 'pitcher_id').values_list('user_id', 'pitcher_id'),
+        dtype=np.int64
+    ).reshape(-1, 2)
+    stale = set(PitcherCooccurrence.objects.filter(other_id=F('pitcher_id')).values_list('pitcher_id', flat=True))
+    cleared = dict.fromkeys(AppliedFavorites.objects.values_list('user_id', flat=True), b'')
+    PitcherCooccurrence.objects.all().delete()
+    AppliedFavorites.objects.all().delete()
+    if not len(pairs):
+        get_cache().delete_many([neighbors_key(pitcher_id) for pitcher_id in stale])
+        transaction.on_commit(lambda: bitsets.cache_bits(cleared))
+        return 0
+
+    users, starts = np.unique(pairs[:, 0], return_index=True)
+    groups = np.split(pairs[:, 1], starts[1:])
+    # Each user contributes the outer product of their favorites; cells are encoded as
+    # i * width + j so the sum over users is a single unique/count pass.
+    width = int(pairs[:, 1].max()) + 1
+    cells = np.concatenate([(group[:, None] * width + group[None, :]).ravel() for group in groups])
+    cells, counts = np.unique(cells, return_counts=True)
+    PitcherCooccurrence.objects.bulk_create(
+        [
+            PitcherCooccurrence(pitcher_id=int(cell // width), other_id=int(cell % width), count=int(count))
+            for cell, count in zip(cells, counts)
+        ],
+        batch_size=2000
+    )
+    applied = [
+        AppliedFavorites(user_id=int(user), pitcher_ids=group.tolist(), bits=bitsets.encode(group.tolist()))
+        for user, group in zip(users, groups)
+    ]
+    AppliedFavorites.objects.bulk_create(applied, batch_size=2000)
+    cleared.update((state.user_id, state.bits) for state in applied)
+    transaction.on_commit(lambda: bitsets.cache_bits(cleared))
+    get_cache().delete_many([neighbors_key(pitcher_id) for pitcher_id in stale | set(pairs[:, 1].tolist())])
+    logger.info(f"Rebuilt co-occurrence counts: {len(users)} users, {len(cells)} cells")
+    return len(cells)
+
+
+def compute_neighbors(pitcher_ids):
+    """Top-k neighbors for each of `pitcher_ids` as lists of (other_id, score, shared_count)"""
+    cells = defaultdict(list)
+    for pitcher_id, other_id, count in PitcherCooccurrence.objects.filter(
+        pitcher_id__in=pitcher_ids, count__gt=0
+    ).values_list('pitcher_id', 'other_id', 'count'):
+        cells[pitcher_id].append((other_id, count))
+    others = {other_id for row in cells.values() for other_id, _ in row} | set(pitcher_ids)
+    diagonal = dict(PitcherCooccurrence.objects.filter(
+        pitcher_id__in=others, other_id=F('pitcher_id'), count__gt=0
+    ).values_list('pitcher_id', 'count'))
+
+    neighbors = {}
+    for pitcher_id in pitcher_ids:
+        own = diagonal.get(pitcher_id)
+        scored = [
+            (other_id, count / math.sqrt(own * diagonal[other_id]), count)
+            for other_id, count in cells.get(pitcher_id, ())
+            if other_id != pitcher_id and own and diagonal.get(other_id)
+        ]
+        neighbors[pitcher_id] = heapq.nlargest(
+            settings.RECOMMENDATIONS_TOP_K, scored, key=lambda item: (item[1], item[2], -item[0])
+        )
+    return neighbors
+
+
+def get_neighbors(pitcher_ids):
+    """Cached top-k neighbor lists for `pitcher_ids`, computing only the misses"""
+    cache = get_cache()
+    keys = {neighbors_key(pitcher_id): pitcher_id for pitcher_id in pitcher_ids}
+    found = {keys[key]: value for key, value in cache.get_many(list(keys)).items()}
+    missing = [pitcher_id for pitcher_id in pitcher_ids if pitcher_id not in found]
+    if missing:
+        computed = compute_neighbors(missing)
+        cache.set_many(
+            {neighbors_key(pitcher_id): value for pitcher_id, value in computed.items()},
+            settings.RECOMMENDATIONS_CACHE_TIMEOUT
+        )
+        found.update(computed)
+    return found
+
+
+def similar(pitcher_id, limit):
+    return get_neighbors([pitcher_id])[pitcher_id][:limit]
+
+
+def recommend(user_id, limit):
+    """
+    Pitchers to suggest to `user_id` as (pitcher_id, score): the summed similarity
+    to each of their favorites, excluding pitchers they already follow.
+    """
+    favorites = set(FavoritePitcher.objects.filter(user_id=user_id).values_list('pitcher_id', flat=True))
+    if not favorites:
+        return [(pitcher_id, 0.0) for pitcher_id, _, _ in counters.top('favorites', limit)]
+    scores = defaultdict(float)
+    for neighbors in get_neighbors(sorted(favorites)).values():
+        for other_id, score, _ in neighbors:
+            if other_id not in favorites:
+                scores[other_id] += score
+    return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
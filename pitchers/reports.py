@@ -0,0 +1,435 @@
+"""
+Bulk scouting reports: CSV, HTML and PDF per team or per pitcher.
+
+`generate` builds a `ReportData` once in the parent process. It holds the
+pitcher snapshot, its `MatchupTable` and the archetype names, the only DB
+read. It then fans the work out over a `fork` process pool, one task per team
+(or pitcher), largest first so the pool stays busy to the end. Workers inherit
+the data copy-on-write instead of re-querying the database. The GC is frozen
+before forking so collections don't copy those pages, and heatmaps come from
+the memory-mapped grid store (see `pitchers/heatmaps.py`), whose pages are
+shared through the OS page cache. Tasks are CPU-bound (heatmap rendering,
+PDF/HTML encoding) and share nothing, so throughput scales with the number of
+workers until the disk becomes the limit.
+
+Each worker writes its task's files itself. For `csv`, rows also go back to
+the parent, which appends them to one combined file as each task completes (so
+its rows are in completion order), and no process ever holds every report at
+once. Without `fork` (eg on Windows) the
+tasks run in-process.
+"""
+import base64
+import csv
+import gc
+import html
+import io
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from django.db import connections, transaction
+from django.utils.text import slugify
+
+from .dataset import get_snapshot, team_summaries
+from .matchups import METRICS, MatchupTable
+from .models import DatasetVersion, PitchArchetype
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'html', 'pdf')
+SIDES = (('L', 'LHB'), ('R', 'RHB'))
+CSV_FIELDS = (
+    'team_name', 'player_name', 'throws', 'stand_side', 'pitch_type', 'archetype', 'archetype_name',
+    *(name for metric in METRICS for name in (metric, f"{metric}_delta")),
+)
+HEATMAP_VARIANT = ((), 1.0)
+
+
+class ReportData:
+    """Everything the reports read, built once in the parent and inherited by the pool's workers"""
+
+    def __init__(self, snapshot, archetype_names):
+        self.snapshot = snapshot
+        self.table = MatchupTable(snapshot)
+        self.archetype_names = archetype_names
+        self.summaries = {summary['team_name']: summary for summary in team_summaries(snapshot)}
+        self.pitches = {}
+        self.teams = {}
+        for row in snapshot.rows:
+            self.pitches.setdefault(row.player_name, {})[(row.stand_side, row.pitch_type)] = row
+            self.teams.setdefault(row.player_name, row.team_name)
+
+    def tasks(self, by, names=None):
+        """(kind, name) per team or pitcher, most rows first; `names` limits them"""
+        if by == 'team':
+            sizes = {team: sum(len(self.pitches[name]) for name in staff) for team, staff in self.table.staffs.items()}
+        else:
+            sizes = {name: len(pitches) for name, pitches in self.pitches.items()}
+        if names:
+            sizes = {name: size for name, size in sizes.items() if name in names}
+        return [(by, name) for name in sorted(sizes, key=lambda name: (-sizes[name], name))]
+
+    def pitcher_report(self, player_name):
+        """One pitcher's split report, with each pitch's archetype"""
+        report = self.table.split_report(player_name)
+        for side, split in report['splits'].items():
+            for pitch in split['pitches']:
+                label = self.pitches[player_name][(side, pitch['pitch_type'])].archetype
+                pitch['archetype'] = label
+                pitch['archetype_name'] = self.archetype_names.get(label, '')
+        report['team_name'] = self.teams[player_name]
+        return report
+
+
+_data = None
+_options = None
+
+
+def init_worker(data, options):
+    global _data, _options
+    _data, _options = data, options
+
+
+def build_report(task):
+    """Write the reports of one (kind, name) task; returns (name, CSV rows, seconds)"""
+    started = time.perf_counter()
+    kind, name = task
+    data, options = _data, _options
+    staff = sorted(data.table.staffs[name]) if kind == 'team' else [name]
+    reports = [data.pitcher_report(player_name) for player_name in staff]
+    title = f"{name} scouting report" if kind == 'team' else f"{name} ({data.teams[name]}) scouting report"
+    rows = csv_rows(reports)
+
+    output_dir = Path(options['output_dir'])
+    slug = slugify(name) or 'unnamed'
+    for fmt in options['formats']:
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(CSV_FIELDS)
+            writer.writerows(rows)
+            body = buffer.getvalue().encode()
+        elif fmt == 'html':
+            body = render_html(title, data, kind, name, reports)
+        else:
+            body = render_pdf(title, data, kind, name, reports)
+        write_atomically(output_dir / f"{slug}.{fmt}", body)
+    return name, rows, time.perf_counter() - started
+
+
+def write_atomically(path, body):
+    building = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    building.write_bytes(body)
+    os.replace(building, path)
+
+
+def csv_rows(reports):
+    rows = []
+    for report in reports:
+        for side, split in report['splits'].items():
+            for pitch in split['pitches']:
+                rows.append([
+                    report['team_name'], report['player_name'], report['throws'], side, pitch['pitch_type'],
+                    pitch['archetype'], pitch['archetype_name'],
+                    *(pitch[name] for metric in METRICS for name in (metric, f"{metric}_delta")),
+                ])
+    return rows
+
+
+def heatmap(player_name, pitch_type, side):
+    """`heatmaps.render` arguments for a pitch's default heatmap, or None without a grid store"""
+    from . import heatmaps
+
+    store = heatmaps.get_store()
+    if store is None:
+        return None
+    counts, bandwidth = HEATMAP_VARIANT
+    return store, [heatmaps.group_key(player_name, pitch_type, side)], counts, bandwidth
+
+
+def heatmap_png(player_name, pitch_type, side):
+    from . import heatmaps
+
+    found = heatmap(player_name, pitch_type, side)
+    if found is None:
+        return None
+    store, keys, counts, bandwidth = found
+    return heatmaps.render(store, keys, counts, 'png', bandwidth)
+
+
+def heatmap_rgb(player_name, pitch_type, side):
+    from . import heatmaps
+
+    found = heatmap(player_name, pitch_type, side)
+    if found is None:
+        return None
+    density = heatmaps.density(*found)
+    return None if density is None else heatmaps.render_rgb(density, scale=4)
+
+
+def number(value, delta=None):
+    """'94.1' or '94.1 (+2.3)' for report tables, '-' when missing"""
+    if value is None:
+        return '-'
+    if delta is None:
+        return f"{value:.1f}"
+    return f"{value:.1f} ({delta:+.1f})"
+
+
+def team_line(data, team_name):
+    summary = data.summaries.get(team_name)
+    if summary is None:
+        return ''
+    return (
+        f"{summary['pitchers']} pitchers, {summary['throws']['L']} LHP / {summary['throws']['R']} RHP, "
+        f"avg velocity {number(summary['avg_velocity'])} mph, avg spin {number(summary['avg_spin_rate'])} rpm"
+    )
+
+
+def render_html(title, data, kind, name, reports):
+    escape = html.escape
+    parts = [
+        '<!DOCTYPE html><html><head><meta charset="utf-8">',
+        f"<title>{escape(title)}</title>",
+        '<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse;margin-bottom:1em}'
+        'td,th{border:1px solid #ccc;padding:2px 6px;text-align:right}td:first-child,td:nth-child(2),'
+        'th{text-align:left}img{width:72px;height:72px;image-rendering:pixelated}</style></head><body>',
+        f"<h1>{escape(title)}</h1>",
+        f"<p>{escape(team_line(data, name if kind == 'team' else data.teams[name]))} "
+        f"(dataset v{data.snapshot.version}, deltas vs league average for the same hand and side)</p>",
+    ]
+    for report in reports:
+        parts.append(f"<h2>{escape(report['player_name'])} ({report['throws']}HP)</h2>")
+        for side, label in SIDES:
+            split = report['splits'][side]
+            if not split['pitches']:
+                continue
+            parts.append(
+                f"<h3>vs {label}: zone rate {number(split['zone_rate'], split['zone_rate_delta'])}%</h3>"
+                '<table><tr><th>Pitch</th><th>Archetype</th><th>Usage %</th><th>Velocity</th><th>Spin</th>'
+                '<th>IVB</th><th>HB</th><th>Zone %</th><th>Locations</th></tr>'
+            )
+            for pitch in split['pitches']:
+                png = heatmap_png(report['player_name'], pitch['pitch_type'], side)
+                image = f'<img alt="" src="data:image/png;base64,{base64.b64encode(png).decode()}">' if png else ''
+                parts.append(
+                    f"<tr><td>{pitch['pitch_type']}</td><td>{escape(pitch['archetype_name'] or pitch['archetype'])}</td>"
+                    f"<td>{number(pitch['usage'], pitch['usage_delta'])}</td>"
+                    f"<td>{number(pitch['velocity'], pitch['velocity_delta'])}</td>"
+                    f"<td>{number(pitch['spin_rate'], pitch['spin_rate_delta'])}</td>"
+                    f"<td>{number(pitch['induced_vert_break'], pitch['induced_vert_break_delta'])}</td>"
+                    f"<td>{number(pitch['horz_break'], pitch['horz_break_delta'])}</td>"
+                    f"<td>{number(pitch['zone_rate'], pitch['zone_rate_delta'])}</td><td>{image}</td></tr>"
+                )
+            parts.append('</table>')
+    parts.append('</body></html>')
+    return ''.join(parts).encode()
+
+
+def render_pdf(title, data, kind, name, reports):
+    pdf = PDFWriter()
+    pdf.text(title, size=16, font='F2')
+    pdf.text(team_line(data, name if kind == 'team' else data.teams[name]), size=9)
+    pdf.text(f"Dataset v{data.snapshot.version}; deltas in parentheses are vs the league average.", size=9)
+    for report in reports:
+        pdf.space(10)
+        pdf.text(f"{report['player_name']} ({report['throws']}HP)", size=12, font='F2')
+        for side, label in SIDES:
+            split = report['splits'][side]
+            if not split['pitches']:
+                continue
+            pdf.text(f"vs {label}: zone rate {number(split['zone_rate'], split['zone_rate_delta'])}%", size=9, font='F2')
+            pdf.text(
+                f"{'Pitch':<6}{'Archetype':<26}{'Usage %':<15}{'Velocity':<15}{'Spin':<17}{'IVB':<15}{'Zone %':<15}",
+                size=7, font='F3'
+            )
+            images = []
+            for pitch in split['pitches']:
+                pdf.text(
+                    f"{pitch['pitch_type']:<6}{(pitch['archetype_name'] or pitch['archetype'])[:25]:<26}"
+                    f"{number(pitch['usage'], pitch['usage_delta']):<15}"
+                    f"{number(pitch['velocity'], pitch['velocity_delta']):<15}"
+                    f"{number(pitch['spin_rate'], pitch['spin_rate_delta']):<17}"
+                    f"{number(pitch['induced_vert_break'], pitch['induced_vert_break_delta']):<15}"
+                    f"{number(pitch['zone_rate'], pitch['zone_rate_delta']):<15}",
+                    size=7, font='F3'
+                )
+                rgb = heatmap_rgb(report['player_name'], pitch['pitch_type'], side)
+                if rgb is not None:
+                    images.append((rgb, pitch['pitch_type']))
+            if images:
+                pdf.images(images)
+    return pdf.render()
+
+
+class PDFWriter:
+    """
+    Just enough PDF 1.4 for these reports: lines of Helvetica/Courier text
+    flowing down Letter pages, and rows of captioned RGB images.
+    """
+    WIDTH, HEIGHT = 612, 792
+    MARGIN = 40
+    FONTS = {'F1': 'Helvetica', 'F2': 'Helvetica-Bold', 'F3': 'Courier'}
+
+    def __init__(self):
+        self.pages = []
+        self.images_data = []
+        self.new_page()
+
+    def new_page(self):
+        self.content = []
+        self.pages.append(self.content)
+        self.y = self.HEIGHT - self.MARGIN
+
+    def space(self, height):
+        if self.y - height < self.MARGIN:
+            self.new_page()
+        else:
+            self.y -= height
+
+    def text(self, line, size=10, font='F1'):
+        self.space(size * 1.35)
+        text = line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        self.content.append(f"BT /{font} {size} Tf {self.MARGIN} {self.y:.1f} Td ({text}) Tj ET")
+
+    def images(self, images, size=60, gap=8):
+        """A row of (rgb array, caption) thumbnails, wrapping onto further rows as needed"""
+        per_row = max(1, (self.WIDTH - 2 * self.MARGIN + gap) // (size + gap))
+        for start in range(0, len(images), per_row):
+            self.space(size + 14)
+            for position, (rgb, caption) in enumerate(images[start:start + per_row]):
+                height, width, _ = rgb.shape
+                self.images_data.append((width, height, zlib.compress(rgb.tobytes(), 6)))
+                x = self.MARGIN + position * (size + gap)
+                self.content.append(
+                    f"q {size} 0 0 {size} {x} {self.y:.1f} cm /Im{len(self.images_data) - 1} Do Q "
+                    f"BT /F1 7 Tf {x} {self.y - 9:.1f} Td ({caption}) Tj ET"
+                )
+            self.y -= 12
+
+    def render(self):
+        objects = []
+
+        def add(body):
+            objects.append(body)
+            return len(objects)
+
+        def stream(dictionary, data):
+            return dictionary.encode() + f" /Length {len(data)} >>\nstream\n".encode() + data + b"\nendstream"
+
+        catalog = add(None)
+        pages = add(None)
+        fonts = {
+            name: add(f"<< /Type /Font /Subtype /Type1 /BaseFont /{base} /Encoding /WinAnsiEncoding >>".encode())
+            for name, base in self.FONTS.items()
+        }
+        images = [
+            add(stream(
+                f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceRGB "
+                f"/BitsPerComponent 8 /Filter /FlateDecode", data
+            ))
+            for width, height, data in self.images_data
+        ]
+        resources = (
+            f"<< /Font << {' '.join(f'/{name} {number} 0 R' for name, number in fonts.items())} >> "
+            f"/XObject << {' '.join(f'/Im{index} {number} 0 R' for index, number in enumerate(images))} >> >>"
+        )
+        kids = []
+        for content in self.pages:
+            # WinAnsi is cp1252; anything outside it becomes '?'.
+            data = zlib.compress('\n'.join(content).encode('cp1252', errors='replace'), 6)
+            contents = add(stream('<< /Filter /FlateDecode', data))
+            kids.append(add(
+                f"<< /Type /Page /Parent {pages} 0 R /MediaBox [0 0 {self.WIDTH} {self.HEIGHT}] "
+                f"/Resources {resources} /Contents {contents} 0 R >>".encode()
+            ))
+        objects[catalog - 1] = f"<< /Type /Catalog /Pages {pages} 0 R >>".encode()
+        objects[pages - 1] = (
+            f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>".encode()
+        )
+
+        out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(out))
+            out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+        xref = len(out)
+        out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+        out += b''.join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+        out += f"trailer\n<< /Size {len(objects) + 1} /Root {catalog} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+        return bytes(out)
+
+
+def generate(output_dir, by='team', formats=('csv', 'html'), workers=None, names=None, progress=None):
+    """
+    Write reports for every team (`by='team'`) or pitcher (`by='pitcher'`),
+    optionally only `names`, to `output_dir` using `workers` processes (default:
+    one per CPU). `progress(done, total, name, seconds)` is called as each
+    task completes. Returns a summary dict.
+    """
+    started = time.perf_counter()
+    snapshot = get_snapshot(DatasetVersion.current().version)
+    data = ReportData(snapshot, dict(PitchArchetype.objects.values_list('label', 'name')))
+    tasks = data.tasks(by, names)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    options = {'output_dir': str(output_dir), 'formats': tuple(formats)}
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks) or 1))
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning("Process pools need the 'fork' start method here, running reports in-process")
+        workers = 1
+
+    combined_path = output_dir / f"{by}s-v{snapshot.version}.csv" if 'csv' in formats else None
+    combined = open(combined_path, 'w', newline='') if combined_path else None
+    task_seconds = 0.0
+    pool = None
+    try:
+        if combined:
+            writer = csv.writer(combined)
+            writer.writerow(CSV_FIELDS)
+        if workers == 1:
+            init_worker(data, options)
+            results = map(build_report, tasks)
+        else:
+            # Forked children must not share the parent's DB connections (they never query, but
+            # one mid-transaction stays open), and a frozen GC leaves the inherited snapshot's
+            # pages untouched, so never copied.
+            if not transaction.get_connection().in_atomic_block:
+                connections.close_all()
+            gc.collect()
+            gc.freeze()
+            pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                initializer=init_worker, initargs=(data, options)
+            )
+            # Taken in completion order, not submission order, so a slow task doesn't hold up the
+            # combined CSV and progress of the ones that finished after it.
+            results = (future.result() for future in as_completed([pool.submit(build_report, task) for task in tasks]))
+        for done, (name, rows, seconds) in enumerate(results, start=1):
+            task_seconds += seconds
+            if combined:
+                writer.writerows(rows)
+                combined.flush()
+            if progress:
+                progress(done, len(tasks), name, seconds)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            gc.unfreeze()
+        if combined:
+            combined.close()
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Generated {len(tasks)} {by} reports with {workers} workers in {elapsed:.2f}s")
+    return {
+        'tasks': len(tasks),
+        'workers': workers,
+        'seconds': elapsed,
+        # Busy time over wall time per worker: 1.0 means the pool was never idle.
+        'utilization': task_seconds / (elapsed * workers) if elapsed else 0.0,
+        'combined_csv': str(combined_path) if combined_path else None,
+    }
@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import Pitcher, FavoritePitcher
+from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.db import IntegrityError, transaction
+from .models import Pitcher, FavoritePitcher, Job, PitchArchetype
 import logging
 
 logger = logging.getLogger(__name__)
@@ -11,31 +13,31 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ('id', 'username', 'email', 'password')
         extra_kwargs = {
             'password': {'write_only': True},
-            'email': {'required': True}
+            'email': {'required': True},
+            # Uniqueness is enforced by the database (see `create`), not by an extra lookup per field.
+            'username': {'validators': [UnicodeUsernameValidator()]},
         }
 
-    def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
-            logger.warning(f"Email {value} already exists")
-            raise serializers.ValidationError("A user with this email already exists.")
-        return value
-
-    def validate_username(self, value):
-        if User.objects.filter(username=value).exists():
-            logger.warning(f"Username {value} already exists")
-            raise serializers.ValidationError("A user with this username already exists.")
-        return value
-
     def create(self, validated_data):
         try:
             logger.info(f"Creating user with username: {validated_data.get('username')}")
-            user = User.objects.create_user(
-                username=validated_data['username'],
-                email=validated_data['email'],
-                password=validated_data['password']
+            user = User(
+                username=User.normalize_username(validated_data['username']),
+                email=User.objects.normalize_email(validated_data['email'])
             )
+            # Hash before touching the database, so no transaction is held open while waiting for a hashing slot.
+            user.set_password(validated_data['password'])
+            with transaction.atomic():
+                user.save()
             logger.info(f"Successfully created user: {user.username}")
             return user
+        except IntegrityError as e:
+            # The unique indexes on username and LOWER(email) replace the old exists() pre-checks.
+            if 'auth_user_email_ci_uniq' in str(e):
+                logger.warning(f"Email {validated_data['email']} already exists")
+                raise serializers.ValidationError({'email': ["A user with this email already exists."]})
+            logger.warning(f"Username {validated_data['username']} already exists")
+            raise serializers.ValidationError({'username': ["A user with this username already exists."]})
         except Exception as e:
             logger.error(f"Error in create method: {str(e)}", exc_info=True)
             raise
@@ -45,6 +47,11 @@ class PitcherSerializer(serializers.ModelSerializer):
         model = Pitcher
         fields = '__all__'
 
+class PitchArchetypeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PitchArchetype
+        fields = ('label', 'pitch_type', 'rank', 'name', 'size', 'centroid', 'spread')
+
 class FavoritePitcherSerializer(serializers.ModelSerializer):
     pitcher = PitcherSerializer(read_only=True)
     pitcher_id = serializers.PrimaryKeyRelatedField(
@@ -59,7 +66,8 @@ class FavoritePitcherSerializer(serializers.ModelSerializer):
 
     def validate(self, data):
         logger.info(f"Validating data: {data}")
-        if 'pitcher_id' not in data:
+        # `pitcher_id` is validated into `pitcher` (its source).
+        if 'pitcher' not in data:
             raise serializers.ValidationError(
                 "pitcher_id is required"
             )
@@ -77,4 +85,22 @@ class FavoritePitcherSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError({'pitcher_id': f'Pitcher with id {pitcher_id} does not exist'})
         except Exception as e:
             logger.error(f"Error creating favorite: {str(e)}", exc_info=True)
-            raise 
\ No newline at end of file
+            raise 
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = (
+            'id', 'kind', 'payload', 'status', 'attempts', 'max_attempts', 'progress',
+            'progress_message', 'result', 'error', 'run_after', 'created_at', 'finished_at'
+        )
+        read_only_fields = (
+            'status', 'attempts', 'progress', 'progress_message', 'result', 'error',
+            'run_after', 'created_at', 'finished_at'
+        )
+
+    def validate_kind(self, value):
+        from .jobs import registry
+        if value not in registry:
+            raise serializers.ValidationError(f"Unknown job kind. Choose one of: {', '.join(sorted(registry))}")
+        return value
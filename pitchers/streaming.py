@@ -0,0 +1,110 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# Same output options as DRF's JSONRenderer (compact separators, UTF-8), so streamed rows
+# are identical to the buffered response.
+_encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline-delimited JSON. List endpoints stream rows in this format themselves;
+    the renderer covers everything else (eg error bodies) as a single line.
+    """
+    media_type = NDJSON_CONTENT_TYPE
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return _encoder.encode(data).encode() + b'\n'
+
+
+def wants_stream(request):
+    """
+    Streaming is opt-in: `?stream=json|ndjson`, or negotiating NDJSON via
+    `Accept: application/x-ndjson` / `?format=ndjson`.
+    """
+    mode = request.query_params.get('stream')
+    if mode in ('1', 'true', 'json'):
+        return 'json'
+    if mode == 'ndjson' or request.accepted_renderer.format == 'ndjson':
+        return 'ndjson'
+    return None
+
+
+def iter_rows(queryset, fields, chunk_size=None):
+    """Yield one dict per row without materialising the queryset or model instances"""
+    chunk_size = chunk_size or settings.STREAMING_CHUNK_SIZE
+    for values in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        yield dict(zip(fields, values))
+
+
+def encode_stream(rows, mode, batch_size=None):
+    """
+    Encode `rows` as a JSON array or NDJSON, yielding a bytes chunk per batch.
+
+    Batching keeps the number of write calls (and compressor flushes) low, while
+    memory stays bounded by `batch_size` rows whatever the result size.
+    """
+    batch_size = batch_size or settings.STREAMING_CHUNK_SIZE
+    separator = ',' if mode == 'json' else '\n'
+    batch = []
+    first = True
+    if mode == 'json':
+        yield b'['
+    for row in rows:
+        batch.append(_encoder.encode(row))
+        if len(batch) >= batch_size:
+            yield ((separator if not first else '') + separator.join(batch)).encode()
+            first = False
+            batch = []
+    if batch:
+        yield ((separator if not first else '') + separator.join(batch)).encode()
+        first = False
+    if mode == 'json':
+        yield b']'
+    elif not first:
+        yield b'\n'
+
+
+def is_asgi(request):
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+async def pull_async(chunks):
+    """
+    Async iterator over the sync iterator `chunks`, pulling each chunk through `sync_to_async`.
+
+    Django's ASGI handler reads a sync streaming body with `list()` before sending
+    anything, so under ASGI the stream has to be async for the first rows to go
+    out while the rest are still being read. The pulls run on the thread the view
+    ran on, so the server-side cursor stays on its connection.
+    """
+    chunks = iter(chunks)
+    pull = sync_to_async(next)
+    done = object()
+    try:
+        while (chunk := await pull(chunks, done)) is not done:
+            yield chunk
+    finally:
+        # Closes the cursor when the client goes away mid-stream.
+        if hasattr(chunks, 'close'):
+            await sync_to_async(chunks.close)()
+
+
+def streaming_response(queryset, fields, mode, asynchronous=False):
+    """`asynchronous` streams through `pull_async`, for requests served by the ASGI handler"""
+    content_type = 'application/json' if mode == 'json' else NDJSON_CONTENT_TYPE
+    chunks = encode_stream(iter_rows(queryset, fields), mode)
+    response = StreamingHttpResponse(pull_async(chunks) if asynchronous else chunks, content_type=content_type)
+    # Ask proxies not to buffer the stream, so the first rows reach the client straight away.
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,3 +1,2023 @@
-from django.test import TestCase
+import asyncio
+import contextvars
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import close_old_connections, connections
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from . import archetypes, counters, warming
+from .dataset import clear_snapshot
+from .middleware import compressed_bodies
+from .models import Pitcher, FavoritePitcher, DatasetVersion, Job, PushEvent, PitcherPopularity, PrecomputedArtifact
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def make_pitcher(player_name, **overrides):
+    fields = {
+        'player_name': player_name,
+        'player_image': 'https://img.mlbstatic.com/mlb-photos/image/upload/w_300,q_100/v1/people/554430/headshot/current',
+        'team_name': 'Philadelphia Phillies',
+        'team_logo': 'https://www.mlbstatic.com/team-logos/143.svg',
+        'stand_side': 'R',
+        'pitch_type': 'FF',
+        'velocity_range': '94.0-97.1',
+        'usage_rate': '40.2%',
+        'zone_rate': '55.0%',
+        'avg_spin_rate': 2400.0,
+        'avg_horz_break': -7.5,
+        'avg_induced_vert_break': 15.2,
+        'arm_angle': 35.0,
+        'throws': 'R',
+        'heatmap_path': f"heatmaps/{player_name.replace(', ', '_')}_FF_R.png",
+    }
+    fields.update(overrides)
+    return Pitcher.objects.create(**fields)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, COUNTERS_FLUSH_INTERVAL=None)
+class APITestCase(TestCase):
+    def setUp(self):
+        # Process-level caches are keyed by dataset version, which restarts with every test.
+        clear_snapshot()
+        compressed_bodies.clear()
+        cache.clear()
+        counters.buffer.clear()
+        # Or the exit flush would write it to the development database.
+        self.addCleanup(counters.buffer.clear)
+        warming.clear()
+        self.user = User.objects.create_user(username='scout', email='scout@example.com', password='pw-12345!')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+class CompressionAndConditionalTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(40):
+            make_pitcher(f"Pitcher, Number{i}")
+        DatasetVersion.bump()
+
+    def test_pitcher_list_is_gzipped_above_threshold(self):
+        response = self.client.get('/api/pitchers/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        body = gzip.decompress(response.content)
+        self.assertLess(len(response.content) * 5, len(body))
+
+    def test_brotli_preferred_when_accepted(self):
+        if brotli is None:
+            self.skipTest('brotli is not installed')
+        response = self.client.get('/api/pitchers/', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertTrue(brotli.decompress(response.content).startswith(b'['))
+
+    def test_small_responses_are_not_compressed(self):
+        response = self.client.get('/api/user/info/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_pitcher_list_revalidates_with_dataset_version(self):
+        first = self.client.get('/api/pitchers/')
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+
+        second = self.client.get('/api/pitchers/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(second.status_code, 304)
+
+        DatasetVersion.bump()
+        third = self.client.get('/api/pitchers/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(third.status_code, 200)
+        self.assertNotEqual(third['ETag'], etag)
+
+    def test_favorites_get_content_etag(self):
+        FavoritePitcher.objects.create(user=self.user, pitcher=Pitcher.objects.first())
+        first = self.client.get('/api/favorites/get_all_favorites/', {'username': 'scout'})
+        second = self.client.get(
+            '/api/favorites/get_all_favorites/', {'username': 'scout'}, HTTP_IF_NONE_MATCH=first['ETag']
+        )
+        self.assertEqual(second.status_code, 304)
+
+
+class SnapshotTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pitchers = [make_pitcher(f"Pitcher, Number{i}") for i in range(5)]
+        DatasetVersion.bump()
+
+    def test_snapshot_list_matches_serializer(self):
+        from .serializers import PitcherSerializer
+
+        response = self.client.get('/api/pitchers/')
+        expected = PitcherSerializer(Pitcher.objects.all(), many=True).data
+        self.assertEqual(response.json(), expected)
+
+    def test_snapshot_rows_have_no_instance_dict(self):
+        from .dataset import get_snapshot
+
+        snapshot = get_snapshot(DatasetVersion.current().version)
+        self.assertEqual(len(snapshot), 5)
+        self.assertFalse(hasattr(snapshot.rows[0], '__dict__'))
+        self.assertIs(snapshot.rows[0].team_logo, snapshot.rows[1].team_logo)
+
+    def test_snapshot_rebuilt_after_dataset_bump(self):
+        self.client.get('/api/pitchers/')
+        make_pitcher('Newcomer, Sam')
+        DatasetVersion.bump()
+        names = [row['player_name'] for row in self.client.get('/api/pitchers/').json()]
+        self.assertIn('Newcomer, Sam', names)
+
+    def test_retrieve_from_snapshot(self):
+        pitcher = self.pitchers[2]
+        response = self.client.get(f'/api/pitchers/{pitcher.id}/')
+        self.assertEqual(response.json()['player_name'], pitcher.player_name)
+        self.assertEqual(self.client.get('/api/pitchers/999999/').status_code, 404)
+
+
+class ThrottleTests(APITestCase):
+    @override_settings(REST_FRAMEWORK={
+        'DEFAULT_AUTHENTICATION_CLASSES': ('rest_framework_simplejwt.authentication.JWTAuthentication',),
+        'DEFAULT_THROTTLE_CLASSES': ('pitchers.throttling.UserTokenBucketThrottle',),
+        'DEFAULT_THROTTLE_RATES': {'user': '3/min', 'ip': '100/min', 'signup': '1/min', 'login': '1/min'},
+    })
+    def test_user_bucket_allows_burst_then_throttles(self):
+        statuses = [self.client.get('/api/user/info/').status_code for _ in range(4)]
+        self.assertEqual(statuses, [200, 200, 200, 429])
+        response = self.client.get('/api/user/info/')
+        self.assertGreater(int(response['Retry-After']), 0)
+
+    @override_settings(REST_FRAMEWORK={
+        'DEFAULT_THROTTLE_RATES': {'user': '100/min', 'ip': '100/min', 'signup': '1/min', 'login': '1/min'},
+    })
+    def test_signup_has_its_own_bucket(self):
+        client = APIClient()
+        first = client.post('/api/users/', {'username': 'a1', 'email': 'a1@example.com', 'password': 'pw-12345!'})
+        second = client.post('/api/users/', {'username': 'a2', 'email': 'a2@example.com', 'password': 'pw-12345!'})
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 429)
+
+    def test_spoofed_forwarded_for_shares_the_client_bucket(self):
+        from rest_framework.request import Request
+        from rest_framework.test import APIRequestFactory
+        from .throttling import SignupThrottle
+
+        def cache_key(forwarded_for):
+            request = Request(APIRequestFactory().post('/api/users/', HTTP_X_FORWARDED_FOR=forwarded_for))
+            return SignupThrottle().get_cache_key(request, None)
+
+        # The router appends the real client address; anything before it came from the client.
+        self.assertEqual(cache_key('1.1.1.1, 203.0.113.7'), cache_key('2.2.2.2, 203.0.113.7'))
+        self.assertEqual(cache_key('1.1.1.1, 203.0.113.7'), cache_key('203.0.113.7'))
+        self.assertNotEqual(cache_key('203.0.113.7'), cache_key('203.0.113.8'))
+
+    def test_parse_rate(self):
+        from .throttling import parse_rate
+
+        self.assertEqual(parse_rate('60/min'), (60, 1.0))
+        self.assertEqual(parse_rate('10/s'), (10, 10.0))
+
+
+class SingleFlightTests(TestCase):
+    def test_concurrent_calls_share_one_execution(self):
+        from .coalesce import SingleFlight
+
+        flight = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def work():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return 'result'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', work)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', work))) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+
+    def test_errors_propagate_to_waiters_and_are_not_cached(self):
+        from .coalesce import SingleFlight
+
+        flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do('key', lambda: (_ for _ in ()).throw(ValueError('boom')))
+        self.assertEqual(flight.do('key', lambda: 42), 42)
+
+
+class JobQueueTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        from .jobs import Worker
+
+        self.worker = Worker(retry_backoff=0)
+
+    def run_next(self):
+        claimed = self.worker.claim()
+        self.assertIsNotNone(claimed)
+        self.worker.execute(claimed)
+        return Job.objects.get(pk=claimed.pk)
+
+    def test_staff_enqueue_and_worker_runs_reload(self):
+        rows = [{
+            'player_name': 'Queued, Quinn', 'player_image': 'https://example.com/q.png', 'team_name': 'Team',
+            'team_logo': 'https://example.com/t.svg', 'stand_side': 'L', 'pitch_type': 'SL',
+            'velocity_range': '84.0-86.0', 'usage_rate': '20.0%', 'zone_rate': '40.0%', 'avg_spin_rate': 2500.0,
+            'avg_horz_break': 5.0, 'avg_induced_vert_break': 1.0, 'arm_angle': 30.0, 'throws': 'R',
+            'heatmap_path': 'heatmaps/Queued_Quinn_SL_L.png',
+        }]
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(rows, f)
+        self.addCleanup(os.remove, f.name)
+
+        self.assertEqual(self.client.post('/api/jobs/', {'kind': 'reload_pitchers'}, format='json').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.post(
+            '/api/jobs/', {'kind': 'reload_pitchers', 'payload': {'json_file': f.name}}, format='json'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['status'], Job.QUEUED)
+
+        finished = self.run_next()
+        self.assertEqual(finished.status, Job.SUCCEEDED)
+        self.assertEqual(finished.progress, 1.0)
+        self.assertTrue(Pitcher.objects.filter(player_name='Queued, Quinn').exists())
+        status_response = self.client.get(f'/api/jobs/{finished.pk}/')
+        self.assertEqual(status_response.json()['result']['rows'], 1)
+
+    def test_export_writes_csv_to_storage(self):
+        from django.core.files.storage import default_storage
+        from . import jobs
+
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        pitchers = [make_pitcher(f"Pitcher, Número{i}") for i in range(3)]
+        jobs.enqueue('export_pitchers')
+        with self.settings(MEDIA_ROOT=media):
+            finished = self.run_next()
+            self.assertEqual(finished.status, Job.SUCCEEDED)
+            with default_storage.open(finished.result['path'], 'rb') as f:
+                rows = list(csv.reader(io.StringIO(f.read().decode())))
+        self.assertEqual(rows[0][:2], ['id', 'player_name'])
+        self.assertEqual([row[1] for row in rows[1:]], [pitcher.player_name for pitcher in pitchers])
+
+    def test_unknown_kind_rejected(self):
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.post('/api/jobs/', {'kind': 'mine_bitcoin'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_job_is_retried_then_marked_failed(self):
+        from . import jobs
+
+        queued = jobs.enqueue('reload_pitchers', {'json_file': '/does/not/exist.json'}, max_attempts=2)
+        self.assertEqual(self.run_next().status, Job.QUEUED)
+        failed = self.run_next()
+        self.assertEqual(failed.status, Job.FAILED)
+        self.assertEqual(failed.attempts, 2)
+        self.assertIn('FileNotFoundError', failed.error)
+        self.assertEqual(queued.pk, failed.pk)
+
+    def test_concurrency_limit_per_kind(self):
+        from . import jobs
+
+        jobs.enqueue('reload_pitchers', {'json_file': 'a.json'})
+        jobs.enqueue('reload_pitchers', {'json_file': 'b.json'})
+        self.assertIsNotNone(self.worker.claim())
+        self.assertIsNone(self.worker.claim())
+
+    def test_heartbeat_keeps_long_jobs_from_being_requeued(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from . import jobs
+
+        jobs.enqueue('export_pitchers')
+        jobs.enqueue('export_pitchers')
+        mine, lost = self.worker.claim(), jobs.Worker(name='gone:1').claim()
+        Job.objects.update(locked_at=timezone.now() - timedelta(seconds=self.worker.lock_timeout + 1))
+        self.worker.heartbeat()
+        self.worker.requeue_stale()
+        self.assertEqual(Job.objects.get(pk=mine.pk).status, Job.RUNNING)
+        self.assertEqual(Job.objects.get(pk=lost.pk).status, Job.QUEUED)
+
+    def test_stale_job_without_attempts_left_fails(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from . import jobs
+
+        jobs.enqueue('export_pitchers', max_attempts=2)
+        for attempt in (1, 2):
+            # Each time, the worker running it dies (eg killed for running out of memory).
+            self.assertIsNotNone(jobs.Worker(name=f"gone:{attempt}").claim())
+            Job.objects.update(locked_at=timezone.now() - timedelta(seconds=self.worker.lock_timeout + 1))
+            self.worker.requeue_stale()
+        stale = Job.objects.get()
+        self.assertEqual((stale.status, stale.attempts), (Job.FAILED, 2))
+        self.assertIn('lock expired', stale.error)
+        self.assertIsNone(self.worker.claim())
+
+
+class StreamingTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(7):
+            make_pitcher(f"Pitcher, Number{i}")
+
+    def test_streamed_array_matches_buffered_list(self):
+        buffered = self.client.get('/api/pitchers/').json()
+        with self.settings(STREAMING_CHUNK_SIZE=3):
+            response = self.client.get('/api/pitchers/', {'stream': 'json'})
+            self.assertTrue(response.streaming)
+            body = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(body), buffered)
+
+    def test_ndjson_negotiated_from_accept_header(self):
+        with self.settings(STREAMING_CHUNK_SIZE=2):
+            response = self.client.get('/api/pitchers/', HTTP_ACCEPT='application/x-ndjson')
+            lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(json.loads(lines[0])['player_name'], 'Pitcher, Number0')
+
+    def test_streamed_response_is_compressed_incrementally(self):
+        response = self.client.get('/api/pitchers/', {'stream': 'ndjson'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).splitlines()
+        self.assertEqual(len(lines), 7)
+
+    def test_empty_stream_is_valid_json(self):
+        Pitcher.objects.all().delete()
+        response = self.client.get('/api/pitchers/', {'stream': 'json'})
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), [])
+
+    async def asgi_get(self, path, query_string, headers=()):
+        """
+        Body chunks sent by the ASGI handler, as uvicorn would receive them, and
+        how many rows had been read from the database when the first one was sent.
+        """
+        from django.core.asgi import get_asgi_application
+        from django.core.signals import request_finished, request_started
+        from django.db import close_old_connections
+        from rest_framework_simplejwt.tokens import AccessToken
+        from . import streaming
+
+        token = await sync_to_async(lambda: str(AccessToken.for_user(self.user)))()
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query_string.encode(), 'root_path': '',
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+            'headers': [(b'host', b'testserver'), (b'authorization', f"Bearer {token}".encode()), *headers],
+        }
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        chunks = []
+        rows_read = []
+        read_at_first_chunk = []
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # The handler listens for a disconnect while it responds; the client never leaves.
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                self.assertEqual(message['status'], 200)
+            elif message.get('body'):
+                if not chunks:
+                    read_at_first_chunk.append(len(rows_read))
+                chunks.append(message['body'])
+
+        iter_rows = streaming.iter_rows
+
+        def counted_rows(*args, **kwargs):
+            for row in iter_rows(*args, **kwargs):
+                rows_read.append(row)
+                yield row
+
+        # As the test client does, keep the test's transaction's connection open across the request.
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            with mock.patch.object(streaming, 'iter_rows', counted_rows):
+                await get_asgi_application()(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        return chunks, read_at_first_chunk[0]
+
+    async def test_asgi_handler_streams_chunks(self):
+        with self.settings(STREAMING_CHUNK_SIZE=2):
+            chunks, read_at_first_chunk = await self.asgi_get('/api/pitchers/', 'stream=ndjson')
+        self.assertGreater(len(chunks), 1)
+        self.assertLess(read_at_first_chunk, 7)
+        self.assertEqual(len(b''.join(chunks).splitlines()), 7)
+
+    async def test_asgi_handler_streams_compressed_chunks(self):
+        with self.settings(STREAMING_CHUNK_SIZE=2):
+            chunks, read_at_first_chunk = await self.asgi_get(
+                '/api/pitchers/', 'stream=json', [(b'accept-encoding', b'gzip')]
+            )
+        self.assertGreater(len(chunks), 1)
+        self.assertLess(read_at_first_chunk, 7)
+        self.assertEqual(len(json.loads(gzip.decompress(b''.join(chunks)))), 7)
+
+
+class ConcurrencyLimitTests(TestCase):
+    async def test_requests_wait_for_a_slot_except_event_streams(self):
+        from .middleware import ConcurrencyLimit
+
+        running, peak = set(), {}
+        release = asyncio.Event()
+
+        async def app(scope, receive, send):
+            running.add(scope['path'])
+            peak[scope['path']] = len(running)
+            await release.wait()
+            running.discard(scope['path'])
+
+        limited = ConcurrencyLimit(app, 2, unlimited_paths=('/api/events/',))
+        paths = ['/api/pitchers/1/', '/api/pitchers/2/', '/api/pitchers/3/', '/api/events/']
+        tasks = [asyncio.create_task(limited({'type': 'http', 'path': path}, None, None)) for path in paths]
+        await asyncio.sleep(0.05)
+        # Two slots are taken, the third request waits, and the event stream runs regardless.
+        self.assertEqual(running, {'/api/pitchers/1/', '/api/pitchers/2/', '/api/events/'})
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(set(peak), set(paths))
+
+
+class IngestTests(TestCase):
+    HEADER = 'player_name,pitch_type,stand,p_throws,release_speed,release_spin_rate,pfx_x,pfx_z,zone,arm_angle\n'
+
+    def write_csv(self, rows):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='') as f:
+            f.write(self.HEADER)
+            csv.writer(f).writerows(rows)
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_aggregates_groups_across_chunks(self):
+        from .ingest import aggregate_file
+
+        path = self.write_csv([
+            ('Wheeler, Zack', 'FF', 'R', 'R', 95.0, 2400, -0.5, 1.25, 5, 35.0),
+            ('Wheeler, Zack', 'FF', 'R', 'R', 97.0, 2500, -0.7, 1.35, 14, 36.0),
+            ('Wheeler, Zack', 'CU', 'R', 'R', 80.0, 2700, 0.9, -0.8, '', 34.0),
+            ('Wheeler, Zack', 'FF', 'L', 'R', 96.0, '', -0.6, 1.3, 2, 35.0),
+            ('', 'FF', 'R', 'R', 99.0, 2000, 0, 0, 5, 30),
+        ])
+        rows = {(r['pitch_type'], r['stand_side']): r for r in aggregate_file(path, chunk_size=2).summarise((0, 100))}
+
+        self.assertEqual(len(rows), 3)
+        fastball = rows[('FF', 'R')]
+        self.assertEqual(fastball['velocity_range'], '95.0-97.0')
+        self.assertEqual(fastball['usage_rate'], '66.7%')
+        self.assertEqual(fastball['zone_rate'], '50.0%')
+        self.assertEqual(fastball['avg_spin_rate'], 2450.0)
+        self.assertEqual(fastball['avg_induced_vert_break'], 15.6)
+        self.assertEqual(fastball['heatmap_path'], 'heatmaps/Wheeler_Zack_FF_R.png')
+        # A missing spin value is excluded from the mean rather than counted as zero.
+        self.assertEqual(rows[('FF', 'L')]['avg_spin_rate'], 0.0)
+        self.assertEqual(rows[('CU', 'R')]['zone_rate'], '0.0%')
+
+    def test_command_merges_files_and_upserts(self):
+        from django.core.management import call_command
+
+        first = self.write_csv([('Nola, Aaron', 'CU', 'L', 'R', 79.0, 2800, 1.0, -1.0, 5, 40)])
+        second = self.write_csv([('Nola, Aaron', 'CU', 'L', 'R', 81.0, 2900, 1.0, -1.0, 12, 40)])
+        existing = make_pitcher('Nola, Aaron', pitch_type='CU', stand_side='L', team_name='Philadelphia Phillies')
+
+        call_command('ingest_pitches', first, second, '--workers', '2', stdout=io.StringIO())
+
+        existing.refresh_from_db()
+        self.assertEqual(Pitcher.objects.filter(player_name='Nola, Aaron').count(), 1)
+        self.assertEqual(existing.velocity_range, '79.0-81.0')
+        self.assertEqual(existing.zone_rate, '50.0%')
+        self.assertEqual(existing.avg_spin_rate, 2850.0)
+        # v1 from creating `existing`, v2 from the ingest (bulk writes stamp rows themselves).
+        self.assertEqual(DatasetVersion.current().version, 2)
+        self.assertEqual(existing.row_version, 2)
+
+    def test_command_without_fork_aggregates_in_process(self):
+        from django.core.management import call_command
+
+        first = self.write_csv([('Nola, Aaron', 'CU', 'L', 'R', 79.0, 2800, 1.0, -1.0, 5, 40)])
+        second = self.write_csv([('Nola, Aaron', 'CU', 'L', 'R', 81.0, 2900, 1.0, -1.0, 12, 40)])
+        stderr = io.StringIO()
+        # As on macOS or Windows.
+        with mock.patch('multiprocessing.get_all_start_methods', return_value=['spawn']):
+            call_command('ingest_pitches', first, second, '--workers', '2', stdout=io.StringIO(), stderr=stderr)
+        self.assertIn("'fork'", stderr.getvalue())
+        self.assertEqual(Pitcher.objects.get(player_name='Nola, Aaron').velocity_range, '79.0-81.0')
+
+    def test_load_after_ingest_updates_each_pitch_in_place(self):
+        from django.core.management import call_command
+        from .loading import PITCHER_DATA_FIELDS, load_pitchers
+
+        path = self.write_csv([
+            ('Nola, Aaron', 'CU', 'L', 'R', 79.0, 2800, 1.0, -1.0, 5, 40),
+            ('Nola, Aaron', 'CU', 'R', 'R', 80.0, 2800, 1.0, -1.0, 5, 40),
+            ('Nola, Aaron', 'FF', 'L', 'R', 93.0, 2300, -0.5, 1.2, 5, 40),
+        ])
+        call_command('ingest_pitches', path, stdout=io.StringIO())
+        ingested = {(p.pitch_type, p.stand_side): p.pk for p in Pitcher.objects.all()}
+        rows = [
+            {**{field: getattr(pitcher, field) for field in PITCHER_DATA_FIELDS}, 'player_name': pitcher.player_name}
+            for pitcher in Pitcher.objects.all()
+        ]
+        rows[0]['velocity_range'] = '75.0-77.0'
+        rows.append({**rows[0], 'pitch_type': 'SL', 'heatmap_path': 'heatmaps/Nola_Aaron_SL_L.png'})
+
+        load_pitchers(rows)
+
+        loaded = {(p.pitch_type, p.stand_side): p for p in Pitcher.objects.all()}
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual({key: loaded[key].pk for key in ingested}, ingested)
+        changed = loaded[(rows[0]['pitch_type'], rows[0]['stand_side'])]
+        self.assertEqual(changed.velocity_range, '75.0-77.0')
+
+
+class HeatmapTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        from . import heatmaps
+
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        override = self.settings(HEATMAP_STORE_DIR=self.store_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+        heatmaps._render_cached.cache_clear()
+
+        aggregator = heatmaps.HeatmapAggregator()
+        keys = np.array(['Wheeler, Zack|FF|R'] * 3 + ['Wheeler, Zack|FF|L'])
+        aggregator.add(keys, np.array([0.0, 0.1, -1.0, 0.5]), np.array([2.5, 2.6, 1.0, 3.0]),
+                       np.array([0.0, 3.0, 0.0, 1.0]), np.array([2.0, 2.0, 0.0, 1.0]))
+        self.version = aggregator.write(self.store_dir)
+        self.pitcher = make_pitcher('Wheeler, Zack', stand_side='R')
+
+    def test_grids_bin_locations_by_count(self):
+        from . import heatmaps
+
+        store = heatmaps.get_store()
+        self.assertEqual(store.grid('Wheeler, Zack|FF|R').sum(), 3)
+        self.assertEqual(store.grid('Wheeler, Zack|FF|R', ['0-2', '3-2']).sum(), 2)
+        self.assertIsNone(store.grid('Nobody|FF|R'))
+
+    def test_png_and_svg_rendering(self):
+        png = self.client.get(f'/api/pitchers/{self.pitcher.pk}/heatmap/', {'counts': '0-2'})
+        self.assertEqual(png.status_code, 200)
+        self.assertEqual(png['Content-Type'], 'image/png')
+        self.assertTrue(png.content.startswith(b'\x89PNG'))
+
+        svg = self.client.get(f'/api/pitchers/{self.pitcher.pk}/heatmap/', {'image': 'svg', 'stand': 'all'})
+        self.assertEqual(svg['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', svg.content)
+
+        again = self.client.get(
+            f'/api/pitchers/{self.pitcher.pk}/heatmap/', {'counts': '0-2'}, HTTP_IF_NONE_MATCH=png['ETag']
+        )
+        self.assertEqual(again.status_code, 304)
+
+    def test_rendered_variants_are_cached(self):
+        from . import heatmaps
+
+        for _ in range(3):
+            self.client.get(f'/api/pitchers/{self.pitcher.pk}/heatmap/')
+        info = heatmaps._render_cached.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 2))
+
+    def test_invalid_filters_and_missing_grid(self):
+        response = self.client.get(f'/api/pitchers/{self.pitcher.pk}/heatmap/', {'counts': '4-0', 'image': 'gif'})
+        self.assertEqual(set(response.json()), {'counts', 'image'})
+        for bandwidth in ('nan', 'inf', '-inf', 'wide'):
+            response = self.client.get(f'/api/pitchers/{self.pitcher.pk}/heatmap/', {'bandwidth': bandwidth})
+            self.assertEqual((response.status_code, set(response.json())), (400, {'bandwidth'}))
+        other = make_pitcher('Nola, Aaron')
+        missing = self.client.get(f'/api/pitchers/{other.pk}/heatmap/')
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(missing.json()['heatmap_path'], other.heatmap_path)
+
+    def test_new_store_version_replaces_old_grids(self):
+        from . import heatmaps
+
+        aggregator = heatmaps.HeatmapAggregator()
+        aggregator.add(np.array(['Wheeler, Zack|FF|R']), np.array([0.0]), np.array([2.0]), np.array([0.0]), np.array([0.0]))
+        self.assertEqual(aggregator.write(self.store_dir), self.version + 1)
+        self.assertEqual(sorted(os.listdir(self.store_dir)), ['grids-v2.npy', 'index.json'])
+
+    def test_render_after_a_store_swap_is_not_cached_under_the_old_version(self):
+        from . import heatmaps
+
+        store = heatmaps.get_store()
+        before = heatmaps.render(store, ['Wheeler, Zack|FF|R'], None, 'svg', 1.0)
+        heatmaps._render_cached.cache_clear()
+        # A new store is written after this request looked up the old one.
+        aggregator = heatmaps.HeatmapAggregator()
+        aggregator.add(np.array(['Wheeler, Zack|FF|R']), np.array([1.0]), np.array([1.5]), np.array([0.0]), np.array([0.0]))
+        aggregator.write(self.store_dir)
+
+        self.assertEqual(heatmaps.render(store, ['Wheeler, Zack|FF|R'], None, 'svg', 1.0), before)
+        self.assertEqual(heatmaps._render_cached.cache_info().currsize, 0)
+
+
+class DeltaSyncTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.first = make_pitcher('Wheeler, Zack')
+        self.second = make_pitcher('Nola, Aaron')
+        self.version = DatasetVersion.current().version
+
+    def test_saves_are_stamped_and_published(self):
+        self.assertEqual(self.version, 2)
+        self.assertEqual((self.first.row_version, self.second.row_version), (1, 2))
+
+    def test_changes_since_version(self):
+        self.first.velocity_range = '95.0-98.0'
+        self.first.save()
+        response = self.client.get(f"/api/pitchers/changes/?since={self.version}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['version'], self.version + 1)
+        self.assertEqual([row['id'] for row in response.data['upserts']], [self.first.pk])
+        self.assertEqual(response.data['upserts'][0]['velocity_range'], '95.0-98.0')
+        self.assertEqual(response.data['deletes'], [])
+
+        etag = response['ETag']
+        response = self.client.get(f"/api/pitchers/changes/?since={self.version}", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_deletes_leave_tombstones(self):
+        pk = self.second.pk
+        self.second.delete()
+        response = self.client.get(f"/api/pitchers/changes/?since={self.version}")
+        self.assertEqual(response.data['upserts'], [])
+        self.assertEqual(response.data['deletes'], [pk])
+
+    def test_grouped_change_publishes_one_version(self):
+        from .loading import load_pitchers
+        rows = [
+            {**{field: getattr(self.first, field) for field in ('player_image', 'team_name', 'team_logo', 'stand_side',
+             'pitch_type', 'velocity_range', 'usage_rate', 'zone_rate', 'avg_spin_rate', 'avg_horz_break',
+             'avg_induced_vert_break', 'arm_angle', 'throws', 'heatmap_path')}, 'player_name': name}
+            for name in ('Sanchez, Cristopher', 'Suarez, Ranger')
+        ]
+        # Loads recluster archetypes, which would otherwise also update the existing rows.
+        archetypes.assign()
+        version = DatasetVersion.current().version
+        dataset = load_pitchers(rows)
+        self.assertEqual(dataset.version, version + 1)
+        response = self.client.get(f"/api/pitchers/changes/?since={version}")
+        self.assertEqual(len(response.data['upserts']), 2)
+
+    def test_reload_records_updates_and_tombstones(self):
+        from .loading import PITCHER_DATA_FIELDS, load_pitchers
+
+        # Another pitch type, so dropping it doesn't recluster the fastballs.
+        third = make_pitcher('Sanchez, Cristopher', pitch_type='CH')
+        rows = [
+            {**{field: getattr(pitcher, field) for field in PITCHER_DATA_FIELDS}, 'player_name': pitcher.player_name}
+            for pitcher in (self.first, self.second, third)
+        ]
+        archetypes.assign()
+        version = DatasetVersion.current().version
+        # The reloaded file moves the first row to another team (which leaves the archetypes as they
+        # are), keeps the second and drops the third.
+        rows[0]['team_name'] = 'New York Mets'
+        dataset = load_pitchers(rows[:2])
+
+        self.assertEqual(dataset.version, version + 1)
+        response = self.client.get(f"/api/pitchers/changes/?since={version}")
+        self.assertEqual([row['id'] for row in response.data['upserts']], [self.first.pk])
+        self.assertEqual(response.data['upserts'][0]['team_name'], 'New York Mets')
+        self.assertEqual(response.data['deletes'], [third.pk])
+
+    def test_snapshot_required_when_out_of_range(self):
+        with self.settings(DELTA_SYNC_MAX_ROWS=1):
+            response = self.client.get('/api/pitchers/changes/?since=0')
+        self.assertTrue(response.data['snapshot_required'])
+        self.assertTrue(response.data['snapshot_url'].endswith('/api/pitchers/'))
+
+        response = self.client.get(f"/api/pitchers/changes/?since={self.version + 5}")
+        self.assertTrue(response.data['snapshot_required'])
+
+        self.assertEqual(self.client.get('/api/pitchers/changes/?since=abc').status_code, 400)
+
+
+@override_settings(EVENTS_BACKEND='pitchers.events.LocalBackend', EVENTS_KEEPALIVE=0.2)
+class EventStreamTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        from rest_framework_simplejwt.tokens import AccessToken
+        self.token = str(AccessToken.for_user(self.user))
+
+    async def read_event(self, stream):
+        return (await anext(stream)).decode()
+
+    def test_requires_authentication(self):
+        self.assertEqual(Client().get('/api/events/').status_code, 401)
+        self.assertEqual(Client().get('/api/events/?token=nope').status_code, 401)
+
+    async def test_pushes_dataset_and_favorites_events(self):
+        from . import events
+
+        response = await AsyncClient().get(f"/api/events/?token={self.token}")
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertTrue((await self.read_event(stream)).startswith('retry: '))
+        self.assertIn('event: dataset\nid: 0\ndata: {"version":0}', await self.read_event(stream))
+
+        broker = events.get_broker()
+        broker.publish(events.user_channel(self.user.pk + 1), {'action': 'save'})
+        broker.publish(events.user_channel(self.user.pk), {'action': 'save'})
+        self.assertEqual(await self.read_event(stream), 'event: favorites\ndata: {"action":"save"}\n\n')
+        self.assertEqual(await self.read_event(stream), ': keepalive\n\n')
+        broker.publish('dataset', {'version': 3})
+        self.assertIn('id: 3', await self.read_event(stream))
+
+    async def test_closing_stream_unsubscribes(self):
+        from . import events
+
+        stream = events.event_stream(self.user)
+        await anext(stream)
+        self.assertEqual(events.get_broker().subscriber_count(), 1)
+        await stream.aclose()
+        self.assertEqual(events.get_broker().subscriber_count(), 0)
+
+    @override_settings(EVENTS_BACKEND='pitchers.events.DatabaseBackend')
+    def test_writes_publish_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            make_pitcher('Wheeler, Zack')
+            self.client.post('/api/favorites/save_favorites/?username=scout', {'pitcher_names': ['Wheeler, Zack']}, format='json')
+        self.assertEqual(
+            list(PushEvent.objects.order_by('id').values_list('channel', 'data')),
+            [('dataset', {'version': 1}), (f"favorites:{self.user.pk}", {'action': 'save'})]
+        )
+
+
+# The poller manages its own database connection, so it can't share a test transaction.
+@override_settings(
+    SECURE_SSL_REDIRECT=False, COUNTERS_FLUSH_INTERVAL=None,
+    EVENTS_BACKEND='pitchers.events.DatabaseBackend', EVENTS_POLL_INTERVAL=0.01, EVENTS_KEEPALIVE=5,
+)
+class EventPollerTests(TransactionTestCase):
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import AccessToken
+        self.user = User.objects.create_user(username='scout', email='scout@example.com', password='pw-12345!')
+        self.token = str(AccessToken.for_user(self.user))
+
+    async def test_database_backend_relays_events(self):
+        from . import events
+
+        request = contextvars.ContextVar('request')
+        request.set('first subscriber')
+        with mock.patch('pitchers.events.close_old_connections', wraps=close_old_connections) as close:
+            response = await AsyncClient().get('/api/events/', headers={'Authorization': f"Bearer {self.token}"})
+            stream = aiter(response.streaming_content)
+            await anext(stream)
+            await anext(stream)
+            # As if written by another process (eg `run_jobs` finishing a reload).
+            await PushEvent.objects.acreate(channel='dataset', data={'version': 7})
+            self.assertIn('data: {"version":7}', (await anext(stream)).decode())
+            await response.streaming_content.aclose()
+        poller = events.get_broker().backend._task
+        self.assertIsNone(poller.get_context().get(request))
+        self.assertGreaterEqual(close.call_count, 4)
+
+
+class RecommendationTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pitchers = {name: make_pitcher(name) for name in ('A', 'B', 'C', 'D')}
+        self.users = [self.user] + [
+            User.objects.create_user(username=f"fan{i}", email=f"fan{i}@example.com", password='pw-12345!')
+            for i in range(3)
+        ]
+
+    def follow(self, user, *names):
+        with self.captureOnCommitCallbacks(execute=True):
+            for name in names:
+                FavoritePitcher.objects.create(user=user, pitcher=self.pitchers[name])
+
+    def cooccurrence(self):
+        from .models import PitcherCooccurrence
+        return {
+            (i, j): count for i, j, count in
+            PitcherCooccurrence.objects.filter(count__gt=0).values_list('pitcher__player_name', 'other__player_name', 'count')
+        }
+
+    def test_incremental_counts_match_rebuild(self):
+        from . import recommendations
+
+        self.follow(self.users[1], 'A', 'B', 'C')
+        self.follow(self.users[2], 'A', 'B')
+        self.follow(self.users[3], 'B', 'D')
+        with self.captureOnCommitCallbacks(execute=True):
+            FavoritePitcher.objects.filter(user=self.users[1], pitcher__player_name='C').delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[3].delete()
+        incremental = self.cooccurrence()
+        self.assertEqual(incremental, {('A', 'A'): 2, ('B', 'B'): 2, ('A', 'B'): 2, ('B', 'A'): 2})
+
+        recommendations.rebuild()
+        self.assertEqual(self.cooccurrence(), incremental)
+
+    def test_similar_and_recommended(self):
+        self.follow(self.users[1], 'A', 'B', 'C')
+        self.follow(self.users[2], 'A', 'B')
+        self.follow(self.users[3], 'C', 'D')
+
+        response = self.client.get(f"/api/pitchers/{self.pitchers['A'].pk}/similar/")
+        self.assertEqual([row['pitcher']['player_name'] for row in response.data], ['B', 'C'])
+        self.assertEqual(response.data[0]['shared_favorites'], 2)
+        self.assertAlmostEqual(response.data[0]['score'], 1.0)
+
+        # No favorites yet: most favorited first.
+        counters.buffer.flush()
+        response = self.client.get('/api/favorites/recommendations/?limit=2')
+        self.assertEqual([row['pitcher']['player_name'] for row in response.data], ['A', 'B'])
+
+        self.follow(self.user, 'A')
+        response = self.client.get('/api/favorites/recommendations/')
+        self.assertEqual([row['pitcher']['player_name'] for row in response.data], ['B', 'C'])
+
+        self.assertEqual(self.client.get('/api/favorites/recommendations/?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/pitchers/999/similar/').status_code, 404)
+
+    def test_recommendations_are_served_from_cache(self):
+        self.follow(self.users[1], 'A', 'B')
+        self.follow(self.user, 'A')
+        self.client.get('/api/favorites/recommendations/')
+        # One query for the user's favorites, one for the dataset version; neighbors come from the cache.
+        with self.assertNumQueries(2):
+            self.client.get('/api/favorites/recommendations/')
+
+
+class FavoriteBitsetTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pitchers = {name: make_pitcher(name) for name in ('A', 'B', 'C', 'D')}
+        self.fans = [
+            User.objects.create_user(username=f"fan{i}", email=f"fan{i}@example.com", password='pw-12345!')
+            for i in range(2)
+        ]
+
+    def follow(self, user, *names):
+        with self.captureOnCommitCallbacks(execute=True):
+            for name in names:
+                FavoritePitcher.objects.create(user=user, pitcher=self.pitchers[name])
+
+    def ids(self, *names):
+        return sorted(self.pitchers[name].pk for name in names)
+
+    def test_bitsets_track_favorites(self):
+        from . import bitsets, recommendations
+
+        self.assertEqual(bitsets.members(bitsets.decode(bitsets.encode([3, 9, 64]))), [3, 9, 64])
+        self.follow(self.fans[0], 'A', 'C')
+        self.assertEqual(bitsets.members(bitsets.get(self.fans[0].pk)), self.ids('A', 'C'))
+        with self.captureOnCommitCallbacks(execute=True):
+            FavoritePitcher.objects.filter(user=self.fans[0], pitcher=self.pitchers['A']).delete()
+        self.assertEqual(bitsets.members(bitsets.get(self.fans[0].pk)), self.ids('C'))
+
+        # Cache misses are read back from the table, all users in one query.
+        cache.clear()
+        with self.assertNumQueries(1):
+            bits = bitsets.get_many([self.fans[0].pk, self.fans[1].pk])
+        self.assertEqual(bits, {self.fans[0].pk: 1 << self.pitchers['C'].pk, self.fans[1].pk: 0})
+        with self.captureOnCommitCallbacks(execute=True):
+            recommendations.rebuild()
+        self.assertEqual(bitsets.members(bitsets.get(self.fans[0].pk)), self.ids('C'))
+
+    def test_list_annotated_with_favorites(self):
+        self.follow(self.user, 'B', 'D')
+        plain = self.client.get('/api/pitchers/')
+        response = self.client.get('/api/pitchers/', {'annotate': 'is_favorite'})
+        rows = response.json()
+        self.assertEqual([row['id'] for row in rows if row['is_favorite']], self.ids('B', 'D'))
+        self.assertEqual([{**row, 'is_favorite': None} for row in plain.json()], [{**row, 'is_favorite': None} for row in rows])
+        self.assertNotEqual(response['ETag'], plain['ETag'])
+
+        self.follow(self.user, 'A')
+        again = self.client.get('/api/pitchers/', {'annotate': 'is_favorite'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(sum(row['is_favorite'] for row in again.json()), 3)
+
+    def test_compare_users(self):
+        self.follow(self.fans[0], 'A', 'B', 'C')
+        self.follow(self.fans[1], 'B', 'C', 'D')
+        self.follow(self.user, 'C')
+
+        def compare(**params):
+            return self.client.get('/api/favorites/compare/', params)
+
+        shared = compare(usernames='fan0,fan1').json()
+        self.assertEqual([pitcher['id'] for pitcher in shared['pitchers']], self.ids('B', 'C'))
+        everything = compare(usernames='fan0,fan1', op='union').json()
+        self.assertEqual(everything['count'], 4)
+        with_me = compare(usernames='fan1').json()
+        self.assertEqual((with_me['usernames'], with_me['count']), (['scout', 'fan1'], 1))
+        self.assertEqual(compare(usernames='fan0,nobody').status_code, 404)
+        self.assertEqual(set(compare(usernames='', op='xor').json()), {'usernames', 'op'})
+
+
+class FavoritesWriteTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pitchers = [make_pitcher(f"Pitcher, Number{i}") for i in range(4)]
+
+    def save(self, *pitchers, **headers):
+        return self.client.post(
+            '/api/favorites/save_favorites/?username=scout',
+            {'pitcher_names': [pitcher.player_name for pitcher in pitchers]}, format='json', headers=headers
+        )
+
+    def test_saves_only_touch_changed_rows(self):
+        first, second, third, _ = self.pitchers
+        response = self.save(first, second)
+        self.assertEqual((response.json()['version'], response['ETag']), (1, '"favorites-v1"'))
+        kept = FavoritePitcher.objects.get(user=self.user, pitcher=first).pk
+
+        response = self.save(first, third)
+        self.assertEqual((response.json()['added'], response.json()['removed'], response.json()['version']), (1, 1, 2))
+        self.assertEqual(FavoritePitcher.objects.get(user=self.user, pitcher=first).pk, kept)
+        # Saving the same list again changes nothing, so the version stays.
+        self.assertEqual(self.save(first, third).json()['version'], 2)
+
+        created = self.client.post('/api/favorites/', {'pitcher_id': second.pk}, format='json')
+        again = self.client.post('/api/favorites/', {'pitcher_id': second.pk}, format='json')
+        self.assertEqual((created.status_code, again.status_code), (201, 200))
+        self.assertEqual(created.json()['id'], again.json()['id'])
+
+    def test_if_match_rejects_stale_writes(self):
+        first, second = self.pitchers[:2]
+        version = self.client.get('/api/favorites/get_all_favorites/', {'username': 'scout'}).json()['version']
+        self.assertEqual(self.save(first, **{'If-Match': f'"favorites-v{version}"'}).status_code, 200)
+        stale = self.save(second, **{'If-Match': f'"favorites-v{version}"'})
+        self.assertEqual(stale.status_code, 412)
+        self.assertEqual((stale.json()['version'], stale['ETag']), (1, '"favorites-v1"'))
+        self.assertEqual(list(FavoritePitcher.objects.values_list('pitcher_id', flat=True)), [first.pk])
+        response = self.client.delete('/api/favorites/clear_all/?username=scout', headers={'If-Match': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_idempotency_key_replays_response(self):
+        first, second = self.pitchers[:2]
+        response = self.save(first, **{'Idempotency-Key': 'save-1'})
+        # Another device changes the list before the first one's retry arrives.
+        self.save(second)
+        retry = self.save(first, **{'Idempotency-Key': 'save-1'})
+        self.assertEqual((retry.status_code, retry['Idempotent-Replayed']), (200, 'true'))
+        self.assertEqual((retry.json(), retry['ETag']), (response.json(), response['ETag']))
+        self.assertEqual(list(FavoritePitcher.objects.values_list('pitcher_id', flat=True)), [second.pk])
+        self.assertEqual(self.save(second, **{'Idempotency-Key': 'save-1'}).status_code, 422)
+
+    def save_names(self, names, **headers):
+        return self.client.post(
+            '/api/favorites/save_favorites/?username=scout', {'pitcher_names': names}, format='json', headers=headers
+        )
+
+    def test_stale_save_creates_no_placeholders(self):
+        self.save(self.pitchers[0])
+        dataset_version, pitchers = DatasetVersion.current().version, Pitcher.objects.count()
+        stale = self.save_names(['Newcomer, Sam'], **{'If-Match': '"favorites-v0"'})
+        self.assertEqual(stale.status_code, 412)
+        self.assertEqual((DatasetVersion.current().version, Pitcher.objects.count()), (dataset_version, pitchers))
+
+    def test_placeholders_are_published_before_the_idempotent_write(self):
+        from django.db import connection
+        from . import changes
+
+        publish_version = changes.publish_version
+        depths = []
+
+        def publish(version):
+            depths.append(len(connection.atomic_blocks))
+            return publish_version(version)
+
+        outside = len(connection.atomic_blocks)
+        with mock.patch.object(changes, 'publish_version', publish):
+            response = self.save_names(['Newcomer, Sam'], **{'Idempotency-Key': 'save-new'})
+            retry = self.save_names(['Newcomer, Sam'], **{'Idempotency-Key': 'save-new'})
+        self.assertEqual((response.status_code, response.json()['added']), (200, 1))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        # Published once, and not from inside the transaction holding the favorites lock and the key.
+        self.assertEqual(depths, [outside])
+        self.assertEqual(Pitcher.objects.filter(player_name='Newcomer, Sam').count(), 1)
+
+
+class CounterTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pitchers = [make_pitcher(f"Pitcher, Number{i}") for i in range(30)]
+
+    def save_favorites(self, username, *pitchers):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f"/api/favorites/save_favorites/?username={username}",
+                {'pitcher_names': [pitcher.player_name for pitcher in pitchers]}, format='json'
+            )
+
+    def counts(self):
+        from .models import PitcherPopularity
+        return dict(PitcherPopularity.objects.filter(favorite_count__gt=0).values_list('pitcher_id', 'favorite_count'))
+
+    def test_counts_follow_favorite_diffs(self):
+        from .models import PitcherActivity
+
+        first, second, third = self.pitchers[:3]
+        User.objects.create_user(username='fan', email='fan@example.com', password='pw-12345!')
+        self.save_favorites('scout', first, second)
+        self.save_favorites('fan', first)
+        counters.buffer.flush()
+        self.assertEqual(self.counts(), {first.pk: 2, second.pk: 1})
+
+        # Re-saving an overlapping list only counts the difference.
+        self.save_favorites('scout', first, third)
+        counters.buffer.flush()
+        self.assertEqual(self.counts(), {first.pk: 2, third.pk: 1})
+        self.assertEqual(sum(PitcherActivity.objects.values_list('count', flat=True)), 4)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete('/api/favorites/clear_all/?username=fan')
+        counters.buffer.flush()
+        self.assertEqual(self.counts(), {first.pk: 1, third.pk: 1})
+        self.assertEqual(counters.reconcile(), 2)
+        self.assertEqual(self.counts(), {first.pk: 1, third.pk: 1})
+
+    def test_flush_cost_does_not_grow_with_pitchers(self):
+        # The first flush also prunes expired trending buckets.
+        counters.buffer.record(added=[self.pitchers[0].pk])
+        counters.buffer.flush()
+
+        def queries_for(pitchers):
+            counters.buffer.record(added=[pitcher.pk for pitcher in pitchers])
+            with self.assertNumQueries(7) as context:
+                counters.buffer.flush()
+            return len(context.captured_queries)
+
+        self.assertEqual(queries_for(self.pitchers[:3]), queries_for(self.pitchers[3:]))
+
+    def test_trending_decays_and_is_served_sorted(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .models import PitcherActivity, PitcherPopularity
+
+        old, recent = self.pitchers[:2]
+        now = timezone.now()
+        PitcherActivity.objects.create(pitcher=old, bucket=counters.bucket_start((now - timedelta(hours=25)).timestamp()), count=4)
+        PitcherActivity.objects.create(pitcher=recent, bucket=counters.bucket_start(now.timestamp()), count=1)
+        PitcherActivity.objects.create(pitcher=recent, bucket=counters.bucket_start((now - timedelta(days=3)).timestamp()), count=50)
+        PitcherPopularity.objects.create(pitcher=old, favorite_count=4)
+        PitcherPopularity.objects.create(pitcher=recent, favorite_count=1)
+
+        response = self.client.get('/api/pitchers/trending/')
+        self.assertEqual([row['pitcher']['id'] for row in response.data], [recent.pk, old.pk])
+        # Four half-lives old, give or take the bucket width.
+        self.assertTrue(4 * 0.5 ** (25 / 6) <= response.data[1]['trending_score'] <= 4 * 0.5 ** 4)
+        # Buckets past the window are ignored by reads, and pruned by the next flush.
+        self.assertEqual(PitcherActivity.objects.count(), 3)
+        counters.buffer.record(added=[old.pk])
+        counters.buffer.flush()
+        self.assertEqual(PitcherActivity.objects.filter(pitcher=recent).count(), 1)
+
+        response = self.client.get('/api/pitchers/trending/?by=favorites&limit=1')
+        self.assertEqual([(row['pitcher']['id'], row['favorite_count']) for row in response.data], [(old.pk, 5)])
+        self.assertEqual(self.client.get('/api/pitchers/trending/?by=nope').status_code, 400)
+
+    def test_exit_flushes_buffered_changes(self):
+        counters.buffer.record(added=[self.pitchers[0].pk])
+        # As atexit and gunicorn's `worker_exit` do when the process stops.
+        counters.flush_at_exit()
+        self.assertEqual(self.counts(), {self.pitchers[0].pk: 1})
+
+
+class SignupTests(APITestCase):
+    def signup(self, username, email):
+        return APIClient().post('/api/users/', {'username': username, 'email': email, 'password': 'pw-12345!'})
+
+    def test_duplicates_are_rejected_by_the_database(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.signup('newcomer', 'Newcomer@Example.com')
+        self.assertEqual(response.status_code, 201)
+        # No exists() pre-checks: the only statement touching auth_user is the INSERT.
+        self.assertEqual([query['sql'].split()[0] for query in context.captured_queries if 'auth_user' in query['sql']], ['INSERT'])
+
+        response = self.signup('other', 'NEWCOMER@example.COM')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.data)
+        response = self.signup('newcomer', 'someone@example.com')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('username', response.data)
+
+    def test_blank_emails_do_not_conflict(self):
+        User.objects.create_user(username='no-email-1', email='')
+        User.objects.create_user(username='no-email-2', email='')
+
+    @override_settings(PASSWORD_HASH_QUEUE_TIMEOUT=0.01)
+    def test_hashing_is_bounded(self):
+        from .hashers import hash_slots
+
+        slots = hash_slots()
+        slots.acquire()
+        try:
+            response = self.signup('queued', 'queued@example.com')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+            response = APIClient().post('/api/token/', {'username': 'scout', 'password': 'pw-12345!'})
+            self.assertEqual(response.status_code, 503)
+            # The admin login hashes outside DRF, so the middleware answers it.
+            response = Client().post('/admin/login/', {'username': 'scout', 'password': 'pw-12345!'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '1')
+        finally:
+            slots.release()
+        response = APIClient().post('/api/token/', {'username': 'scout', 'password': 'pw-12345!'})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(PASSWORD_HASH_QUEUE_TIMEOUT=5, PASSWORD_HASH_MAX_WAITING=1)
+    def test_hashing_rejects_at_once_when_the_line_is_full(self):
+        from . import hashers
+
+        slots = hashers.hash_slots()
+        slots.acquire()
+        waiter = threading.Thread(target=lambda: hashers.acquire_slot() and slots.release())
+        try:
+            waiter.start()
+            while hashers._waiting < 1:
+                time.sleep(0.01)
+            started = time.perf_counter()
+            response = self.signup('turned-away', 'turned-away@example.com')
+            self.assertEqual(response.status_code, 503)
+            # Turned away without waiting out the queue timeout, so its thread is free again.
+            self.assertLess(time.perf_counter() - started, 1)
+        finally:
+            slots.release()
+            waiter.join()
+
+
+# The admin templates reference static files, which have no manifest until `collectstatic` runs.
+@override_settings(STORAGES={
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+})
+class AdminTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='pw-12345!')
+        self.browser = Client()
+        self.browser.force_login(self.admin)
+        self.pitchers = [make_pitcher(f"Pitcher, Number{i}", team_name=f"Team {i % 3}") for i in range(6)]
+
+    def add_favorites(self, count):
+        for i in range(count):
+            user = User.objects.create_user(username=f"fan{len(FavoritePitcher.objects.all())}-{i}", email='')
+            FavoritePitcher.objects.create(user=user, pitcher=self.pitchers[i % len(self.pitchers)])
+
+    def changelist_queries(self, url):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.browser.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries]
+
+    def test_favorites_changelist_queries_do_not_grow_with_rows(self):
+        self.add_favorites(3)
+        few = self.changelist_queries('/admin/pitchers/favoritepitcher/')
+        self.add_favorites(20)
+        many = self.changelist_queries('/admin/pitchers/favoritepitcher/')
+        self.assertEqual(len(few), len(many))
+        # Raw id / autocomplete widgets instead of selects listing every user and pitcher.
+        response = self.browser.get('/admin/pitchers/favoritepitcher/add/')
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+        self.assertContains(response, 'admin-autocomplete')
+
+    def test_filter_choices_are_cached(self):
+        first = self.changelist_queries('/admin/pitchers/pitcher/')
+        self.assertTrue(any('DISTINCT' in sql for sql in first))
+        second = self.changelist_queries('/admin/pitchers/pitcher/')
+        self.assertFalse(any('DISTINCT' in sql for sql in second))
+        response = self.browser.get('/admin/pitchers/pitcher/?team_name=Team+1')
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+
+    @override_settings(ADMIN_COUNT_LIMIT=4)
+    def test_counts_are_bounded(self):
+        response = self.browser.get('/admin/pitchers/pitcher/?q=Pitcher')
+        self.assertEqual(response.context['cl'].result_count, 4)
+        self.assertFalse(any('COUNT' in sql and 'LIMIT' not in sql for sql in self.changelist_queries('/admin/pitchers/pitcher/?q=Pitcher')))
+
+
+class ArchetypeTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        # Two kinds of four-seamer: hard with lots of ride, and softer from a low slot with less.
+        for i in range(12):
+            make_pitcher(
+                f"Riser, Number{i}", velocity_range=f"{95 + i % 3}.0-{97 + i % 3}.5",
+                avg_spin_rate=2500.0 + i * 5, avg_induced_vert_break=18.0 + i % 4 * 0.3, arm_angle=45.0 + i % 2
+            )
+            make_pitcher(
+                f"Slinger, Number{i}", velocity_range=f"{89 + i % 3}.0-{91 + i % 3}.5",
+                avg_spin_rate=2150.0 + i * 5, avg_induced_vert_break=10.0 + i % 4 * 0.3, arm_angle=15.0 + i % 2
+            )
+        make_pitcher('Placeholder, Pat', avg_spin_rate=0.0)
+        self.settings_override = override_settings(ARCHETYPES_PER_PITCH_TYPE=2)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_clusters_are_deterministic_and_named(self):
+        from .models import PitchArchetype
+
+        self.assertEqual(archetypes.assign(), 2)
+        riser, slinger = PitchArchetype.objects.filter(pitch_type='FF')
+        self.assertEqual((riser.label, riser.size), ('FF-1', 12))
+        self.assertIn('riding four-seamer', riser.name)
+        self.assertIn('low-slot', slinger.name)
+        self.assertEqual(set(Pitcher.objects.filter(archetype='FF-2').values_list('player_name', flat=True)),
+                         {f"Slinger, Number{i}" for i in range(12)})
+        self.assertEqual(Pitcher.objects.get(player_name='Placeholder, Pat').archetype, '')
+        assigned = dict(Pitcher.objects.values_list('id', 'archetype_distance'))
+        version = DatasetVersion.current().version
+        # Reclustering the same data changes nothing, so no new dataset version is published.
+        archetypes.assign()
+        self.assertEqual(dict(Pitcher.objects.values_list('id', 'archetype_distance')), assigned)
+        self.assertEqual(DatasetVersion.current().version, version)
+
+    def test_archetype_endpoints(self):
+        archetypes.assign()
+        response = self.client.get('/api/archetypes/?pitch_type=ff')
+        self.assertEqual([row['label'] for row in response.json()], ['FF-1', 'FF-2'])
+        self.assertEqual(self.client.get('/api/archetypes/FF-2/').json()['size'], 12)
+        response = self.client.get('/api/archetypes/FF-1/pitchers/?limit=3')
+        distances = [row['archetype_distance'] for row in response.json()['pitchers']]
+        self.assertEqual(len(distances), 3)
+        self.assertEqual(distances, sorted(distances))
+        self.assertEqual(self.client.get('/api/archetypes/FF-9/pitchers/').status_code, 404)
+        self.assertEqual(self.client.get('/api/archetypes/FF-1/pitchers/?limit=0').status_code, 400)
+
+
+class MatchupTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        # Two right-handers; the ace leans on the slider against righties and the changeup against lefties.
+        for side, mix in (('R', {'FF': ('50.0%', '60.0%'), 'SL': ('50.0%', '40.0%')}),
+                          ('L', {'FF': ('60.0%', '50.0%'), 'CH': ('40.0%', '30.0%')})):
+            for pitch_type, (usage, zone) in mix.items():
+                make_pitcher('Ace, Annie', stand_side=side, pitch_type=pitch_type, usage_rate=usage, zone_rate=zone,
+                             velocity_range='95.0-97.0')
+        for side in ('R', 'L'):
+            make_pitcher('Thrower, Sam', stand_side=side, pitch_type='FF', usage_rate='100.0%', zone_rate='50.0%',
+                         velocity_range='90.0-92.0', team_name='Boston Red Sox')
+
+    def test_splits_against_league(self):
+        response = self.client.get('/api/pitchers/Ace, Annie/matchups/')
+        self.assertEqual(response.status_code, 200)
+        righties = response.json()['splits']['R']
+        self.assertEqual([pitch['pitch_type'] for pitch in righties['pitches']], ['FF', 'SL'])
+        fastball = righties['pitches'][0]
+        # League righty-vs-righty fastballs: 50% and 100% usage, 60% and 50% in the zone.
+        self.assertEqual((fastball['usage_delta'], fastball['zone_rate_delta']), (-25.0, 5.0))
+        self.assertEqual(fastball['velocity_delta'], 2.5)
+        self.assertEqual(righties['zone_rate'], 50.0)
+        self.assertEqual(self.client.get('/api/pitchers/Nobody, Here/matchups/').status_code, 404)
+
+    def test_lineup_batch(self):
+        response = self.client.post(
+            '/api/pitchers/matchups/',
+            {'pitchers': ['Ace, Annie', 'Thrower, Sam', 'Nobody, Here'], 'lineup': ['L', 'R', 'R', 'S']},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        ace, thrower = response.json()['pitchers']
+        # The switch hitter bats left against a right-hander.
+        self.assertEqual(ace['faces'], {'L': 0.5, 'R': 0.5})
+        self.assertEqual({pitch['pitch_type']: pitch['usage'] for pitch in ace['pitches']},
+                         {'FF': 55.0, 'SL': 25.0, 'CH': 20.0})
+        self.assertEqual(sum(pitch['usage'] for pitch in thrower['pitches']), 100.0)
+        self.assertEqual(response.json()['missing'], ['Nobody, Here'])
+        response = self.client.post('/api/pitchers/matchups/', {'team': 'Boston Red Sox', 'lineup': {'L': 9}},
+                                    format='json')
+        self.assertEqual([row['player_name'] for row in response.json()['pitchers']], ['Thrower, Sam'])
+        response = self.client.post('/api/pitchers/matchups/', {'pitchers': ['Ace, Annie'], 'lineup': {'X': 1}},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class BatchQueryTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pitchers = [make_pitcher(f"Pitcher, Number{i}") for i in range(6)]
+        archetypes.assign()
+        FavoritePitcher.objects.bulk_create([FavoritePitcher(user=self.user, pitcher=p) for p in self.pitchers[:4]])
+
+    def test_one_query_per_type(self):
+        from .querybudget import capture_queries
+
+        query = {
+            'user': ['id', 'username'],
+            'favorites': ['id', {'pitcher': ['player_name', {'archetype': ['label', 'name']}]}],
+            'pitchers': {'ids': [self.pitchers[5].pk, self.pitchers[0].pk, 999999], 'fields': ['id', 'archetype']},
+        }
+        with capture_queries() as log:
+            response = self.client.post('/api/query/', query, format='json')
+        self.assertEqual(response.status_code, 200)
+        # Favorites, then all pitchers (from favorites and by id) at once, then their archetypes.
+        self.assertEqual(len(log), 3, [query['sql'] for query in log.queries])
+        data = response.json()
+        self.assertEqual(data['user'], {'id': self.user.pk, 'username': 'scout'})
+        self.assertEqual(
+            data['favorites'][0],
+            {'id': data['favorites'][0]['id'],
+             'pitcher': {'player_name': 'Pitcher, Number0', 'archetype': {'label': 'FF-1', 'name': 'standard four-seamer'}}}
+        )
+        self.assertEqual(len(data['favorites']), 4)
+        self.assertEqual(data['pitchers'], [
+            {'id': self.pitchers[5].pk, 'archetype': 'FF-1'}, {'id': self.pitchers[0].pk, 'archetype': 'FF-1'}, None
+        ])
+
+    def test_rejects_unknown_fields(self):
+        for query in ({'pitchers': {'ids': [1], 'fields': ['password']}}, {'user': ['password']}, {'jobs': []}, []):
+            with self.subTest(query=query):
+                response = self.client.post('/api/query/', query, format='json')
+                self.assertEqual(response.status_code, 400)
+
+
+class WarmingTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        from . import heatmaps
+
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        override = self.settings(HEATMAP_STORE_DIR=self.store_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+        heatmaps._render_cached.cache_clear()
+        aggregator = heatmaps.HeatmapAggregator()
+        aggregator.add(np.array(['Wheeler, Zack|FF|R']), np.array([0.0]), np.array([2.5]), np.array([0.0]), np.array([0.0]))
+        aggregator.write(self.store_dir)
+
+        self.ace = make_pitcher('Wheeler, Zack')
+        make_pitcher('Wheeler, Zack', pitch_type='SI', velocity_range='93.0-95.0')
+        make_pitcher('Sale, Chris', throws='L', team_name='Atlanta Braves', avg_spin_rate=2600.0)
+        PitcherPopularity.objects.create(pitcher=self.ace, favorite_count=3)
+
+    def forget(self):
+        """Empty this process's caches, as in a freshly forked worker"""
+        from . import heatmaps
+
+        clear_snapshot()
+        compressed_bodies.clear()
+        cache.clear()
+        warming.clear()
+        heatmaps._render_cached.cache_clear()
+
+    def test_release_artifacts_prime_a_cold_process(self):
+        from django.core.management import call_command
+        from . import heatmaps
+
+        call_command('warm_caches', stdout=io.StringIO())
+        version = DatasetVersion.current().version
+        kinds = sorted(PrecomputedArtifact.objects.filter(version=version).values_list('kind', flat=True).distinct())
+        self.assertEqual(kinds, ['heatmaps', 'leaderboards', 'pitcher_list', 'teams'])
+
+        self.forget()
+        self.assertEqual(warming.prime(), PrecomputedArtifact.objects.count())
+        self.assertIsNone(warming.prime())
+        self.assertIsNotNone(compressed_bodies.get((f'"pitchers-v{version}"', 'gzip')))
+        self.assertIsNotNone(cache.get(counters.TOP_KEY))
+        heatmap = self.client.get(f'/api/pitchers/{self.ace.pk}/heatmap/')
+        self.assertEqual(heatmap.status_code, 200)
+        self.assertEqual(heatmaps._render_cached.cache_info().misses, 0)
+        trending = self.client.get('/api/pitchers/trending/', {'by': 'favorites'})
+        self.assertEqual(trending.json()[0]['favorite_count'], 3)
+
+    def test_priming_without_artifacts_and_pruning(self):
+        self.assertEqual(warming.prime(), 0)
+        version = DatasetVersion.current().version
+        self.assertIsNotNone(compressed_bodies.get((f'"pitchers-v{version}"', 'gzip')))
+
+        for later in (version, version + 1, version + 2):
+            warming.build(later)
+        self.assertEqual(
+            sorted(set(PrecomputedArtifact.objects.values_list('version', flat=True))), [version + 1, version + 2]
+        )
+
+    def test_team_summaries(self):
+        response = self.client.get('/api/pitchers/teams/')
+        self.assertEqual(response.status_code, 200)
+        braves, phillies = response.json()
+        self.assertEqual(braves['throws'], {'L': 1, 'R': 0})
+        self.assertEqual(phillies['pitchers'], 1)
+        self.assertEqual(phillies['pitch_types'], {'FF': 1, 'SI': 1})
+        self.assertEqual(phillies['avg_velocity'], 94.8)
+        again = self.client.get('/api/pitchers/teams/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+
+
+    def test_cached_body_survives_a_newer_version_stored_meanwhile(self):
+        from types import SimpleNamespace
+
+        def build():
+            # Another thread serves the next version while this one builds.
+            warming.store_body('teams', 8, b'newer')
+            return b'older'
+
+        self.assertEqual(warming.cached_body('teams', SimpleNamespace(version=7), build), b'older')
+
+class ReportTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        from . import heatmaps
+
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        override = self.settings(HEATMAP_STORE_DIR=self.store_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+        aggregator = heatmaps.HeatmapAggregator()
+        aggregator.add(np.array(['Wheeler, Zack|FF|R'] * 2), np.array([0.0, 0.5]), np.array([2.5, 2.0]),
+                       np.array([0.0, 1.0]), np.array([0.0, 2.0]))
+        aggregator.write(self.store_dir)
+
+        make_pitcher('Wheeler, Zack')
+        make_pitcher('Wheeler, Zack', stand_side='L', pitch_type='CH', usage_rate='20.0%')
+        make_pitcher('Nola, Aaron', avg_spin_rate=2550.0)
+        make_pitcher('Sale, Chris', throws='L', team_name='Atlanta Braves')
+        archetypes.assign()
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+
+    def generate(self, name, **options):
+        from .reports import generate
+
+        return generate(os.path.join(self.output, name), formats=('csv', 'html', 'pdf'), **options)
+
+    def test_pool_matches_in_process_output(self):
+        serial = self.generate('serial', workers=1)
+        pooled = self.generate('pooled', workers=2)
+        self.assertEqual((serial['tasks'], pooled['workers']), (2, 2))
+        files = sorted(os.listdir(os.path.join(self.output, 'serial')))
+        self.assertEqual(files, sorted(os.listdir(os.path.join(self.output, 'pooled'))))
+        self.assertIn('philadelphia-phillies.pdf', files)
+        combined = os.path.basename(pooled['combined_csv'])
+        for name in files:
+            with open(os.path.join(self.output, 'serial', name), 'rb') as a, \
+                    open(os.path.join(self.output, 'pooled', name), 'rb') as b:
+                if name == combined:
+                    # Appended as tasks complete, so only the row order may differ.
+                    self.assertEqual(sorted(a.read().splitlines()), sorted(b.read().splitlines()))
+                else:
+                    self.assertEqual(a.read(), b.read(), name)
+
+        with open(pooled['combined_csv'], newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 4)
+        fastball = next(row for row in rows if row['player_name'] == 'Wheeler, Zack' and row['pitch_type'] == 'FF')
+        self.assertEqual((fastball['team_name'], fastball['archetype_name']), ('Philadelphia Phillies', 'standard four-seamer'))
+
+        with open(os.path.join(self.output, 'pooled', 'philadelphia-phillies.html')) as f:
+            self.assertIn('data:image/png;base64,', f.read())
+        with open(os.path.join(self.output, 'pooled', 'philadelphia-phillies.pdf'), 'rb') as f:
+            pdf = f.read()
+        self.assertTrue(pdf.startswith(b'%PDF-1.4') and pdf.endswith(b'%%EOF\n'))
+        self.assertIn(b'/Subtype /Image', pdf)
+        # Every xref entry points at its object.
+        xref = int(pdf.rsplit(b'startxref\n', 1)[1].split()[0])
+        _, header, _, *entries = pdf[xref:].split(b'\n')
+        for number, entry in enumerate(entries[:int(header.split()[1]) - 1], start=1):
+            offset = int(entry.split()[0])
+            self.assertTrue(pdf[offset:].startswith(f'{number} 0 obj'.encode()))
+
+    def test_command_by_pitcher(self):
+        from django.core.management import call_command
+
+        output = os.path.join(self.output, 'pitchers')
+        stdout = io.StringIO()
+        call_command('generate_reports', by='pitcher', names=['Sale, Chris'], output=output, workers=1, stdout=stdout)
+        self.assertIn('[1/1] Sale, Chris', stdout.getvalue())
+        version = DatasetVersion.current().version
+        self.assertEqual(sorted(os.listdir(output)), [f'pitchers-v{version}.csv', 'sale-chris.csv', 'sale-chris.html'])
+
+
+class StartupProfileTests(TestCase):
+    def test_reports_phases_and_enforces_budget(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        out = io.StringIO()
+        call_command('profile_startup', '--runs', '1', '--json', '--budget', '0', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertGreater(report['phases_ms']['total'], 0)
+        self.assertIn('pitchers', report['apps_ms'])
+        self.assertIn('django', report['packages_self_ms'])
+        # numpy is only needed by rarely run tasks, so it's not imported at boot.
+        self.assertNotIn('numpy', report['packages_self_ms'])
+
+        with self.assertRaises(CommandError):
+            call_command('profile_startup', '--runs', '1', '--budget', '1', stdout=io.StringIO())
+
+
+class ProfilerTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        from rest_framework_simplejwt.tokens import AccessToken
+        from .profiling import get_store
+
+        get_store().clear()
+        make_pitcher('Wheeler, Zack')
+        self.staff = User.objects.create_user(username='staff', email='', password='pw-12345!', is_staff=True)
+        self.staff_client = APIClient()
+        self.staff_client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.staff)}")
+
+    def test_staff_request_is_profiled_and_stored(self):
+        response = self.staff_client.get('/api/pitchers/', HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        url = response['X-Profile-Url']
+        profile = self.staff_client.get(url).json()
+        self.assertEqual(profile['path'], '/api/pitchers/')
+        self.assertEqual(profile['status'], 200)
+        self.assertGreater(profile['query_count'], 0)
+        self.assertTrue(any('pitchers_pitcher' in query['sql'] for query in profile['queries']))
+        self.assertEqual(self.staff_client.get(url, {'folded': '1'})['Content-Type'], 'text/plain; charset=utf-8')
+        # Only staff can read profiles.
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_cprofile_inline(self):
+        response = self.staff_client.get('/api/pitchers/', {'_profile': 'cprofile-inline'})
+        profile = response.json()
+        self.assertEqual(profile['mode'], 'cprofile')
+        self.assertIn('cumulative', profile['functions'])
+
+    def test_non_staff_flag_is_ignored(self):
+        response = self.client.get('/api/pitchers/', HTTP_X_PROFILE='inline')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(len(response.json()), 1)
+
+    def test_store_is_bounded(self):
+        from .profiling import ProfileStore
+
+        store = ProfileStore(max_bytes=300)
+        for i in range(5):
+            store.add({'id': str(i), 'folded': 'x' * 100})
+        self.assertLessEqual(store.size, 300)
+        self.assertIsNone(store.get('0'))
+        self.assertIsNotNone(store.get('4'))
+        self.assertFalse(store.add({'id': 'big', 'folded': 'x' * 400}))
+
+
+# (method, path, body) for every API route; `{...}` are filled from the seeded rows.
+BUDGETED_ROUTES = [
+    ('get', '/api/', None),
+    ('get', '/api/users/', None),
+    ('post', '/api/users/', {'username': 'newcomer', 'email': 'newcomer@example.com', 'password': 'pw-12345!'}),
+    ('get', '/api/users/{user}/', None),
+    ('put', '/api/users/{user}/', {'username': 'fan', 'email': 'fan2@example.com', 'password': 'pw-12345!'}),
+    ('patch', '/api/users/{user}/', {'email': 'fan3@example.com'}),
+    ('delete', '/api/users/{user}/', None),
+    ('get', '/api/pitchers/', None),
+    ('get', '/api/pitchers/?annotate=is_favorite', None),
+    ('get', '/api/pitchers/changes/?since=1', None),
+    ('get', '/api/pitchers/trending/', None),
+    ('get', '/api/pitchers/teams/', None),
+    ('get', '/api/pitchers/{pitcher}/', None),
+    ('get', '/api/pitchers/{pitcher}/heatmap/', None),
+    ('get', '/api/pitchers/{pitcher}/similar/', None),
+    ('get', '/api/pitchers/{name}/matchups/', None),
+    ('post', '/api/pitchers/matchups/', {'team': 'Philadelphia Phillies', 'lineup': {'L': 4, 'R': 5}}),
+    ('get', '/api/favorites/', None),
+    ('post', '/api/favorites/', {'pitcher_id': '{spare}'}),
+    ('delete', '/api/favorites/clear_all/?username=fan', None),
+    ('delete', '/api/favorites/delete_by_name/?player_name=Pitcher, 1', None),
+    ('get', '/api/favorites/get_all_favorites/?username=fan', None),
+    ('get', '/api/favorites/my_favorites/?username=fan', None),
+    ('get', '/api/favorites/recommendations/', None),
+    ('get', '/api/favorites/compare/?usernames=fan&op=union', None),
+    # Includes a name that isn't in the dataset, which gets a placeholder pitcher.
+    ('post', '/api/favorites/save_favorites/?username=fan', {'pitcher_names': '{names}'}),
+    ('get', '/api/favorites/{favorite}/', None),
+    ('put', '/api/favorites/{favorite}/', {'pitcher_id': '{spare}'}),
+    ('patch', '/api/favorites/{favorite}/', {'pitcher_id': '{spare}'}),
+    ('delete', '/api/favorites/{favorite}/', None),
+    ('get', '/api/jobs/', None),
+    ('post', '/api/jobs/', {'kind': 'rebuild_recommendations'}),
+    ('get', '/api/jobs/{job}/', None),
+    ('post', '/api/token/', {'username': 'fan', 'password': 'pw-12345!'}),
+    ('post', '/api/token/refresh/', {'refresh': '{refresh}'}),
+    ('get', '/api/user/info/', None),
+    ('post', '/api/query/', {
+        'user': ['id', 'username'], 'favorites': ['id', {'pitcher': ['player_name', {'archetype': ['name']}]}],
+    }),
+    ('get', '/api/profiles/{profile}/', None),
+    ('get', '/api/archetypes/', None),
+    ('get', '/api/archetypes/{archetype}/', None),
+    ('get', '/api/archetypes/{archetype}/pitchers/', None),
+]
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class QueryBudgetTests(APITestCase):
+    """Every API route stays within its view's query budget, with no N+1 patterns, for small and large data"""
+
+    def seed(self, size):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        from .profiling import get_store
+
+        clear_snapshot()
+        cache.clear()
+        pitchers = [make_pitcher(f"Pitcher, {i}") for i in range(size + 1)]
+        staff = User.objects.create_user(username='boss', email='', password='pw-12345!', is_staff=True)
+        fan = User.objects.create_user(username='fan', email='fan@example.com', password='pw-12345!')
+        for user in (staff, fan):
+            FavoritePitcher.objects.bulk_create([FavoritePitcher(user=user, pitcher=p) for p in pitchers[:size]])
+        jobs = [Job.objects.create(kind='rebuild_recommendations', created_by=staff) for _ in range(size)]
+        get_store().add({'id': 'seeded', 'folded': ''})
+        archetypes.assign()
+        refresh = RefreshToken.for_user(staff)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {refresh.access_token}")
+        return {
+            'user': fan.pk, 'pitcher': pitchers[0].pk, 'spare': pitchers[size].pk, 'job': jobs[0].pk,
+            'favorite': staff.favorites.order_by('pk').first().pk, 'profile': 'seeded', 'refresh': str(refresh),
+            'names': [p.player_name for p in pitchers[:size]] + ['Newcomer, Pete'], 'archetype': 'FF-1',
+            'name': pitchers[0].player_name,
+        }
+
+    def run_route(self, method, path, body, size):
+        from django.db import transaction
+        from django.urls import resolve
+        from .querybudget import budget_for, capture_queries
+
+        with transaction.atomic():
+            values = self.seed(size)
+            path = path.format(**values)
+            if body:
+                body = {
+                    key: values[value[1:-1]] if isinstance(value, str) and value.startswith('{') else value
+                    for key, value in body.items()
+                }
+            with capture_queries() as log:
+                response = getattr(self.client, method)(path, body, format='json')
+            transaction.set_rollback(True)
+        self.assertLess(response.status_code, 500, f"{method.upper()} {path}")
+        budget = budget_for(resolve(path.split('?')[0]).func, method)
+        return budget, log
+
+    def test_routes_within_budget(self):
+        for method, path, body in BUDGETED_ROUTES:
+            with self.subTest(f"{method.upper()} {path}"):
+                for size in (2, 12):
+                    budget, log = self.run_route(method, path, body, size)
+                    self.assertIsNotNone(budget, 'no query budget declared')
+                    self.assertEqual(log.problems(budget), [], '\n'.join(q['sql'] for q in log.queries))
+
+    def test_every_route_is_listed(self):
+        from django.urls import get_resolver, resolve
+
+        def names(patterns):
+            for pattern in patterns:
+                if hasattr(pattern, 'url_patterns'):
+                    yield from names(pattern.url_patterns)
+                elif 'format' not in str(pattern.pattern):
+                    yield pattern.name
+
+        placeholders = {'user': 1, 'pitcher': 1, 'favorite': 1, 'job': 1, 'profile': 'x', 'archetype': 'FF-1',
+                        'name': 'Pitcher, 1'}
+        listed = {resolve(path.split('?')[0].format(**placeholders)).url_name for _, path, _ in BUDGETED_ROUTES}
+        # The event stream is long-lived and covered by `EventStreamTests`.
+        self.assertEqual(set(names(get_resolver('pitchers.urls').url_patterns)) - {'events'}, listed)
+
+    @override_settings(QUERY_BUDGETS_ENABLED=True)
+    def test_middleware_warns_over_budget(self):
+        from unittest import mock
+        from .views import FavoritePitcherViewSet
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch.dict(FavoritePitcherViewSet.query_budgets, {'list': 0}):
+            with self.assertLogs('pitchers.middleware', 'WARNING') as logs:
+                response = client.get('/api/favorites/')
+        self.assertEqual(response['X-Query-Count'], '1')
+        self.assertIn('over the budget of 0', logs.output[0])
+        self.assertIn('pitchers/', logs.output[0])
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, COUNTERS_FLUSH_INTERVAL=None)
+class FavoritesConcurrencyTests(TransactionTestCase):
+    """
+    Many threads writing one user's favorites at once, each on its own database
+    connection, against whichever database the suite runs on (SQLite by default,
+    MySQL when DATABASE_URL points at one).
+    """
+    THREADS = 8
+
+    def setUp(self):
+        clear_snapshot()
+        cache.clear()
+        counters.buffer.clear()
+        self.addCleanup(counters.buffer.clear)
+        self.user = User.objects.create_user(username='scout', email='scout@example.com', password='pw-12345!')
+        self.pitchers = [make_pitcher(f"Pitcher, Number{i}") for i in range(6)]
+
+    def hammer(self, requests):
+        """Send each of `requests` (fn(client) -> response) from its own thread, all at once; returns the responses"""
+        barrier = threading.Barrier(len(requests))
+        responses = [None] * len(requests)
+        errors = []
+
+        def send(position, request):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            try:
+                barrier.wait()
+                responses[position] = request(client)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=send, args=item) for item in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual([response.status_code for response in responses if response.status_code >= 500], [])
+        return responses
+
+    def save(self, pitchers, **headers):
+        names = [pitcher.player_name for pitcher in pitchers]
+        return lambda client: client.post(
+            '/api/favorites/save_favorites/?username=scout', {'pitcher_names': names}, format='json', headers=headers
+        )
+
+    def favorite_ids(self):
+        return set(FavoritePitcher.objects.filter(user=self.user).values_list('pitcher_id', flat=True))
+
+    def test_devices_saving_at_once_never_interleave(self):
+        lists = [self.pitchers[:3], self.pitchers[2:5]]
+        responses = self.hammer([self.save(lists[i % 2]) for i in range(self.THREADS)])
+        self.assertIn(self.favorite_ids(), [{pitcher.pk for pitcher in found} for found in lists])
+        versions = sorted(response.json()['version'] for response in responses)
+        # Each save either changed the list (and got its own version) or found it already saved.
+        self.assertEqual(versions[-1], len(set(versions)))
+
+    def test_creates_of_the_same_favorite(self):
+        pitcher_id = self.pitchers[0].pk
+        responses = self.hammer([
+            lambda client: client.post('/api/favorites/', {'pitcher_id': pitcher_id}, format='json')
+        ] * self.THREADS)
+        self.assertEqual(sorted(response.status_code for response in responses), [200] * (self.THREADS - 1) + [201])
+        self.assertEqual(self.favorite_ids(), {pitcher_id})
+
+    def test_retries_with_one_idempotency_key(self):
+        responses = self.hammer([self.save(self.pitchers[:2], **{'Idempotency-Key': 'k1'})] * self.THREADS)
+        self.assertEqual({json.dumps(response.json()) for response in responses}, {json.dumps(responses[0].json())})
+        self.assertEqual(sum(response.has_header('Idempotent-Replayed') for response in responses), self.THREADS - 1)
+        self.assertEqual(responses[0].json()['version'], 1)
+
+    def test_writes_against_one_version(self):
+        responses = self.hammer([
+            self.save([pitcher], **{'If-Match': '"favorites-v0"'}) for pitcher in self.pitchers[:self.THREADS]
+        ])
+        self.assertEqual(sorted(response.status_code for response in responses).count(200), 1)
+        self.assertEqual({response.status_code for response in responses}, {200, 412})
+        self.assertEqual(len(self.favorite_ids()), 1)
+
+
+class JobClaimConcurrencyTests(TransactionTestCase):
+    def test_workers_claiming_at_once_respect_the_kind_limit(self):
+        from . import jobs
+
+        for name in ('a', 'b', 'c', 'd'):
+            jobs.enqueue('reload_pitchers', {'json_file': f"{name}.json"})
+        barrier = threading.Barrier(4)
+        claimed, errors = [], []
+
+        def claim(i):
+            try:
+                barrier.wait()
+                claimed.append(jobs.Worker(name=f"worker:{i}").claim())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=claim, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len([job for job in claimed if job is not None]), 1)
+        self.assertEqual(Job.objects.filter(status=Job.RUNNING).count(), 1)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, COUNTERS_FLUSH_INTERVAL=None)
+class DatasetChangeConcurrencyTests(TransactionTestCase):
+    """Dataset changes from several threads at once, each on its own database connection"""
+
+    def setUp(self):
+        clear_snapshot()
+        self.first = make_pitcher('Wheeler, Zack')
+        self.since = DatasetVersion.current().version
+
+    def in_thread(self, target, errors):
+        def run():
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_overlapping_changes_publish_in_order(self):
+        from .changes import changes_since, dataset_change
+
+        reserved, release = threading.Event(), threading.Event()
+        versions, errors = {}, []
+
+        def slow_change():
+            with dataset_change() as version:
+                versions['slow'] = version
+                reserved.set()
+                release.wait(10)
+                make_pitcher('Nola, Aaron')
+
+        thread = self.in_thread(slow_change, errors)
+        self.assertTrue(reserved.wait(10))
+        with dataset_change() as version:
+            versions['fast'] = version
+            make_pitcher('Suarez, Ranger')
+        # The newer change finished first, but the older one's rows aren't written yet.
+        self.assertEqual(DatasetVersion.current().version, self.since)
+        self.assertEqual(changes_since(self.since, 100)[0], self.since)
+
+        release.set()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual((versions['slow'], versions['fast']), (self.since + 1, self.since + 2))
+        version, upserts, deleted = changes_since(self.since, 100)
+        self.assertEqual(version, self.since + 2)
+        self.assertEqual({row.player_name for row in upserts}, {'Nola, Aaron', 'Suarez, Ranger'})
+
+    def test_concurrent_saves_reserve_distinct_versions(self):
+        errors = []
+        barrier = threading.Barrier(6)
+
+        def save(i):
+            barrier.wait()
+            make_pitcher(f"Pitcher, Number{i}")
+
+        threads = [self.in_thread(lambda i=i: save(i), errors) for i in range(6)]
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        versions = sorted(Pitcher.objects.exclude(pk=self.first.pk).values_list('row_version', flat=True))
+        self.assertEqual(versions, list(range(self.since + 1, self.since + 7)))
+        self.assertEqual(DatasetVersion.current().version, self.since + 6)
+
+    def test_abandoned_reservation_is_given_up(self):
+        from .models import DatasetReservation
+
+        with self.settings(DATASET_SAVE_TIMEOUT=-1):
+            abandoned = DatasetVersion.reserve(-1)
+            make_pitcher('Nola, Aaron')
+        self.assertEqual(DatasetVersion.current().version, abandoned + 1)
+        self.assertFalse(DatasetReservation.objects.exists())
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, COUNTERS_FLUSH_INTERVAL=None)
+class PitcherBundleTests(TransactionTestCase):
+    databases = {'default', 'pitchers_bundle'}
+
+    def setUp(self):
+        from . import bundles
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        settings_override = override_settings(PITCHER_BUNDLE_DIR=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(bundles.reset)
+        self.addCleanup(clear_snapshot)
+        bundles.reset()
+        clear_snapshot()
+        counters.buffer.clear()
+        # Or the exit flush would write it to the development database.
+        self.addCleanup(counters.buffer.clear)
+        self.pitchers = [make_pitcher(f"Pitcher, Number{i}") for i in range(5)]
+        DatasetVersion.bump()
+
+    def test_bundle_copies_table_and_serves_reads(self):
+        from .bundles import ALIAS, bundle_path, bundle_version
+        from .dataset import get_snapshot
+
+        version = DatasetVersion.current().version
+        self.assertEqual(len(get_snapshot(version)), 5)
+        self.assertEqual(bundle_version(bundle_path(version)), version)
+        self.assertEqual(Pitcher.objects.all().db, ALIAS)
+        self.assertEqual(
+            list(Pitcher.objects.order_by('pk').values_list('player_name', flat=True)),
+            [pitcher.player_name for pitcher in self.pitchers]
+        )
+        with connections[ALIAS].cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN SELECT id FROM pitchers_pitcher WHERE player_name = %s', ['x'])
+            self.assertIn('USING', cursor.fetchone()[-1])
+
+    def test_writes_and_transactions_use_primary(self):
+        from django.db import transaction
+        from .bundles import ALIAS
+        from .dataset import get_snapshot
+
+        get_snapshot(DatasetVersion.current().version)
+        pitcher = Pitcher.objects.get(pk=self.pitchers[0].pk)
+        self.assertEqual(pitcher._state.db, ALIAS)
+        pitcher.team_name = 'Boston Red Sox'
+        pitcher.save()
+        user = User.objects.create_user(username='scout', password='pw-12345!')
+        FavoritePitcher.objects.create(user=user, pitcher=pitcher)
+        self.assertEqual(pitcher.favorited_by.count(), 1)
+        with transaction.atomic():
+            self.assertEqual(Pitcher.objects.get(pk=pitcher.pk).team_name, 'Boston Red Sox')
+
+    def test_new_version_switches_bundle(self):
+        from .bundles import ALIAS, CURRENT, bundle_dir
+        from .dataset import get_snapshot
+
+        get_snapshot(DatasetVersion.current().version)
+        make_pitcher('Newcomer, Sam')
+        version = DatasetVersion.bump().version
+        # Until the new bundle is served, reads fall back to the primary.
+        self.assertEqual(Pitcher.objects.all().db, 'default')
+        get_snapshot(version)
+        self.assertEqual(Pitcher.objects.all().db, ALIAS)
+        self.assertTrue(Pitcher.objects.filter(player_name='Newcomer, Sam').exists())
+        self.assertEqual(os.readlink(bundle_dir() / CURRENT), f"pitchers-v{version}.sqlite3")
+
+    def publish_elsewhere(self, player_name):
+        """Add a pitcher and a version the way another process would, without this one observing it"""
+        from django.db.models import F
+
+        fields = {
+            field.attname: getattr(self.pitchers[0], field.attname)
+            for field in Pitcher._meta.concrete_fields if not field.primary_key
+        }
+        Pitcher.objects.bulk_create([Pitcher(**{**fields, 'player_name': player_name})])
+        DatasetVersion.objects.filter(pk=1).update(version=F('version') + 1, reserved=F('version') + 1)
+        return DatasetVersion.current().version
+
+    def test_version_published_by_another_process_is_noticed_per_request(self):
+        from .bundles import ALIAS
+        from .dataset import get_snapshot
+
+        get_snapshot(DatasetVersion.current().version)
+        self.publish_elsewhere('Newcomer, Sam')
+        self.assertFalse(Pitcher.objects.filter(player_name='Newcomer, Sam').exists())
+        Client().get('/api/')
+        self.assertEqual(Pitcher.objects.all().db, 'default')
+        self.assertTrue(Pitcher.objects.filter(player_name='Newcomer, Sam').exists())
+
+    def test_bundle_written_by_another_process_is_served_per_request(self):
+        from . import bundles
+        from .dataset import get_snapshot
+
+        get_snapshot(DatasetVersion.current().version)
+        version = self.publish_elsewhere('Newcomer, Sam')
+        bundles.point_current(bundles.write_bundle(version))
+        Client().get('/api/')
+        self.assertEqual(Pitcher.objects.all().db, bundles.ALIAS)
+        self.assertTrue(Pitcher.objects.filter(player_name='Newcomer, Sam').exists())
@@ -0,0 +1,100 @@
+import time
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+
+def parse_rate(rate):
+    """
+    Parse a DRF-style rate ('60/min') into (capacity, tokens per second).
+
+    The bucket holds up to `capacity` tokens and refills continuously, so a
+    client can burst up to the full allowance and then proceeds at the
+    steady-state rate, rather than being locked out until a window resets.
+    """
+    num, period = rate.split('/')
+    capacity = int(num)
+    seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return capacity, capacity / seconds
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Token-bucket throttle backed by the Django cache.
+
+    With the default local-memory cache the buckets are per process; point
+    `THROTTLE_CACHE_ALIAS` at a shared cache (Redis/Memcached) to share them
+    across workers and dynos. The read-modify-write on a bucket is only
+    serialised within a process, though, so shared limits are approximate:
+    requests racing in different processes can spend the same token, letting a
+    client exceed its rate by up to one request per concurrent worker.
+    """
+    scope = None
+    rates = None
+    # Serialises the read-modify-write on the bucket within this process only (see above).
+    _lock = Lock()
+
+    def __init__(self):
+        rates = self.rates if self.rates is not None else api_settings.DEFAULT_THROTTLE_RATES
+        self.rate = rates.get(self.scope)
+        self.capacity, self.refill_rate = parse_rate(self.rate) if self.rate else (None, None)
+        self.cache = caches[settings.THROTTLE_CACHE_ALIAS]
+        self._wait = None
+
+    def get_cache_key(self, request, view):
+        raise NotImplementedError('.get_cache_key() must be overridden')
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+
+        now = time.time()
+        with self._lock:
+            tokens, updated = self.cache.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.refill_rate)
+            if tokens < 1:
+                self._wait = (1 - tokens) / self.refill_rate
+                self.cache.set(key, (tokens, now), self.timeout)
+                return False
+            self.cache.set(key, (tokens - 1, now), self.timeout)
+        return True
+
+    def wait(self):
+        return self._wait
+
+    @property
+    def timeout(self):
+        # Long enough for an idle bucket to refill completely, after which it can be forgotten.
+        return int(self.capacity / self.refill_rate) + 1
+
+
+class UserTokenBucketThrottle(TokenBucketThrottle):
+    """Per-user bucket; anonymous requests are left to `IPTokenBucketThrottle`"""
+    scope = 'user'
+
+    def get_cache_key(self, request, view):
+        if not request.user or not request.user.is_authenticated:
+            return None
+        return f"throttle:{self.scope}:{request.user.pk}"
+
+
+class IPTokenBucketThrottle(TokenBucketThrottle):
+    """Per-client-IP bucket, applied to every request"""
+    scope = 'ip'
+
+    def get_cache_key(self, request, view):
+        return f"throttle:{self.scope}:{self.get_ident(request)}"
+
+
+class SignupThrottle(IPTokenBucketThrottle):
+    scope = 'signup'
+
+
+class LoginThrottle(IPTokenBucketThrottle):
+    scope = 'login'
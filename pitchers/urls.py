@@ -2,15 +2,27 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from . import views
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from .querybudget import query_budget
+from .throttling import LoginThrottle, IPTokenBucketThrottle
 
 router = DefaultRouter()
+router.APIRootView = views.APIRootView
 router.register(r'users', views.UserViewSet)
 router.register(r'pitchers', views.PitcherViewSet)
 router.register(r'favorites', views.FavoritePitcherViewSet, basename='favorite')
+router.register(r'jobs', views.JobViewSet, basename='job')
+router.register(r'archetypes', views.PitchArchetypeViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
-    path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path(
+        'token/',
+        query_budget(1)(TokenObtainPairView.as_view(throttle_classes=[LoginThrottle, IPTokenBucketThrottle])),
+        name='token_obtain_pair'
+    ),
+    path('token/refresh/', query_budget(1)(TokenRefreshView.as_view()), name='token_refresh'),
     path('user/info/', views.UserInfoView.as_view(), name='user_info'),
+    path('query/', views.BatchQueryView.as_view(), name='query'),
+    path('events/', views.event_stream_view, name='events'),
+    path('profiles/<str:profile_id>/', views.ProfileView.as_view(), name='profile-detail'),
 ] 
\ No newline at end of file
@@ -1,16 +1,60 @@
 from django.shortcuts import render
-from rest_framework import viewsets, permissions, status
+from rest_framework import viewsets, permissions, status, mixins, routers
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from django.contrib.auth.models import User
-from .models import Pitcher, FavoritePitcher
-from .serializers import UserSerializer, PitcherSerializer, FavoritePitcherSerializer
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.db import transaction
+from django.utils.http import http_date, quote_etag
+from .models import Pitcher, FavoritePitcher, DatasetVersion, Job, PitchArchetype
+from .dataset import dataset_etag, get_snapshot, encode_row, PITCHER_FIELDS
+from .changes import changes_since, dataset_change
+from .coalesce import single_flight
+from .hashers import HashingBusy
+from .throttling import SignupThrottle, IPTokenBucketThrottle
+from .querybudget import query_budget
+from .streaming import NDJSONRenderer, is_asgi, wants_stream, streaming_response
+from rest_framework.settings import api_settings
+from django.conf import settings
+from .serializers import (
+    UserSerializer, PitcherSerializer, FavoritePitcherSerializer, JobSerializer, PitchArchetypeSerializer
+)
+from . import jobs, events, recommendations, counters, warming, bitsets, favorites
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
 import logging
 from rest_framework.views import APIView
+import hashlib
 import json
+import math
+from collections import defaultdict
+from functools import reduce
+from operator import and_, or_
 
 logger = logging.getLogger(__name__)
 
+# Field values for pitchers created by `save_favorites` for names that aren't in the dataset.
+PLACEHOLDER_PITCHER = {
+    'player_image': 'https://example.com/default.jpg',
+    'team_name': 'Unknown Team',
+    'team_logo': 'https://example.com/default_logo.jpg',
+    'stand_side': 'R',
+    'pitch_type': 'FB',
+    'velocity_range': '90-95',
+    'usage_rate': '0%',
+    'zone_rate': '0%',
+    'avg_spin_rate': 0.0,
+    'avg_horz_break': 0.0,
+    'avg_induced_vert_break': 0.0,
+    'arm_angle': 0.0,
+    'throws': 'R',
+    'heatmap_path': '/default/heatmap.png'
+}
+
 def log_request(request, view_name):
     """Helper function to log request details"""
     logger.info(f"=== {view_name} Request ===")
@@ -27,13 +71,45 @@ def log_response(response, view_name):
     """Helper function to log response details"""
     logger.info(f"=== {view_name} Response ===")
     logger.info(f"Status: {response.status_code}")
-    if hasattr(response, 'data'):
-        logger.info(f"Response Data: {json.dumps(response.data, indent=2)}")
+    if response.streaming:
+        logger.info("Response Data: <streamed>")
+    elif hasattr(response, 'data'):
+        # Dumping a full pitcher list re-serializes megabytes of JSON, so large lists are summarised.
+        if isinstance(response.data, list) and len(response.data) > settings.LOG_RESPONSE_MAX_ITEMS:
+            logger.info(f"Response Data: <list of {len(response.data)} items>")
+        else:
+            logger.info(f"Response Data: {json.dumps(response.data, indent=2)}")
+
+def dataset_validators(suffix=''):
+    """Helper function to build ETag/Last-Modified validators from the dataset version"""
+    dataset = DatasetVersion.current()
+    etag = dataset_etag(dataset.version, suffix)
+    last_modified = int(dataset.updated_at.timestamp())
+    return dataset.version, etag, last_modified
+
+def parse_limit(request, maximum, default=10):
+    """Helper function to read a `?limit=` between 1 and `maximum`, or None if invalid"""
+    limit = request.query_params.get('limit', str(default))
+    if not limit.isdigit() or not 1 <= int(limit) <= maximum:
+        return None
+    return int(limit)
+
+def apply_validators(response, etag, last_modified):
+    """Helper function to attach validators so clients can revalidate with a 304"""
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 # Create your views here.
 
+class APIRootView(routers.APIRootView):
+    query_budgets = {'get': 1}
+
+
 class UserInfoView(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    query_budgets = {'get': 1}
 
     def get(self, request):
         log_request(request, "UserInfoView")
@@ -56,16 +132,100 @@ class UserInfoView(APIView):
             log_response(response, "UserInfoView")
             return response
 
+class ProfileView(APIView):
+    """A stored request profile (see `pitchers/profiling.py`); `?folded=1` returns the flamegraph stacks"""
+    permission_classes = [permissions.IsAdminUser]
+    query_budgets = {'get': 1}
+
+    def get(self, request, profile_id):
+        from .profiling import get_store
+
+        profile = get_store().get(profile_id)
+        if profile is None:
+            return Response(
+                {'detail': 'No such profile in this worker, it may have been evicted or served by another worker.'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        if request.query_params.get('folded'):
+            return HttpResponse(profile.get('folded', ''), content_type='text/plain; charset=utf-8')
+        return Response(profile)
+
+class BatchQueryView(APIView):
+    """
+    One request for the user, their favorites and any pitchers, in the shape the
+    client declares, with one query per type (see `pitchers/batchquery.py`)
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    query_budgets = {'post': 4}
+
+    def post(self, request):
+        log_request(request, "BatchQueryView")
+        from .batchquery import BatchQuery, QueryError
+
+        try:
+            result = BatchQuery(request.user, request.data).resolve()
+        except QueryError as e:
+            response = Response({'query': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            log_response(response, "BatchQueryView")
+            return response
+        response = Response(result)
+        log_response(response, "BatchQueryView")
+        return response
+
+@query_budget(1)
+async def event_stream_view(request):
+    """
+    Server-Sent Events stream of dataset and favorites changes (see `pitchers/events.py`).
+
+    Browsers' EventSource can't send an Authorization header, so the access token
+    may also be passed as `?token=`.
+    """
+    logger.info(f"=== event_stream_view Request === Path: {request.path}")
+    authentication = JWTAuthentication()
+
+    def authenticate():
+        raw_token = request.GET.get('token')
+        if raw_token:
+            return authentication.get_user(authentication.get_validated_token(raw_token))
+        result = authentication.authenticate(request)
+        return result[0] if result else None
+
+    try:
+        user = await sync_to_async(authenticate)()
+    except (InvalidToken, AuthenticationFailed) as e:
+        return JsonResponse({'detail': str(e)}, status=status.HTTP_401_UNAUTHORIZED)
+    if user is None:
+        return JsonResponse(
+            {'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED
+        )
+
+    response = StreamingHttpResponse(events.event_stream(user), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    logger.info(f"Opened event stream for {user.username}")
+    return response
+
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.AllowAny]
+    query_budgets = {
+        'list': 2, 'create': 4, 'retrieve': 2, 'update': 3, 'partial_update': 3,
+        # Cascades to the user's favorites, jobs and auth tables, one statement per table.
+        'destroy': 11,
+    }
 
     def get_permissions(self):
         if self.action == 'create':
             return [permissions.AllowAny()]
         return [permissions.IsAuthenticated()]
 
+    def get_throttles(self):
+        if self.action == 'create':
+            # Each signup costs a password hash, so it gets its own, much smaller, bucket.
+            return [SignupThrottle(), IPTokenBucketThrottle()]
+        return super().get_throttles()
+
     def create(self, request, *args, **kwargs):
         log_request(request, "UserViewSet.create")
         try:
@@ -84,6 +244,13 @@ class UserViewSet(viewsets.ModelViewSet):
             response = Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             log_response(response, "UserViewSet.create")
             return response
+        except ValidationError as e:
+            logger.error(f"Validation errors: {e.detail}")
+            response = Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
+            log_response(response, "UserViewSet.create")
+            return response
+        except HashingBusy:
+            raise
         except Exception as e:
             logger.error(f"Error creating user: {str(e)}", exc_info=True)
             response = Response({
@@ -97,52 +264,449 @@ class PitcherViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Pitcher.objects.all()
     serializer_class = PitcherSerializer
     permission_classes = [permissions.IsAuthenticated]
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer]
+    query_budgets = {
+        # `list` includes the requester's favorites bitset with `?annotate=is_favorite`.
+        'list': 4, 'retrieve': 3, 'changes': 6, 'trending': 6, 'heatmap': 2, 'similar': 5, 'matchups': 3,
+        'lineup_matchups': 3, 'teams': 3,
+    }
+
+    def serves_snapshot(self, request):
+        # The preloaded snapshot holds pre-encoded JSON, so it can only stand in for the
+        # JSON renderer (not the browsable API) on the unfiltered queryset.
+        return request.accepted_renderer.format == 'json' and self.paginator is None
 
     def list(self, request, *args, **kwargs):
+        """`?annotate=is_favorite` adds the requester's favorite flag to each row (not when streaming)"""
         log_request(request, "PitcherViewSet.list")
+        stream_mode = wants_stream(request)
+        suffix = f"-{stream_mode}" if stream_mode else ''
+        favorite_ids = None
+        if request.query_params.get('annotate') == 'is_favorite' and not stream_mode:
+            bits = bitsets.get(request.user.pk)
+            favorite_ids = frozenset(bitsets.members(bits))
+            suffix += f"-fav{bitsets.fingerprint(bits)}"
+        version, etag, last_modified = dataset_validators(suffix=suffix)
+        conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if conditional is not None:
+            log_response(conditional, "PitcherViewSet.list")
+            return apply_validators(conditional, etag, last_modified)
+        if stream_mode:
+            # Rows are read with a server-side cursor and encoded in batches, so memory per
+            # request stays flat regardless of how many pitchers match.
+            queryset = self.filter_queryset(self.get_queryset()).order_by('id')
+            response = streaming_response(queryset, PITCHER_FIELDS, stream_mode, asynchronous=is_asgi(request))
+            apply_validators(response, etag, last_modified)
+            log_response(response, "PitcherViewSet.list")
+            return response
+        if self.serves_snapshot(request):
+            snapshot = get_snapshot(version)
+            body = snapshot.list_body if favorite_ids is None else snapshot.flagged_list_body(favorite_ids)
+            response = HttpResponse(body, content_type='application/json')
+            apply_validators(response, etag, last_modified)
+            logger.info(f"Served {len(snapshot)} pitchers from snapshot v{version}")
+            return response
         response = super().list(request, *args, **kwargs)
+        if favorite_ids is not None:
+            items = response.data['results'] if isinstance(response.data, dict) else response.data
+            for item in items:
+                item['is_favorite'] = item['id'] in favorite_ids
+        apply_validators(response, etag, last_modified)
         log_response(response, "PitcherViewSet.list")
         return response
 
     def retrieve(self, request, *args, **kwargs):
         log_request(request, "PitcherViewSet.retrieve")
+        version, etag, last_modified = dataset_validators(suffix=f"-{kwargs.get('pk')}")
+        conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if conditional is not None:
+            log_response(conditional, "PitcherViewSet.retrieve")
+            return apply_validators(conditional, etag, last_modified)
+        row = None
+        if self.serves_snapshot(request) and str(kwargs.get('pk')).isdigit():
+            row = get_snapshot(version).get(int(kwargs['pk']))
+        if row is not None:
+            response = HttpResponse(encode_row(row), content_type='application/json')
+            apply_validators(response, etag, last_modified)
+            log_response(response, "PitcherViewSet.retrieve")
+            return response
         response = super().retrieve(request, *args, **kwargs)
+        apply_validators(response, etag, last_modified)
         log_response(response, "PitcherViewSet.retrieve")
         return response
 
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """
+        Delta sync: rows inserted/updated and ids deleted since dataset version `since`.
+
+        Clients keep the returned `version` and pass it back next time. When they are
+        too far behind (or the delta is too large) the response asks them to reload
+        the full list instead.
+        """
+        log_request(request, "PitcherViewSet.changes")
+        since = request.query_params.get('since', '')
+        if not since.isdigit():
+            response = Response({'since': 'Must be a dataset version number'}, status=status.HTTP_400_BAD_REQUEST)
+            log_response(response, "PitcherViewSet.changes")
+            return response
+        since = int(since)
+        version, etag, last_modified = dataset_validators(suffix=f"-since{since}")
+        conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if conditional is not None:
+            log_response(conditional, "PitcherViewSet.changes")
+            return apply_validators(conditional, etag, last_modified)
+
+        version, upserts, deletes = changes_since(since, settings.DELTA_SYNC_MAX_ROWS)
+        if upserts is None:
+            response = Response({
+                'version': version,
+                'snapshot_required': True,
+                'snapshot_url': request.build_absolute_uri(reverse('pitcher-list')),
+            })
+        else:
+            response = Response({
+                'version': version,
+                'since': since,
+                'upserts': list(upserts.values(*PITCHER_FIELDS)),
+                'deletes': deletes,
+            })
+        apply_validators(response, etag, last_modified)
+        log_response(response, "PitcherViewSet.changes")
+        return response
+
+    @action(detail=False, methods=['get'])
+    def trending(self, request):
+        """
+        Pre-sorted top pitchers by time-decayed new favorites (`?by=trending`, the
+        default) or by total favorites (`?by=favorites`).
+        """
+        log_request(request, "PitcherViewSet.trending")
+        by = request.query_params.get('by', 'trending')
+        limit = parse_limit(request, settings.TRENDING_TOP_N)
+        errors = {}
+        if by not in ('trending', 'favorites'):
+            errors['by'] = 'Must be trending or favorites'
+        if limit is None:
+            errors['limit'] = f"Must be between 1 and {settings.TRENDING_TOP_N}"
+        if errors:
+            response = Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            log_response(response, "PitcherViewSet.trending")
+            return response
+        snapshot = get_snapshot(DatasetVersion.current().version)
+        results = []
+        for pitcher_id, score, favorite_count in counters.top(by, limit):
+            row = snapshot.get(pitcher_id)
+            if row is not None:
+                results.append({
+                    'pitcher': row._asdict(), 'trending_score': round(score, 4), 'favorite_count': favorite_count
+                })
+        response = Response(results)
+        log_response(response, "PitcherViewSet.trending")
+        return response
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """Users who follow this pitcher also follow: cached neighbors by favorites co-occurrence"""
+        log_request(request, "PitcherViewSet.similar")
+        limit = parse_limit(request, settings.RECOMMENDATIONS_TOP_K)
+        if limit is None:
+            response = Response(
+                {'limit': f"Must be between 1 and {settings.RECOMMENDATIONS_TOP_K}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+            log_response(response, "PitcherViewSet.similar")
+            return response
+        snapshot = get_snapshot(DatasetVersion.current().version)
+        if not str(pk).isdigit() or snapshot.get(int(pk)) is None:
+            response = Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+            log_response(response, "PitcherViewSet.similar")
+            return response
+        results = []
+        for other_id, score, shared in recommendations.similar(int(pk), limit):
+            row = snapshot.get(other_id)
+            if row is not None:
+                results.append({'pitcher': row._asdict(), 'score': round(score, 4), 'shared_favorites': shared})
+        response = Response(results)
+        log_response(response, "PitcherViewSet.similar")
+        return response
+
+    @action(detail=False, methods=['get'])
+    def teams(self, request):
+        """Per-team staff summaries: pitchers by hand, pitch types thrown and average velocity and spin"""
+        log_request(request, "PitcherViewSet.teams")
+        version, etag, last_modified = dataset_validators(suffix='-teams')
+        conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if conditional is not None:
+            log_response(conditional, "PitcherViewSet.teams")
+            return apply_validators(conditional, etag, last_modified)
+        response = HttpResponse(warming.teams_body(get_snapshot(version)), content_type='application/json')
+        apply_validators(response, etag, last_modified)
+        log_response(response, "PitcherViewSet.teams")
+        return response
+
+    @action(detail=False, methods=['get'], url_path=r'(?P<player_name>[^/]+)/matchups')
+    def matchups(self, request, player_name=None):
+        """
+        How a pitcher attacks left- vs right-handed batters: pitch mix, zone rate and
+        movement against each side, with deltas from the league (see `pitchers/matchups.py`).
+        """
+        log_request(request, "PitcherViewSet.matchups")
+        from . import matchups
+
+        variant = hashlib.md5(player_name.encode()).hexdigest()
+        version, etag, last_modified = dataset_validators(suffix=f"-matchups-{variant}")
+        conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if conditional is not None:
+            log_response(conditional, "PitcherViewSet.matchups")
+            return apply_validators(conditional, etag, last_modified)
+        table = matchups.get_table(get_snapshot(version))
+        if player_name not in table:
+            response = Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+            log_response(response, "PitcherViewSet.matchups")
+            return response
+        response = Response(table.split_report(player_name))
+        apply_validators(response, etag, last_modified)
+        log_response(response, "PitcherViewSet.matchups")
+        return response
+
+    @action(detail=False, methods=['post'], url_path='matchups', url_name='lineup-matchups')
+    def lineup_matchups(self, request):
+        """
+        Batched matchups: a staff (`pitchers`, a list of names, or `team`) against a
+        lineup's handedness, given as counts (`{"L": 4, "R": 4, "S": 1}`) or a list of
+        `L`/`R`/`S`. Returns each pitcher's expected mix against that lineup vs the league.
+        """
+        log_request(request, "PitcherViewSet.lineup_matchups")
+        from . import matchups
+
+        lineup = request.data.get('lineup')
+        if isinstance(lineup, list):
+            valid = all(side in ('L', 'R', 'S') for side in lineup)
+            lineup = {side: lineup.count(side) for side in ('L', 'R', 'S')} if valid else None
+        elif isinstance(lineup, dict) and set(lineup) <= {'L', 'R', 'S'}:
+            lineup = {side: lineup.get(side, 0) for side in ('L', 'R', 'S')}
+        else:
+            lineup = None
+        errors = {}
+        if lineup is None or not all(isinstance(count, int) and count >= 0 for count in lineup.values()) \
+                or not sum(lineup.values()):
+            errors['lineup'] = 'Must be batter counts by side (L, R, S) or a list of L/R/S'
+        pitchers = request.data.get('pitchers')
+        team = request.data.get('team')
+        if pitchers is None and not team:
+            errors['pitchers'] = 'Give a list of pitcher names or a team'
+        elif pitchers is not None and (
+            not isinstance(pitchers, list) or not all(isinstance(name, str) for name in pitchers)
+            or len(pitchers) > settings.MATCHUPS_BATCH_MAX
+        ):
+            errors['pitchers'] = f"Must be a list of at most {settings.MATCHUPS_BATCH_MAX} pitcher names"
+        if errors:
+            response = Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            log_response(response, "PitcherViewSet.lineup_matchups")
+            return response
+
+        table = matchups.get_table(get_snapshot(DatasetVersion.current().version))
+        if pitchers is None:
+            pitchers = table.staffs.get(team, [])[:settings.MATCHUPS_BATCH_MAX]
+        response = Response({
+            'lineup': lineup,
+            'pitchers': table.lineup_report(pitchers, lineup),
+            'missing': [name for name in pitchers if name not in table],
+        })
+        log_response(response, "PitcherViewSet.lineup_matchups")
+        return response
+
+    @action(detail=True, methods=['get'])
+    def heatmap(self, request, pk=None):
+        """
+        Render a location heatmap from the cached density grids.
+
+        Query params: `image` (png|svg), `counts` (eg `0-2,1-2`), `stand` (L|R|all,
+        defaults to this row's batter side) and `bandwidth` (smoothing, in cells).
+        """
+        log_request(request, "PitcherViewSet.heatmap")
+        from . import heatmaps
+
+        pitcher = self.get_object()
+        image_format = request.query_params.get('image', 'png')
+        counts = sorted({count for count in request.query_params.get('counts', '').split(',') if count})
+        stand = request.query_params.get('stand', pitcher.stand_side)
+        try:
+            bandwidth = float(request.query_params.get('bandwidth', 1.0))
+        except ValueError:
+            bandwidth = math.nan
+        # float() also parses `nan` and `inf`, and NaN gets through min/max.
+        bandwidth = min(max(bandwidth, 0.0), 5.0) if math.isfinite(bandwidth) else None
+
+        errors = {}
+        if image_format not in ('png', 'svg'):
+            errors['image'] = 'Must be png or svg'
+        if any(count not in heatmaps.COUNT_INDEX for count in counts):
+            errors['counts'] = f"Counts must be balls-strikes, one of: {', '.join(heatmaps.COUNTS)}"
+        if stand not in ('L', 'R', 'all'):
+            errors['stand'] = 'Must be L, R or all'
+        if bandwidth is None:
+            errors['bandwidth'] = 'Must be a number'
+        if errors:
+            response = Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            log_response(response, "PitcherViewSet.heatmap")
+            return response
+
+        store = heatmaps.get_store()
+        sides = ('L', 'R') if stand == 'all' else (stand,)
+        keys = [heatmaps.group_key(pitcher.player_name, pitcher.pitch_type, side) for side in sides]
+        body = heatmaps.render(store, keys, counts, image_format, bandwidth) if store else None
+        if body is None:
+            response = Response(
+                {'detail': 'No heatmap grid available for this pitcher', 'heatmap_path': pitcher.heatmap_path},
+                status=status.HTTP_404_NOT_FOUND
+            )
+            log_response(response, "PitcherViewSet.heatmap")
+            return response
+
+        variant = hashlib.md5(repr((keys, counts, bandwidth, image_format)).encode()).hexdigest()
+        etag = quote_etag(f"heatmap-v{store.version}-{variant}")
+        conditional = get_conditional_response(request, etag=etag)
+        if conditional is not None:
+            return conditional
+        content_type = 'image/svg+xml' if image_format == 'svg' else 'image/png'
+        response = HttpResponse(body, content_type=content_type)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, max_age=3600)
+        logger.info(f"Rendered {image_format} heatmap for {pitcher.player_name} {pitcher.pitch_type} ({len(body)} bytes)")
+        return response
+
+class PitchArchetypeViewSet(viewsets.ReadOnlyModelViewSet):
+    """Browse pitch archetypes (see `pitchers/archetypes.py`); `?pitch_type=FF` narrows the list"""
+    queryset = PitchArchetype.objects.all()
+    serializer_class = PitchArchetypeSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    lookup_field = 'label'
+    query_budgets = {'list': 2, 'retrieve': 2, 'pitchers': 3}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        pitch_type = self.request.query_params.get('pitch_type')
+        if pitch_type:
+            queryset = queryset.filter(pitch_type=pitch_type.upper())
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        log_request(request, "PitchArchetypeViewSet.list")
+        response = super().list(request, *args, **kwargs)
+        log_response(response, "PitchArchetypeViewSet.list")
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        log_request(request, "PitchArchetypeViewSet.retrieve")
+        response = super().retrieve(request, *args, **kwargs)
+        log_response(response, "PitchArchetypeViewSet.retrieve")
+        return response
+
+    @action(detail=True, methods=['get'])
+    def pitchers(self, request, label=None):
+        """The archetype's pitches, most typical (closest to the centroid) first"""
+        log_request(request, "PitchArchetypeViewSet.pitchers")
+        limit = parse_limit(request, settings.ARCHETYPE_PITCHERS_MAX, default=50)
+        if limit is None:
+            response = Response(
+                {'limit': f"Must be between 1 and {settings.ARCHETYPE_PITCHERS_MAX}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+            log_response(response, "PitchArchetypeViewSet.pitchers")
+            return response
+        archetype = self.get_object()
+        members = Pitcher.objects.filter(archetype=archetype.label).order_by('archetype_distance', 'id')[:limit]
+        response = Response({
+            'archetype': PitchArchetypeSerializer(archetype).data,
+            'pitchers': PitcherSerializer(members, many=True).data,
+        })
+        log_response(response, "PitchArchetypeViewSet.pitchers")
+        return response
+
 class FavoritePitcherViewSet(viewsets.ModelViewSet):
     serializer_class = FavoritePitcherSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budgets = {
+        'list': 2, 'retrieve': 2, 'my_favorites': 3, 'get_all_favorites': 4, 'recommendations': 6, 'compare': 5,
+        # Writes lock and bump the user's favorites version (see `pitchers/favorites.py`), creating it on
+        # their first write, and only touch the rows that changed, however many favorites there are.
+        'create': 12, 'update': 11, 'partial_update': 11, 'destroy': 12, 'clear_all': 12,
+        # Up to three lookups (exact, case-insensitive, normalized spaces), each resolving `?username=`.
+        'delete_by_name': 14,
+        # Including any placeholder pitchers it has to create, under one reserved dataset version.
+        'save_favorites': 25,
+    }
 
     def get_queryset(self):
         username = self.request.query_params.get('username')
         if username:
             try:
                 user = User.objects.get(username=username)
-                return FavoritePitcher.objects.filter(user=user)
+                return FavoritePitcher.objects.filter(user=user).select_related('pitcher')
             except User.DoesNotExist:
                 return FavoritePitcher.objects.none()
-        return FavoritePitcher.objects.filter(user=self.request.user)
+        return FavoritePitcher.objects.filter(user=self.request.user).select_related('pitcher')
 
-    def perform_create(self, serializer):
-        log_request(self.request, "FavoritePitcherViewSet.perform_create")
-        try:
-            username = self.request.query_params.get('username')
-            if username:
-                try:
-                    user = User.objects.get(username=username)
-                    serializer.save(user=user)
-                except User.DoesNotExist:
-                    raise serializers.ValidationError({'username': 'User not found'})
-            else:
-                serializer.save(user=self.request.user)
-            logger.info("Successfully created favorite")
-        except Exception as e:
-            logger.error(f"Error creating favorite: {str(e)}", exc_info=True)
-            raise
+    def coalesced_favorites(self, user):
+        """Serialized favorites for `user`, shared between concurrent identical reads"""
+        return single_flight.do(
+            f"favorites:{user.pk}",
+            lambda: self.get_serializer(
+                FavoritePitcher.objects.filter(user=user).select_related('pitcher'), many=True
+            ).data
+        )
+
+    @favorites.idempotent
+    @favorites.versioned
+    def create(self, request, *args, **kwargs):
+        """Add a favorite: 201 with it, or 200 with the existing one if it was already there"""
+        log_request(request, "FavoritePitcherViewSet.create")
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        username = request.query_params.get('username')
+        if username:
+            user = User.objects.filter(username=username).first()
+            if user is None:
+                raise ValidationError({'username': 'User not found'})
+        else:
+            user = request.user
+        pitcher = serializer.validated_data['pitcher']
+        write = favorites.apply(user.pk, add=[pitcher.pk], expected=request.expected_version, action='create')
+        favorite = FavoritePitcher.objects.get(user=user, pitcher=pitcher)
+        favorite.pitcher = pitcher
+        logger.info(f"{'Created' if write.added else 'Already had'} favorite {pitcher.pk} for user {user.pk}")
+        response = Response(
+            self.get_serializer(favorite).data, status=status.HTTP_201_CREATED if write.added else status.HTTP_200_OK
+        )
+        response['ETag'] = favorites.etag(write.version)
+        log_response(response, "FavoritePitcherViewSet.create")
+        return response
+
+    @favorites.idempotent
+    @favorites.versioned
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        # Swapping the pitcher of a favorite is a change like any other: same lock, new version.
+        user_id = serializer.instance.user_id
+        with transaction.atomic():
+            version = favorites.lock(user_id, self.request.expected_version)
+            # post_save schedules the recommendations/counters sync.
+            serializer.save()
+            favorites.bump(user_id, version)
+        events.publish(events.user_channel(user_id), {'action': 'update'})
 
     @action(detail=False, methods=['post'])
+    @favorites.versioned
     def save_favorites(self, request):
+        """
+        Replace the user's favorites with `pitcher_names`, writing only the favorites that changed.
+
+        Placeholder pitchers are created in their own dataset change before the
+        favorites write and its idempotency record, which share one transaction,
+        and only once a retry or a stale `If-Match` has been ruled out.
+        """
         log_request(request, "FavoritePitcherViewSet.save_favorites")
         try:
             username = request.query_params.get('username')
@@ -168,75 +732,48 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
                 log_response(response, "FavoritePitcherViewSet.save_favorites")
                 return response
 
-            pitcher_names = request.data.get('pitcher_names', [])
+            replayed = favorites.recorded_response(request)
+            if replayed is not None:
+                log_response(replayed, "FavoritePitcherViewSet.save_favorites")
+                return replayed
+            favorites.check(user.pk, request.expected_version)
+
+            pitcher_names = request.data.get('pitcher_names') or []
             logger.info(f"Received pitcher names: {pitcher_names}")
-            
-            # Clear existing favorites
-            deleted_count = FavoritePitcher.objects.filter(user=user).delete()
-            logger.info(f"Cleared existing favorites. Deleted count: {deleted_count}")
 
-            # If pitcher_names is null or empty, just return empty response
-            if not pitcher_names:
-                logger.info("No pitcher names provided, returning empty favorites list")
-                response = Response({
-                    'favorites': [],
-                    'count': 0
-                }, status=status.HTTP_200_OK)
-                log_response(response, "FavoritePitcherViewSet.save_favorites")
-                return response
+            # Look every name up in one query rather than one per name.
+            pitchers_by_name = defaultdict(list)
+            for pitcher in Pitcher.objects.filter(player_name__in=set(pitcher_names)):
+                pitchers_by_name[pitcher.player_name].append(pitcher)
+            names = list(dict.fromkeys(pitcher_names))
+            missing = [name for name in names if name not in pitchers_by_name]
+            if missing:
+                # Unknown names get placeholder records, published as one dataset change.
+                with dataset_change() as version:
+                    Pitcher.objects.bulk_create(
+                        [Pitcher(player_name=name, row_version=version, **PLACEHOLDER_PITCHER) for name in missing]
+                    )
+                for pitcher in Pitcher.objects.filter(player_name__in=missing):
+                    pitchers_by_name[pitcher.player_name].append(pitcher)
+                logger.info(f"Created new pitcher records for {missing}")
 
-            # Create new favorites
             saved_favorites = []
-            for name in pitcher_names:
-                try:
-                    logger.info(f"Processing pitcher: {name}")
-                    # Try to get existing pitcher or create new one with default values
-                    pitcher, created = Pitcher.objects.get_or_create(
-                        player_name=name,
-                        defaults={
-                            'player_name': name,
-                            'player_image': 'https://example.com/default.jpg',
-                            'team_name': 'Unknown Team',
-                            'team_logo': 'https://example.com/default_logo.jpg',
-                            'stand_side': 'R',
-                            'pitch_type': 'FB',
-                            'velocity_range': '90-95',
-                            'usage_rate': '0%',
-                            'zone_rate': '0%',
-                            'avg_spin_rate': 0.0,
-                            'avg_horz_break': 0.0,
-                            'avg_induced_vert_break': 0.0,
-                            'arm_angle': 0.0,
-                            'throws': 'R',
-                            'heatmap_path': '/default/heatmap.png'
-                        }
-                    )
-                    if created:
-                        logger.info(f"Created new pitcher record for {name} (ID: {pitcher.id})")
-                    else:
-                        logger.info(f"Found existing pitcher record for {name} (ID: {pitcher.id})")
-                    
-                    favorite = FavoritePitcher.objects.create(
-                        user=user,
-                        pitcher=pitcher
-                    )
-                    logger.info(f"Created favorite record (ID: {favorite.id}) for {pitcher.player_name}")
-                    
-                    saved_favorites.append({
-                        'pitcher_name': pitcher.player_name
-                    })
-                except Exception as e:
-                    logger.error(f"Error creating favorite for {name}: {str(e)}", exc_info=True)
+            pitcher_ids = []
+            for name in names:
+                matches = pitchers_by_name[name]
+                if len(matches) > 1:
+                    logger.error(f"Error creating favorite for {name}: {len(matches)} pitchers have this name")
                     continue
-
-            logger.info(f"Successfully saved {len(saved_favorites)} favorites")
-            response = Response({
-                'favorites': saved_favorites,
-                'count': len(saved_favorites)
-            }, status=status.HTTP_200_OK)
+                pitcher_ids.append(matches[0].pk)
+                saved_favorites.append({
+                    'pitcher_name': name
+                })
+            response = self.write_saved_favorites(request, user, pitcher_ids, saved_favorites)
             log_response(response, "FavoritePitcherViewSet.save_favorites")
             return response
 
+        except favorites.VersionConflict:
+            raise
         except Exception as e:
             logger.error(f"Error saving favorites: {str(e)}", exc_info=True)
             response = Response(
@@ -246,6 +783,22 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
             log_response(response, "FavoritePitcherViewSet.save_favorites")
             return response
 
+    @favorites.idempotent
+    def write_saved_favorites(self, request, user, pitcher_ids, saved_favorites):
+        """The favorites write of `save_favorites`, recorded under the request's `Idempotency-Key`"""
+        write = favorites.apply(user.pk, replace=pitcher_ids, expected=request.expected_version, action='save')
+        logger.info(f"Favorites of {user.username} now v{write.version}: +{len(write.added)} -{len(write.removed)}")
+        logger.info(f"Successfully saved {len(saved_favorites)} favorites")
+        response = Response({
+            'favorites': saved_favorites,
+            'count': len(saved_favorites),
+            'version': write.version,
+            'added': len(write.added),
+            'removed': len(write.removed),
+        }, status=status.HTTP_200_OK)
+        response['ETag'] = favorites.etag(write.version)
+        return response
+
     @action(detail=False, methods=['get'])
     def my_favorites(self, request):
         log_request(request, "FavoritePitcherViewSet.my_favorites")
@@ -269,10 +822,9 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
                 log_response(response, "FavoritePitcherViewSet.my_favorites")
                 return response
 
-            favorites = FavoritePitcher.objects.filter(user=user)
-            serializer = self.get_serializer(favorites, many=True)
-            logger.info(f"Retrieved {len(favorites)} favorites for user {username}")
-            response = Response(serializer.data)
+            saved = self.coalesced_favorites(user)
+            logger.info(f"Retrieved {len(saved)} favorites for user {username}")
+            response = Response(saved)
             log_response(response, "FavoritePitcherViewSet.my_favorites")
             return response
         except Exception as e:
@@ -284,6 +836,63 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
             log_response(response, "FavoritePitcherViewSet.my_favorites")
             return response
 
+    @action(detail=False, methods=['get'])
+    def recommendations(self, request):
+        """Pitchers similar to the user's favorites, or the most favorited ones if they have none"""
+        log_request(request, "FavoritePitcherViewSet.recommendations")
+        limit = parse_limit(request, settings.RECOMMENDATIONS_TOP_K)
+        if limit is None:
+            response = Response(
+                {'limit': f"Must be between 1 and {settings.RECOMMENDATIONS_TOP_K}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+            log_response(response, "FavoritePitcherViewSet.recommendations")
+            return response
+        snapshot = get_snapshot(DatasetVersion.current().version)
+        results = []
+        for pitcher_id, score in recommendations.recommend(request.user.pk, limit):
+            row = snapshot.get(pitcher_id)
+            if row is not None:
+                results.append({'pitcher': row._asdict(), 'score': round(score, 4)})
+        response = Response(results)
+        log_response(response, "FavoritePitcherViewSet.recommendations")
+        return response
+
+    @action(detail=False, methods=['get'])
+    def compare(self, request):
+        """
+        Pitchers followed by all (`?op=intersect`, the default) or any (`?op=union`) of the
+        comma-separated `?usernames=`. A single username is compared with the requesting user.
+        """
+        log_request(request, "FavoritePitcherViewSet.compare")
+        op = request.query_params.get('op', 'intersect')
+        usernames = list(dict.fromkeys(name for name in request.query_params.get('usernames', '').split(',') if name))
+        errors = {}
+        if op not in ('intersect', 'union'):
+            errors['op'] = 'Must be intersect or union'
+        if not 1 <= len(usernames) <= settings.FAVORITES_COMPARE_MAX_USERS:
+            errors['usernames'] = f"Must name between 1 and {settings.FAVORITES_COMPARE_MAX_USERS} users"
+        if errors:
+            response = Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            log_response(response, "FavoritePitcherViewSet.compare")
+            return response
+        if len(usernames) == 1 and usernames[0] != request.user.username:
+            usernames.insert(0, request.user.username)
+
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        missing = [username for username in usernames if username not in user_ids]
+        if missing:
+            response = Response({'detail': f"Users not found: {', '.join(missing)}"}, status=status.HTTP_404_NOT_FOUND)
+            log_response(response, "FavoritePitcherViewSet.compare")
+            return response
+        bits = bitsets.get_many(list(user_ids.values()))
+        combined = reduce(and_ if op == 'intersect' else or_, bits.values())
+        snapshot = get_snapshot(DatasetVersion.current().version)
+        rows = [snapshot.get(pitcher_id) for pitcher_id in bitsets.members(combined)]
+        pitchers = [row._asdict() for row in rows if row is not None]
+        response = Response({'op': op, 'usernames': usernames, 'count': len(pitchers), 'pitchers': pitchers})
+        log_response(response, "FavoritePitcherViewSet.compare")
+        return response
+
     @action(detail=False, methods=['get'])
     def get_all_favorites(self, request):
         log_request(request, "FavoritePitcherViewSet.get_all_favorites")
@@ -307,12 +916,13 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
                 log_response(response, "FavoritePitcherViewSet.get_all_favorites")
                 return response
 
-            favorites = FavoritePitcher.objects.filter(user=user)
-            serializer = self.get_serializer(favorites, many=True)
-            logger.info(f"Retrieved {len(favorites)} favorites for user {username}")
+            saved = self.coalesced_favorites(user)
+            logger.info(f"Retrieved {len(saved)} favorites for user {username}")
             response = Response({
-                'favorites': serializer.data,
-                'count': len(favorites)
+                'favorites': saved,
+                'count': len(saved),
+                # Send back as `If-Match: "favorites-v<version>"` to save only if nothing changed since.
+                'version': favorites.current_version(user.pk),
             })
             log_response(response, "FavoritePitcherViewSet.get_all_favorites")
             return response
@@ -326,6 +936,8 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
             return response
 
     @action(detail=False, methods=['delete'])
+    @favorites.idempotent
+    @favorites.versioned
     def clear_all(self, request):
         log_request(request, "FavoritePitcherViewSet.clear_all")
         try:
@@ -348,15 +960,18 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
                 log_response(response, "FavoritePitcherViewSet.clear_all")
                 return response
 
-            count = FavoritePitcher.objects.filter(user=user).count()
-            FavoritePitcher.objects.filter(user=user).delete()
+            write = favorites.apply(user.pk, replace=(), expected=request.expected_version, action='clear')
+            count = len(write.removed)
             logger.info(f"Successfully deleted all {count} favorites for user {username}")
             response = Response(
-                {'message': f'Successfully deleted all {count} favorites'},
+                {'message': f'Successfully deleted all {count} favorites', 'version': write.version},
                 status=status.HTTP_200_OK
             )
+            response['ETag'] = favorites.etag(write.version)
             log_response(response, "FavoritePitcherViewSet.clear_all")
             return response
+        except favorites.VersionConflict:
+            raise
         except Exception as e:
             logger.error(f"Error clearing favorites: {str(e)}", exc_info=True)
             response = Response(
@@ -367,6 +982,8 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
             return response
 
     @action(detail=False, methods=['delete'])
+    @favorites.idempotent
+    @favorites.versioned
     def delete_by_name(self, request):
         log_request(request, "FavoritePitcherViewSet.delete_by_name")
         try:
@@ -404,11 +1021,16 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
                 log_response(response, "FavoritePitcherViewSet.delete_by_name")
                 return response
 
-            favorite.delete()
+            write = favorites.apply(
+                favorite.user_id, remove=[favorite.pitcher_id], expected=request.expected_version, action='delete'
+            )
             logger.info(f"Successfully deleted favorite for player: {player_name}")
             response = Response(status=status.HTTP_204_NO_CONTENT)
+            response['ETag'] = favorites.etag(write.version)
             log_response(response, "FavoritePitcherViewSet.delete_by_name")
             return response
+        except favorites.VersionConflict:
+            raise
         except Exception as e:
             logger.error(f"Error deleting favorite: {str(e)}", exc_info=True)
             response = Response(
@@ -418,16 +1040,23 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
             log_response(response, "FavoritePitcherViewSet.delete_by_name")
             return response
 
+    @favorites.idempotent
+    @favorites.versioned
     def destroy(self, request, *args, **kwargs):
         log_request(request, "FavoritePitcherViewSet.destroy")
         try:
             instance = self.get_object()
             logger.info(f"Attempting to delete favorite {instance.id} for user {request.user.username}")
-            self.perform_destroy(instance)
+            write = favorites.apply(
+                instance.user_id, remove=[instance.pitcher_id], expected=request.expected_version, action='delete'
+            )
             logger.info("Successfully deleted favorite")
             response = Response(status=status.HTTP_204_NO_CONTENT)
+            response['ETag'] = favorites.etag(write.version)
             log_response(response, "FavoritePitcherViewSet.destroy")
             return response
+        except favorites.VersionConflict:
+            raise
         except Exception as e:
             logger.error(f"Error deleting favorite: {str(e)}", exc_info=True)
             response = Response(
@@ -436,3 +1065,35 @@ class FavoritePitcherViewSet(viewsets.ModelViewSet):
             )
             log_response(response, "FavoritePitcherViewSet.destroy")
             return response
+
+
+class JobViewSet(mixins.CreateModelMixin, viewsets.ReadOnlyModelViewSet):
+    """Enqueue background jobs (staff only) and poll their status and progress"""
+    serializer_class = JobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    query_budgets = {'list': 2, 'retrieve': 2, 'create': 2}
+
+    def get_permissions(self):
+        if self.action == 'create':
+            return [permissions.IsAdminUser()]
+        return [permissions.IsAuthenticated()]
+
+    def get_queryset(self):
+        if self.request.user.is_staff:
+            return Job.objects.all()
+        return Job.objects.filter(created_by=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        log_request(request, "JobViewSet.create")
+        response = super().create(request, *args, **kwargs)
+        log_response(response, "JobViewSet.create")
+        return response
+
+    def perform_create(self, serializer):
+        queued = jobs.enqueue(
+            serializer.validated_data['kind'],
+            serializer.validated_data.get('payload'),
+            user=self.request.user
+        )
+        serializer.instance = queued
+        logger.info(f"Enqueued job {queued}")
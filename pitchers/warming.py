@@ -0,0 +1,245 @@
+"""
+Cache warming: artifacts built at release, loaded before a worker serves.
+
+After a deploy or a data reload, every process starts with empty in-process
+caches. The first requests pay for compressing the pitcher list, computing
+the leaderboards, summarizing teams and rendering heatmaps. `manage.py
+warm_caches` runs in the release phase, after `migrate`. It computes those
+bodies once and stores them as `PrecomputedArtifact` rows keyed by dataset
+version (the `reload_pitchers` job does the same after a reload).
+
+`prime` loads the current version's artifacts into the in-process caches with
+one query. It runs in the gunicorn master before forking (from
+`preload_snapshot`) and again in each worker's `post_fork`, which covers
+workers started after the dataset has moved past the master's version. A kind
+with no stored artifact is computed in place, so priming leaves the caches warm
+either way, just slower.
+
+Each kind registers a builder, `fn(snapshot)` yielding (key, body, meta), with
+`@builder(kind)` and a primer, `fn(snapshot, artifacts)`, with
+`@primer(kind)`. Artifacts of the newest `WARM_CACHES_KEEP` versions are kept.
+"""
+import json
+import logging
+import time
+from threading import Lock
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from . import counters
+from .dataset import get_snapshot, team_summaries
+from .middleware import brotli, compress_body, compressed_bodies
+from .models import DatasetVersion, PrecomputedArtifact
+
+logger = logging.getLogger(__name__)
+
+# kind -> fn(snapshot) yielding (key, body, meta), in build order
+builders = {}
+# kind -> fn(snapshot, artifacts of that kind), in priming order
+primers = {}
+
+_bodies = {}
+_bodies_lock = Lock()
+_primed_version = None
+
+HEATMAP_VARIANT = ((), 'png', 1.0)
+
+
+def builder(kind):
+    """Register `fn(snapshot)` as the builder of artifacts of `kind`"""
+    def decorator(fn):
+        builders[kind] = fn
+        return fn
+    return decorator
+
+
+def primer(kind):
+    """Register `fn(snapshot, artifacts)` to load artifacts of `kind` into this process"""
+    def decorator(fn):
+        primers[kind] = fn
+        return fn
+    return decorator
+
+
+def encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def cached_body(kind, snapshot, build):
+    """The body of `kind` for `snapshot`'s version from the in-process cache, built on first use"""
+    body = _bodies.get((kind, snapshot.version))
+    if body is None:
+        # Returned as built: a newer version stored meanwhile may already have replaced it in the cache.
+        body = build()
+        store_body(kind, snapshot.version, body)
+    return body
+
+
+def store_body(kind, version, body):
+    with _bodies_lock:
+        # Bodies of older versions are dropped.
+        for stale in [key for key in _bodies if key[0] == kind and key[1] != version]:
+            del _bodies[stale]
+        _bodies[(kind, version)] = body
+
+
+def teams_body(snapshot):
+    return cached_body('teams', snapshot, lambda: JSONRenderer().render(team_summaries(snapshot)))
+
+
+def hot_pitchers(snapshot):
+    """Rows of the top `WARM_HEATMAPS` pitchers by favorites, then trending"""
+    ids = {}
+    for by in ('favorites', 'trending'):
+        for pitcher_id, *_ in counters.top(by, settings.WARM_HEATMAPS):
+            ids.setdefault(pitcher_id, None)
+    rows = [snapshot.get(pitcher_id) for pitcher_id in ids]
+    return [row for row in rows if row is not None][:settings.WARM_HEATMAPS]
+
+
+@builder('pitcher_list')
+def build_pitcher_list(snapshot):
+    for encoding in encodings():
+        yield encoding, compress_body(snapshot.list_body, encoding), {'etag': snapshot.etag()}
+
+
+@primer('pitcher_list')
+def prime_pitcher_list(snapshot, artifacts):
+    stored = {artifact.key: bytes(artifact.body) for artifact in artifacts}
+    for encoding in encodings():
+        body = stored.get(encoding) or compress_body(snapshot.list_body, encoding)
+        compressed_bodies.set((snapshot.etag(), encoding), body)
+
+
+@builder('leaderboards')
+def build_leaderboards(snapshot):
+    yield 'top', json.dumps(counters.compute_top()).encode(), {'computed_at': time.time()}
+
+
+@primer('leaderboards')
+def prime_leaderboards(snapshot, artifacts):
+    # Favorites keep changing after the release, so an old leaderboard is recomputed instead.
+    fresh = [
+        artifact for artifact in artifacts
+        if time.time() - artifact.meta.get('computed_at', 0) <= settings.WARM_LEADERBOARD_MAX_AGE
+    ]
+    if fresh:
+        counters.get_cache().set(counters.TOP_KEY, json.loads(bytes(fresh[0].body)), settings.TRENDING_REFRESH_SECONDS)
+    else:
+        counters.top('trending', 1)
+
+
+@builder('teams')
+def build_teams(snapshot):
+    yield 'all', JSONRenderer().render(team_summaries(snapshot)), {}
+
+
+@primer('teams')
+def prime_teams(snapshot, artifacts):
+    if artifacts:
+        store_body('teams', snapshot.version, bytes(artifacts[0].body))
+    else:
+        teams_body(snapshot)
+
+
+@builder('heatmaps')
+def build_heatmaps(snapshot):
+    from . import heatmaps
+
+    store = heatmaps.get_store()
+    if store is None:
+        return
+    counts, image_format, bandwidth = HEATMAP_VARIANT
+    for row in hot_pitchers(snapshot):
+        keys = [heatmaps.group_key(row.player_name, row.pitch_type, row.stand_side)]
+        body = heatmaps.render(store, keys, counts, image_format, bandwidth)
+        if body is not None:
+            yield str(row.id), body, {'keys': keys, 'store_version': store.version}
+
+
+@primer('heatmaps')
+def prime_heatmaps(snapshot, artifacts):
+    # Heatmaps aren't rendered in place: that's the CPU the artifacts exist to save.
+    from . import heatmaps
+
+    store = heatmaps.get_store()
+    if store is None:
+        return
+    counts, image_format, bandwidth = HEATMAP_VARIANT
+    heatmaps.prerendered.clear()
+    for artifact in artifacts:
+        if artifact.meta.get('store_version') == store.version:
+            key = (store.version, tuple(artifact.meta['keys']), counts, image_format, bandwidth)
+            heatmaps.prerendered[key] = bytes(artifact.body)
+
+
+def build(version=None):
+    """Compute and store the artifacts of `version` (default: the current one); returns {kind: count}"""
+    started = time.perf_counter()
+    snapshot = get_snapshot(version if version is not None else DatasetVersion.current().version)
+    artifacts = []
+    built = {}
+    for kind, fn in builders.items():
+        found = [
+            PrecomputedArtifact(kind=kind, key=key, version=snapshot.version, body=body, meta=meta)
+            for key, body, meta in fn(snapshot)
+        ]
+        artifacts.extend(found)
+        built[kind] = len(found)
+    with transaction.atomic():
+        PrecomputedArtifact.objects.filter(version=snapshot.version).delete()
+        PrecomputedArtifact.objects.bulk_create(artifacts)
+        kept = list(
+            PrecomputedArtifact.objects.values_list('version', flat=True).distinct().order_by('-version')
+            [:settings.WARM_CACHES_KEEP]
+        )
+        if kept:
+            PrecomputedArtifact.objects.filter(version__lt=kept[-1]).delete()
+    logger.info(
+        f"Built {len(artifacts)} artifacts for v{snapshot.version} "
+        f"({sum(len(artifact.body) for artifact in artifacts)} bytes) in {time.perf_counter() - started:.3f}s"
+    )
+    return built
+
+
+def prime(snapshot=None):
+    """
+    Fill this process's caches for `snapshot` (default: the current version)
+    from its artifacts; returns the number of artifacts loaded, or None if
+    this process was already primed for that version.
+    """
+    global _primed_version
+    started = time.perf_counter()
+    if snapshot is None:
+        snapshot = get_snapshot(DatasetVersion.current().version)
+    if _primed_version == snapshot.version:
+        return None
+    artifacts = {kind: [] for kind in primers}
+    for artifact in PrecomputedArtifact.objects.filter(version=snapshot.version).order_by('kind', 'key'):
+        artifacts.setdefault(artifact.kind, []).append(artifact)
+    for kind, fn in primers.items():
+        try:
+            fn(snapshot, artifacts[kind])
+        except Exception as e:
+            # A cache that can't be primed fills on demand, as without warming.
+            logger.error(f"Couldn't prime {kind} for v{snapshot.version}: {str(e)}", exc_info=True)
+    # Cold code path rather than a stored artifact: the table is a few NumPy passes over the snapshot.
+    from .matchups import get_table
+    get_table(snapshot)
+    _primed_version = snapshot.version
+    loaded = sum(len(found) for found in artifacts.values())
+    logger.info(f"Primed caches for v{snapshot.version} from {loaded} artifacts in {time.perf_counter() - started:.3f}s")
+    return loaded
+
+
+def clear():
+    """Forget everything primed into this process"""
+    global _primed_version
+    from . import heatmaps
+
+    with _bodies_lock:
+        _bodies.clear()
+    heatmaps.prerendered.clear()
+    _primed_version = None